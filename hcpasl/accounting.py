@@ -0,0 +1,155 @@
+"""
+Resource usage of the external tools called by the pipeline.
+
+`sp_run` reports the wall time, CPU time, peak resident memory and
+block I/O of each command it runs, taken from the command's rusage
+(which includes any processes it waited for). Once
+`start_accounting()` has been called, each command is appended to a
+csv file as it finishes, tagged with the pipeline stage it ran in, and
+`save_summary()` totals the usage per stage and per tool.
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+# ru_inblock and ru_oublock are counted in 512-byte blocks on Linux
+BLOCK_SIZE = 512
+FIELDS = [
+    "stage",
+    "tool",
+    "returncode",
+    "wall_s",
+    "user_s",
+    "sys_s",
+    "max_rss_mb",
+    "read_mb",
+    "written_mb",
+    "command",
+]
+
+_local = threading.local()
+_lock = threading.Lock()
+_records = []
+_csv_path = None
+
+
+@contextmanager
+def stage(number):
+    """Attribute commands run by this thread in the body to stage `number`"""
+    previous = current_stage()
+    _local.stage = number
+    try:
+        yield
+    finally:
+        _local.stage = previous
+
+
+def current_stage():
+    """The stage commands run by this thread are attributed to"""
+    return getattr(_local, "stage", None)
+
+
+def command_name(cmd):
+    """Name of the executable run by `cmd`, a list or a shell string"""
+    first = str(cmd[0]) if isinstance(cmd, (list, tuple)) else str(cmd).split()[0]
+    return os.path.basename(first)
+
+
+def start_accounting(csv_path):
+    """Start recording each command's usage in `csv_path`"""
+    global _csv_path
+    with _lock:
+        _records.clear()
+        _csv_path = csv_path
+        with open(csv_path, "w", newline="") as f:
+            csv.DictWriter(f, fieldnames=FIELDS).writeheader()
+
+
+def record_usage(cmd, wall, rusage, returncode, stage=None):
+    """
+    Log the usage of a finished command and, if accounting has been
+    started, append it to the csv file.
+
+    Parameters
+    ----------
+    cmd : list or str
+        The command that was run.
+    wall : float
+        Wall time in seconds.
+    rusage : resource.struct_rusage
+        Usage of the command, as returned by `os.wait4`.
+    returncode : int
+        The command's exit code.
+    stage : int, optional
+        Stage to attribute the command to. Default is the calling
+        thread's current stage.
+    """
+    row = {
+        "stage": current_stage() if stage is None else stage,
+        "tool": command_name(cmd),
+        "returncode": returncode,
+        "wall_s": round(wall, 3),
+        "user_s": round(rusage.ru_utime, 3),
+        "sys_s": round(rusage.ru_stime, 3),
+        "max_rss_mb": round(rusage.ru_maxrss / 1024, 1),
+        "read_mb": round(rusage.ru_inblock * BLOCK_SIZE / 1024**2, 1),
+        "written_mb": round(rusage.ru_oublock * BLOCK_SIZE / 1024**2, 1),
+        "command": " ".join(str(c) for c in cmd)
+        if isinstance(cmd, (list, tuple))
+        else str(cmd),
+    }
+    logging.info(
+        f"{row['tool']} finished in {row['wall_s']:.1f}s (user {row['user_s']:.1f}s, "
+        f"sys {row['sys_s']:.1f}s, peak RSS {row['max_rss_mb']:.0f} MB)."
+    )
+    with _lock:
+        if _csv_path is None:
+            return
+        _records.append(row)
+        with open(_csv_path, "a", newline="") as f:
+            csv.DictWriter(f, fieldnames=FIELDS).writerow(row)
+
+
+def summarise(records, key):
+    """Total the usage of `records` grouped by `key` ("stage" or "tool")"""
+    summary = {}
+    for row in records:
+        totals = summary.setdefault(
+            str(row[key]),
+            {
+                "calls": 0,
+                "wall_s": 0.0,
+                "user_s": 0.0,
+                "sys_s": 0.0,
+                "max_rss_mb": 0.0,
+                "read_mb": 0.0,
+                "written_mb": 0.0,
+            },
+        )
+        totals["calls"] += 1
+        for field in ("wall_s", "user_s", "sys_s", "read_mb", "written_mb"):
+            totals[field] = round(totals[field] + row[field], 3)
+        totals["max_rss_mb"] = max(totals["max_rss_mb"], row["max_rss_mb"])
+    return summary
+
+
+def save_summary(json_path):
+    """Write the usage recorded so far, totalled per stage and per tool"""
+    with _lock:
+        records = list(_records)
+    summary = {
+        "stages": summarise(records, "stage"),
+        "tools": summarise(records, "tool"),
+    }
+    with open(json_path, "w") as f:
+        json.dump(summary, f, indent=4)
+    for number, totals in summary["stages"].items():
+        logging.info(
+            f"Stage {number}: {totals['calls']} commands, {totals['wall_s']:.0f}s wall, "
+            f"{totals['user_s'] + totals['sys_s']:.0f}s CPU, "
+            f"peak RSS {totals['max_rss_mb']:.0f} MB."
+        )
@@ -31,22 +31,33 @@ Corrections to be applied include:
 
 import logging
 import multiprocessing as mp
-import shutil
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import nibabel as nb
 import numpy as np
 import regtricks as rt
 from fabber import Fabber, percent_progress
 from fsl.wrappers import fslmaths
-from fsl.wrappers.flirt import mcflirt
 from scipy.ndimage import binary_dilation
 
+from hcpasl.fabber_outputs import log_fabber_iterations, warm_start_mvn
+from hcpasl.journal import RunJournal
+from hcpasl.motion_estimation import refine_mcflirt, run_mcflirt
+from hcpasl.trace import span
+from hcpasl import pgzip
+from hcpasl.satrecov import FITTERS, fit_satrecov_to_dir
+from hcpasl.timing import AcquisitionTiming
 from hcpasl.utils import (
     ImagePath,
+    atomic_save,
+    intermediate_path,
     sp_run,
     make_motion_fov_mask,
+    satrecov_scaling,
     ASL_SHAPE,
+    DTYPE,
     TIS,
     NTIS,
     RPTS,
@@ -56,6 +67,25 @@ from hcpasl.utils import (
     IBF,
 )
 
+# chunks of the volume per core into which nonspatial Fabber runs are
+# split, so that chunks which converge slowly do not leave cores idle
+FABBER_CHUNKS_PER_CORE = 4
+# Fabber outputs used by the pipeline, the only ones saved: the spatial
+# run continues from the nonspatial run's MVN, its T1t is used for
+# slice-time correction and its MVN can warm-start the second fit
+FABBER_OUTPUTS = {"nospatial": ["finalMVN"], "spatial": ["mean_T1t", "finalMVN"]}
+# convergence of warm-started fits, which stop once the free energy
+# changes by less than min-fchange rather than after a fixed number of
+# iterations
+WARM_START_CONVERGENCE = {
+    "convergence": "fchange",
+    "min-fchange": 0.01,
+    "max-iterations": 10,
+}
+# iterations by which the brain mask is dilated for the first satrecov
+# fit, which precedes motion correction
+SATRECOV_MASK_DILATION = 2
+
 
 def create_ti_image(asl, tis, sliceband, slicedt, outname, repeats=None):
     """
@@ -74,33 +104,106 @@ def create_ti_image(asl, tis, sliceband, slicedt, outname, repeats=None):
     """
 
     asl_spc = rt.ImageSpace(asl)
-    n_slice = asl_spc.size[2]
-    slice_in_band = np.tile(np.arange(0, sliceband), n_slice // sliceband).reshape(
-        1, 1, n_slice, 1
+    timing = AcquisitionTiming(
+        tis, repeats or [1] * len(tis), slicedt, sliceband, asl_spc.size[2]
     )
-    ti_array = np.array([np.tile(x, asl_spc.size) for x in tis]).transpose(1, 2, 3, 0)
-    ti_array = ti_array + (slice_in_band * slicedt)
-
-    if repeats:
-        ti_array = np.concatenate(
-            [
-                np.repeat(ti_array[..., ti, np.newaxis], 2 * r, axis=-1)
-                for ti, r in enumerate(repeats)
-            ],
-            axis=-1,
-        )
+    pgzip.save_image(timing.ti_image(asl_spc, per_volume=bool(repeats)), outname)
+
+
+def _run_fabber(options):
+    """Run Fabber in a worker process, returning its output data and log"""
+    run = Fabber().run(options)
+    return run.data, run.log
+
 
-    rt.ImageSpace.save_like(asl, ti_array, outname)
+def _run_fabber_chunks(options, cores):
+    """
+    Run a nonspatial Fabber fit as concurrent jobs on chunks of the
+    volume, and reassemble their outputs.
 
+    Each voxel of a nonspatial fit is independent of the others, so the
+    data, and any other voxelwise arrays in `options`, are split along
+    their first axis, which leaves each voxel's slice, and so its slice
+    timing, unchanged. If a mask is given, the chunks hold similar
+    numbers of masked voxels and chunks without any are not run.
 
-def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
+    Returns
+    -------
+    data : dict
+        Fabber's outputs, as for a single run over the whole volume.
+    log : str
+        The jobs' logs, one after another.
+    """
+    mask = options.get("mask")
+    n_x = options["data"].shape[0]
+    # number of voxels to fit in each plane along the first axis
+    if mask is None:
+        weights = np.ones(n_x)
+    else:
+        weights = mask.reshape(n_x, -1).sum(axis=1)
+    cumulative = np.cumsum(weights)
+    n_chunks = min(cores * FABBER_CHUNKS_PER_CORE, np.count_nonzero(weights))
+    targets = cumulative[-1] * np.arange(1, n_chunks) / n_chunks
+    bounds = np.unique([0, *(np.searchsorted(cumulative, targets) + 1), n_x])
+    slabs = [
+        (start, stop)
+        for start, stop in zip(bounds[:-1], bounds[1:])
+        if weights[start:stop].any()
+    ]
+    chunks = [
+        {
+            key: val[start:stop] if isinstance(val, np.ndarray) else val
+            for key, val in options.items()
+        }
+        for start, stop in slabs
+    ]
+    logging.info(f"Running Fabber on {len(chunks)} chunks across {cores} processes.")
+    # spawn rather than fork, as the pipeline runs stages in threads
+    with ProcessPoolExecutor(cores, mp_context=mp.get_context("spawn")) as pool:
+        results = list(pool.map(_run_fabber, chunks))
+    data = {}
+    for (start, stop), (chunk_data, _) in zip(slabs, results):
+        for name, arr in chunk_data.items():
+            if name not in data:
+                data[name] = np.zeros((n_x, *arr.shape[1:]), dtype=arr.dtype)
+            data[name][start:stop] = arr
+    log = "\n".join(chunk_log for _, chunk_log in results)
+    return data, log
+
+
+def _save_fabber_outputs(data, log, out_dir, ref_nii, names):
+    """
+    Save the Fabber outputs in `names`, and Fabber's log, in `out_dir`
+    as `FabberRun.write_to_dir` does, in the intermediate image format.
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for name in names:
+        pgzip.save_image(
+            nb.Nifti1Image(data[name], ref_nii.affine, ref_nii.header),
+            intermediate_path(out_dir, name),
+        )
+    (out_dir / "logfile").write_text(log)
+
+
+def _satrecov_worker(
+    control,
+    satrecov_dir,
+    tis,
+    rpts,
+    ibf,
+    spatial,
+    ref_nii,
+    cores=1,
+    mask=None,
+    init_mvn=None,
+):
     """
     Wrapper for fabber's saturation recovery model.
 
     Parameters
     ----------
-    control_name : pathlib.Path
-        Path to the control images.
+    control : numpy.ndarray
+        4D array of the control images.
     satrecov_dir : pathlib.Path
         Parent directory for the satrecov results. Results from
         this will be stored either in {`satrecov_dir`}/spatial
@@ -115,15 +218,27 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
     spatial : bool
         Choose whether to run fabber in spatial (True) or
         non-spatial (False) mode.
+    ref_nii : nibabel.nifti1.Nifti1Image
+        Image in the space of the control images, whose header is
+        used to save Fabber's results.
+    cores : int, optional
+        Number of processes across which a non-spatial run is split.
+        A spatial run is always a single job. Default is 1.
+    mask : numpy.ndarray, optional
+        3D boolean array of the voxels to fit. Default is to fit every
+        voxel.
+    init_mvn : pathlib.Path, optional
+        Posterior from an earlier fit. If given, a non-spatial run
+        starts from it, and either run stops once it has converged
+        rather than after a fixed number of iterations.
     """
     # set options for Fabber run, generic to spatial and non-spatial runs
     options = {
-        "data": str(control_name),
+        "data": control,
         "overwrite": True,
         "noise": "white",
         "ibf": ibf,
         "model": "satrecov",
-        "save-mean": True,  # is this needed in nonspatial run?
         "casl": True,
         "slicedt": 0.059,
         "ti1": tis[0],
@@ -140,81 +255,115 @@ def _satrecov_worker(control_name, satrecov_dir, tis, rpts, ibf, spatial):
         "rpt5": rpts[4],
         "fixa": True,
     }
+    if mask is not None:
+        options["mask"] = mask
+    if init_mvn is not None:
+        options.update(WARM_START_CONVERGENCE)
     # spatial or non-spatial specific options
     spatial_dir = satrecov_dir / "spatial"
     nospatial_dir = satrecov_dir / "nospatial"
     if spatial:
-        out_dir = str(spatial_dir)
+        out_dir = spatial_dir
         extra_options = {
             "method": "spatialvb",
-            "output": out_dir,
-            "continue-from-mvn": str(nospatial_dir / "finalMVN.nii.gz"),
+            "output": str(out_dir),
+            "continue-from-mvn": str(intermediate_path(nospatial_dir, "finalMVN")),
+            "save-mean": True,
+            "save-mvn": True,
         }
+        outputs = FABBER_OUTPUTS["spatial"]
     else:
-        out_dir = str(nospatial_dir)
-        extra_options = {"method": "vb", "output": out_dir, "save-mvn": True}
+        out_dir = nospatial_dir
+        extra_options = {"method": "vb", "output": str(out_dir), "save-mvn": True}
+        if init_mvn is not None:
+            # as an array, so that it can be split with the data
+            extra_options["continue-from-mvn"] = nb.load(init_mvn).get_fdata(
+                dtype=DTYPE
+            )
+        outputs = FABBER_OUTPUTS["nospatial"]
     options.update(extra_options)
     logging.info("Running fabber's satrecov model with options:")
     for key, val in options.items():
+        if isinstance(val, np.ndarray):
+            val = f"array of shape {val.shape}"
         logging.info(f"{key}: {str(val)}")
+    if not spatial and cores > 1:
+        with span("fabber satrecov", "fabber", method="vb", cores=cores):
+            data, log = _run_fabber_chunks(options, cores)
+        with span("fabber write_to_dir", "io", path=out_dir):
+            _save_fabber_outputs(data, log, out_dir, ref_nii, outputs)
+        return
+
     # run Fabber
     fab = Fabber()
-    run = fab.run(
-        options, progress_cb=percent_progress(sys.stdout)
-    )  # Basic interaction with the run output
+    with span("fabber satrecov", "fabber", method=options["method"]):
+        run = fab.run(
+            options, progress_cb=percent_progress(sys.stdout)
+        )  # Basic interaction with the run output
     # info about fabber run
     logging.info("\nOutput data summary")
     for name, data in run.data.items():
         logging.info("%s: %s" % (name, data.shape))
     logging.info("Run finished at: %s" % run.timestamp_str)
-    # Write full contents out to a directory
-    # load control image to get header for saving
-    control_img = nb.load(control_name)
-    run.write_to_dir(out_dir, ref_nii=control_img)
+    # write the outputs used by the pipeline
+    with span("fabber write_to_dir", "io", path=out_dir):
+        _save_fabber_outputs(run.data, run.log, out_dir, ref_nii, outputs)
 
 
-def split_asl_label_control(asl_name, ntis, iaf, ibf, rpts):
+def split_asl_label_control(asl, ntis, iaf, ibf, rpts, save=False):
     """
     Split an ASL sequence into its label and control images.
 
+    Each label image is acquired next to its control image, whether
+    the sequence is grouped by TI or by repeat, so the label and
+    control images are strided views of the series rather than copies.
+
     Parameters
     ----------
-    asl_name : pathlib.Path
-        Path to the ASL series to be split.
+    asl : hcpasl.utils.ImagePath
+        The ASL series to be split.
     ntis : int
         Number of TIs in the ASL sequence.
     iaf : str
-        ("tc", "ct", "diff")
+        ("tc", "ct")
     ibf : str
         ("tis", "rpts")
     rpts : list
         List of number of repeats at each TI.
+    save : bool, optional
+        If True, also save the first and second image of each pair as
+        {asl}_odd and {asl}_even, as `asl_file --spairs` does. Default
+        is False.
 
     Returns
     -------
-    even_name : pathlib.Path
-    odd_name : pathlib.Path
+    control : numpy.ndarray
+    label : numpy.ndarray
     """
-    logging.info("Splitting data into label and control using asl_file.")
-    asl_base = asl_name.parent / asl_name.stem.split(".")[0]
-    # messy - is there a better way of filling in arguments?
-    cmd = [
-        "asl_file",
-        f"--data={str(asl_name)}",
-        f"--ntis={ntis}",
-        "--iaf=tc",
-        f"--ibf={ibf}",
-        "--spairs",
-        f"--rpts={rpts[0]},{rpts[1]},{rpts[2]},{rpts[3]},{rpts[4]}",
-        f"--out={asl_base}",
-    ]
-    sp_run(cmd)
-    even_name = asl_name.parent / f"{asl_base}_even.nii.gz"
-    odd_name = asl_name.parent / f"{asl_base}_odd.nii.gz"
-    return even_name, odd_name
-
-
-def fit_satrecov_model(asl_name, results_dir):
+    if iaf not in ("tc", "ct") or ibf not in ("tis", "rpts"):
+        raise ValueError(f"Unsupported ASL data format iaf={iaf}, ibf={ibf}.")
+    data = asl.get_fdata()
+    if len(rpts) != ntis or data.shape[-1] != 2 * sum(rpts):
+        raise ValueError(
+            f"{asl.stem} has {data.shape[-1]} volumes, which does not match "
+            f"{ntis} TIs with repeats {rpts}."
+        )
+    logging.info(f"Splitting {asl.stem} into label and control images.")
+    first, second = data[..., 0::2], data[..., 1::2]
+    if save:
+        for name, pairs in (("odd", first), ("even", second)):
+            atomic_save(
+                nb.Nifti1Image(pairs, asl.img.affine, asl.img.header),
+                asl.path.parent / f"{asl.stem}_{name}.nii.gz",
+            )
+    if iaf == "tc":
+        return second, first
+    return first, second
+
+
+def fit_satrecov_model(
+    asl_name, results_dir, fitter="fabber", cores=1, mask=None, init_mvn=None
+):
     """
     Use Fabber's `satrecov` model to estimate a T1 map.
 
@@ -230,14 +379,36 @@ def fit_satrecov_model(asl_name, results_dir):
     results_dir : pathlib.Path
         Directory in which to save the `nospatial` and `spatial`
         parameter estimates.
+    fitter : {"fabber", "numpy"}, optional
+        "numpy" fits the model in process with
+        `hcpasl.satrecov.fit_satrecov_to_dir` rather than with two
+        Fabber runs. Default is "fabber".
+    cores : int, optional
+        Number of processes across which Fabber's non-spatial fit is
+        split. Default is 1.
+    mask : pathlib.Path, optional
+        Mask of the voxels to fit. Default is to fit every voxel, or
+        with the "numpy" fitter every voxel with a positive signal.
+    init_mvn : pathlib.Path, optional
+        Fabber posterior on the voxel grid of `asl_name`, from which to
+        start the fit. See `hcpasl.fabber_outputs.warm_start_mvn`.
+        Ignored by the "numpy" fitter.
     """
+    if fitter not in FITTERS:
+        raise ValueError(f"Unknown satrecov fitter {fitter}, expected {FITTERS}.")
     # obtain control images of ASL series
-    control_name, tag_name = split_asl_label_control(asl_name, NTIS, "tc", IBF, RPTS)
+    asl = ImagePath(asl_name)
+    control, _ = split_asl_label_control(asl, NTIS, "tc", IBF, RPTS)
+    if mask is not None:
+        mask = nb.load(mask).get_fdata() > 0
+    if fitter == "numpy":
+        return fit_satrecov_to_dir(control, results_dir, asl.img, mask=mask)
+    args = (control, results_dir, TIS, RPTS, IBF)
     # satrecov nospatial
-    _satrecov_worker(control_name, results_dir, TIS, RPTS, IBF, spatial=False)
+    _satrecov_worker(*args, False, asl.img, cores, mask, init_mvn)
     # satrecov spatial
-    _satrecov_worker(control_name, results_dir, TIS, RPTS, IBF, spatial=True)
-    t1_name = results_dir / "spatial/mean_T1t.nii.gz"
+    _satrecov_worker(*args, True, asl.img, mask=mask, init_mvn=init_mvn)
+    t1_name = intermediate_path(results_dir / "spatial", "mean_T1t")
     return t1_name
 
 
@@ -246,9 +417,13 @@ def fslmaths_median_filter(image_name):
     Simple wrapper for fslmaths' median filter function. Applies
     the median filter to `image_name`. Derives and returns the
     name of the filtered image as {image_name}_filt.nii.gz.
+
+    Voxels outside the mask of a masked fit are 0, so they are first
+    filled by dilating the estimates (-dilall), which stops the filter
+    pulling zeros into the voxels at the edge of the mask.
     """
     filtered_name = image_name.parent / f'{image_name.stem.split(".")[0]}_filt.nii.gz'
-    cmd = ["fslmaths", image_name, "-fmedian", filtered_name]
+    cmd = ["fslmaths", image_name, "-dilall", "-fmedian", filtered_name]
     sp_run(cmd)
     return filtered_name
 
@@ -299,43 +474,30 @@ def apply_slicetime_correction(
         Scaling factors used to perform the slice-time
         correction.
     """
-    # timing information for scan
-    # supposed measurement time of slice
-    tis_array = np.repeat(np.array(tis), 2 * np.array(rpts)).reshape(1, 1, 1, -1)
-
-    # actual measurment time of slice
-    slice_numbers = np.tile(np.arange(0, sliceband), n_slices // sliceband).reshape(
-        1, 1, -1, 1
-    )
-    slice_times = tis_array + (slicedt * slice_numbers)
+    timing = AcquisitionTiming(tis, rpts, slicedt, sliceband, n_slices)
 
     # load images
     asl_img = nb.load(asl_name)
     t1_img = nb.load(t1_name)
+    t1_data = t1_img.get_fdata(dtype=DTYPE)
 
-    # check dimensions of t1 image to see if time series or not
+    # multiply asl sequence by satrecov model evaluated at TI and
+    # divide by it evaluated at the actual slice-time
+    stcorr_factors = np.empty(asl_img.shape, dtype=DTYPE)
     if t1_img.ndim == 3:
-        t1_data = t1_img.get_fdata()[..., np.newaxis]
+        # a single T1 estimate: evaluate once per TI, then per volume
+        per_ti = satrecov_scaling(
+            t1_data[..., np.newaxis], timing.tis, timing.volume_times(False)
+        )
+        np.take(per_ti, timing.volume_ti_index, axis=-1, out=stcorr_factors)
     elif t1_img.ndim == 4:
-        t1_data = t1_img.get_fdata()
-
-    # multiply asl sequence by satrecov model evaluated at TI
-    numexp = np.zeros(asl_img.shape)
-    np.divide(-tis_array, t1_data, out=numexp, where=(t1_data > 0))
-    num = 1 - np.exp(numexp)
-
-    # divide asl sequence by satrecov model evaluated at actual slice-time
-    denexp = np.zeros(asl_img.shape)
-    np.divide(-slice_times, t1_data, out=denexp, where=(t1_data > 0))
-    den = 1 - np.exp(denexp)
-
-    # evaluate scaling factors
-    stcorr_factors = np.ones_like(num, dtype=np.float32)
-    np.divide(num, den, out=stcorr_factors, where=(den > 0))
+        satrecov_scaling(
+            t1_data, timing.volume_tis, timing.volume_times(), out=stcorr_factors
+        )
     stcorr_factors_img = nb.nifti1.Nifti1Image(stcorr_factors, affine=asl_img.affine)
 
     # correct asl series
-    stcorr_data = asl_img.get_fdata() * stcorr_factors
+    stcorr_data = asl_img.get_fdata(dtype=DTYPE) * stcorr_factors
     stcorr_img = nb.nifti1.Nifti1Image(stcorr_data, affine=asl_img.affine)
     return stcorr_img, stcorr_factors_img
 
@@ -354,6 +516,10 @@ def initial_corrections_asl(
     interpolation=3,
     nobandingcorr=False,
     gd_corr=True,
+    satrecov_fitter="fabber",
+    satrecov_warm_start=False,
+    moco_warm_start=False,
+    journal=None,
 ):
     """
     Full ASL correction and motion estimation pipeline.
@@ -417,6 +583,24 @@ def initial_corrections_asl(
     gd_corr: bool
         Whether to perform gradient distortion correction or not.
         Default is True
+    satrecov_fitter : {"fabber", "numpy"}, optional
+        How the `satrecov` model is fitted, see `fit_satrecov_model`.
+        Default is "fabber".
+    satrecov_warm_start : bool, optional
+        If True, Fabber's second fit of the `satrecov` model starts
+        from the parameter estimates of its first fit, resampled
+        through the ASL0 susceptibility distortion correction, and
+        stops once it has converged. Default is False.
+    moco_warm_start : bool, optional
+        If True, the second motion estimation refines the first pass's
+        estimates with flirt, see `hcpasl.motion_estimation`, rather
+        than running mcflirt again from scratch. Experimental, see
+        `scripts/benchmark_moco.py`. Default is False.
+    journal : hcpasl.journal.RunJournal, optional
+        Journal in which each completed step is recorded. If it was
+        opened with `resume=True`, steps completed by a previous run
+        with unchanged outputs are skipped. Default is to run every
+        step without recording.
     """
     logging.info("Running single_step_resample_to_asl0()")
     logging.info(f"Subject directory: {subject_dir}")
@@ -431,6 +615,9 @@ def initial_corrections_asl(
     logging.info(f"Number of CPU cores to use: {cores}")
     logging.info(f"Interpolation order: {interpolation}")
     logging.info(f"Perform banding corrections: {not nobandingcorr}")
+    logging.info(f"satrecov fitter: {satrecov_fitter}")
+    logging.info(f"Warm-start second satrecov fit: {satrecov_warm_start}")
+    logging.info(f"Warm-start second motion estimation: {moco_warm_start}")
 
     assert (
         isinstance(cores, int) and cores > 0 and cores <= mp.cpu_count()
@@ -441,6 +628,32 @@ def initial_corrections_asl(
 
     # original ASL series and bias field names
     asl_name = ImagePath(label_control_dir / "label_control.nii.gz")
+    bias = nb.load(bias_name).get_fdata(dtype=DTYPE)[..., None]
+
+    # record each step so that an interrupted run can be resumed
+    if journal is None:
+        journal = RunJournal()
+    steps = journal.scope(
+        "initial_corrections_asl",
+        params={
+            "interpolation": interpolation,
+            "nobandingcorr": nobandingcorr,
+            "gd_corr": gd_corr,
+            "satrecov_fitter": satrecov_fitter,
+            "satrecov_warm_start": satrecov_warm_start,
+            "moco_warm_start": moco_warm_start,
+        },
+        inputs=[
+            asl_name.path,
+            eb_factors,
+            bias_name,
+            calib_name,
+            calib2struct,
+            gradunwarp_dir / "fullWarp_abs.nii.gz" if gd_corr else None,
+            topup_dir / "WarpField_01.nii.gz",
+            topup_dir / "fmap_struct_reg/asl2struct.mat",
+        ],
+    )
 
     # create directories for results
     logging.info("Creating results directories.")
@@ -469,7 +682,6 @@ def initial_corrections_asl(
     gdc_name = (gradunwarp_dir / "fullWarp_abs.nii.gz").resolve()
     asl_spc = rt.ImageSpace(str(asl_name))
     if gd_corr:
-        logging.info("Applying gradient distortion correction to original ASL series.")
         gdc_warp = rt.NonLinearRegistration.from_fnirt(
             coefficients=gdc_name,
             src=asl_spc,
@@ -492,73 +704,135 @@ def initial_corrections_asl(
     fmap2struct_reg = rt.Registration.from_flirt(
         src2ref=fmap2struct_reg, src=fmapmag_name, ref=t1w_name
     )
-    # apply gdc to ASL series
-    if gd_corr:
-        asl_gdc = gdc_warp.apply_to_image(
-            src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
-        )
-        asl_gdc = asl_name.correct_from_image(sdc_dir, "gdc", asl_gdc)
-    else:
-        asl_gdc = asl_name
-
-    # bias correct the ASL series
-    logging.info("Bias-correcting the ASL series.")
-    asl_gdc_bc = bcorr_dir / f"{asl_gdc.stem}_bc.nii.gz"
-    fslmaths(str(asl_gdc)).div(str(bias_name)).run(str(asl_gdc_bc))
-    asl_gdc_bc = ImagePath(asl_gdc_bc)
+    if not nobandingcorr:
+        eb_sfs = np.loadtxt(eb_factors, dtype=DTYPE)
+        eb_arr = np.tile(eb_sfs, (ASL_SHAPE[0], ASL_SHAPE[1], 1))
+        eb_name = eb_dir / "eb_scaling_factors.nii.gz"
+
+    # apply gdc, bias and empirical banding corrections to ASL series
+    asl_gdc_name = asl_name.corrected_path(sdc_dir, "gdc") if gd_corr else None
+    asl_gdc_stem = f"{asl_name.stem}_gdc" if gd_corr else asl_name.stem
+    asl_gdc_bc_name = intermediate_path(bcorr_dir, f"{asl_gdc_stem}_bc")
+    if steps.pending(
+        "initial_corrections",
+        [asl_gdc_name, asl_gdc_bc_name, *([] if nobandingcorr else [eb_name])],
+    ):
+        # apply gdc to ASL series
+        if gd_corr:
+            logging.info(
+                "Applying gradient distortion correction to original ASL series."
+            )
+            asl_gdc = gdc_warp.apply_to_image(
+                src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
+            )
+            asl_gdc = asl_name.correct_from_image(sdc_dir, "gdc", asl_gdc)
+        else:
+            asl_gdc = asl_name
+
+        # bias correct the ASL series
+        logging.info("Bias-correcting the ASL series.")
+        tmp_name = asl_gdc_bc_name.with_name(f".{asl_gdc_bc_name.name}")
+        with span("fslmaths", "subprocess", op="div"):
+            fslmaths(str(asl_gdc.path)).div(str(bias_name)).run(
+                str(tmp_name)
+            )
+        tmp_name.replace(asl_gdc_bc_name)
+
+        # save empirical banding scaling factors
+        if not nobandingcorr:
+            atomic_save(asl_spc.make_nifti(eb_arr), eb_name)
+        steps.complete("initial_corrections")
+    asl_gdc_bc = ImagePath(asl_gdc_bc_name)
 
     # apply empirical banding scaling factors to the bias-corrected ASL series
     if not nobandingcorr:
-        logging.info("Applying empirical banding correction to the ASL series.")
-        eb_sfs = np.loadtxt(eb_factors)
-        eb_arr = np.tile(eb_sfs, (ASL_SHAPE[0], ASL_SHAPE[1], 1))
-        eb_img = asl_spc.make_nifti(eb_arr)
-        eb_img.to_filename(eb_dir / "eb_scaling_factors.nii.gz")
-        eb_img = ImagePath(eb_dir / "eb_scaling_factors.nii.gz")
+        eb_img = ImagePath(eb_name)
         assert len(eb_sfs) == asl_gdc_bc.img.shape[2]
-        asl_gdc_bc_eb = asl_gdc_bc.correct_from_data(
-            eb_dir, "eb", asl_gdc_bc.img.get_fdata() * eb_arr[..., None]
-        )
+        asl_gdc_bc_eb_name = asl_gdc_bc.corrected_path(eb_dir, "eb")
+        if steps.pending("empirical_banding", [asl_gdc_bc_eb_name]):
+            logging.info("Applying empirical banding correction to the ASL series.")
+            asl_gdc_bc.correct_from_data(
+                eb_dir, "eb", asl_gdc_bc.get_fdata() * eb_arr[..., None]
+            )
+            asl_gdc_bc.release()
+            steps.complete("empirical_banding")
+        asl_gdc_bc_eb = ImagePath(asl_gdc_bc_eb_name)
     else:
         asl_gdc_bc_eb = asl_gdc_bc
 
+    # brain mask for the first satrecov fit, dilated since the series
+    # has not yet been motion-corrected
+    fs_brainmask = (t1w_dir / "brainmask_fs.nii.gz").resolve(strict=True)
+    calib2struct_reg = rt.Registration.from_flirt(
+        src2ref=calib2struct, src=calib_name, ref=fs_brainmask
+    )
+    satrecov_mask_name = label_control_dir / "brain_mask_satrecov.nii.gz"
+    if steps.pending("satrecov_mask", [satrecov_mask_name]):
+        logging.info("Creating brain mask for the first satrecov model fit.")
+        calib_brainmask = calib2struct_reg.inverse().apply_to_image(
+            src=fs_brainmask, ref=asl_spc, order=1
+        )
+        satrecov_mask = binary_dilation(
+            calib_brainmask.get_fdata(), iterations=SATRECOV_MASK_DILATION
+        )
+        atomic_save(asl_spc.make_nifti(satrecov_mask), satrecov_mask_name)
+        steps.complete("satrecov_mask")
+
     # estimate satrecov model on gradient distortion-, bias- and MT- corrected ASL series
-    logging.info("First satrecov model fit.")
-    t1_name = fit_satrecov_model(asl_gdc_bc_eb.path, satrecov_dir)
-    t1_filt_name = fslmaths_median_filter(t1_name)
+    t1_filt_name = satrecov_dir / "spatial/mean_T1t_filt.nii.gz"
+    first_satrecov_time = None
+    if steps.pending("first_satrecov", [satrecov_dir]):
+        logging.info("First satrecov model fit.")
+        start = time.perf_counter()
+        t1_name = fit_satrecov_model(
+            asl_gdc_bc_eb.path,
+            satrecov_dir,
+            satrecov_fitter,
+            cores,
+            satrecov_mask_name,
+        )
+        first_satrecov_time = time.perf_counter() - start
+        logging.info(f"First satrecov fit took {first_satrecov_time:.1f} s.")
+        if satrecov_fitter == "fabber":
+            log_fabber_iterations(satrecov_dir)
+        fslmaths_median_filter(t1_name)
+        steps.complete("first_satrecov")
 
     # perform slice-time correction using estimated tissue params
     if not nobandingcorr:
-        logging.info("Performing initial slice-time correction.")
-        stcorr_img, stfactors_img = apply_slicetime_correction(
-            asl_gdc_bc_eb.path, t1_filt_name, TIS, RPTS, SLICEDT, SLICEBAND, NSLICES
-        )
-        asl_gdc_bc_eb_st = asl_gdc_bc_eb.correct_from_image(
-            stcorr_dir, "st", stcorr_img
-        )
-        stfactors_img.to_filename(stcorr_dir / "st_scaling_factors.nii.gz")
-
+        asl_gdc_bc_eb_st_name = asl_gdc_bc_eb.corrected_path(stcorr_dir, "st")
+        stfactors_name = stcorr_dir / "st_scaling_factors.nii.gz"
+        if steps.pending(
+            "first_slicetime_correction", [asl_gdc_bc_eb_st_name, stfactors_name]
+        ):
+            logging.info("Performing initial slice-time correction.")
+            stcorr_img, stfactors_img = apply_slicetime_correction(
+                asl_gdc_bc_eb.path,
+                t1_filt_name,
+                TIS,
+                RPTS,
+                SLICEDT,
+                SLICEBAND,
+                NSLICES,
+            )
+            asl_gdc_bc_eb.correct_from_image(stcorr_dir, "st", stcorr_img)
+            atomic_save(stfactors_img, stfactors_name)
+            steps.complete("first_slicetime_correction")
+        asl_gdc_bc_eb_st = ImagePath(asl_gdc_bc_eb_st_name)
     else:
         asl_gdc_bc_eb_st = asl_gdc_bc_eb
 
     # register ASL series to calibration image
-    logging.info("Running mcflirt on calibration image and ASL series.")
     mc_img = moco_dir / "first/label_control_mc.nii.gz"
-    mcflirt(
-        str(asl_gdc_bc_eb_st.path),
-        reffile=str(calib_name),
-        mats=True,
-        plots=True,
-        out=str(mc_img),
-        stages=4,
-    )
-    # rename mcflirt matrices directory and load transform
-    orig_mcflirt = mc_img.with_suffix(mc_img.suffix + ".mat")
-    if asln2calibration_name.exists():
-        shutil.rmtree(asln2calibration_name)
-    orig_mcflirt.rename(asln2calibration_name)
-
-    # Generate motion-FoV mask in ASL0 space
+    if steps.pending("first_motion_estimation", [asln2calibration_name]):
+        logging.info("Running mcflirt on calibration image and ASL series.")
+        with span("mcflirt", "subprocess", out=mc_img):
+            run_mcflirt(
+                asl_gdc_bc_eb_st, calib_name, mc_img, asln2calibration_name, cores
+            )
+        steps.complete("first_motion_estimation")
+
+    # load motion estimates
     asl_spc = rt.ImageSpace(asl_gdc_bc_eb.path)
     calib_spc = rt.ImageSpace(calib_name)
     asln2calibration_moco = rt.MotionCorrection.from_mcflirt(
@@ -568,40 +842,42 @@ def initial_corrections_asl(
     )
     asl02m0 = asln2calibration_moco.transforms[0]
     asln2asl0 = rt.chain(asln2calibration_moco, asl02m0.inverse())
-    fov_mask_asl = make_motion_fov_mask(asln2asl0, asl_spc, asl_spc, cores=cores)
-    fov_mask_asl_path = moco_dir / "fov_mask_initial.nii.gz"
-    nb.save(fov_mask_asl, fov_mask_asl_path)
 
-    # get brain mask in ASL0 space
-    # dilate so not too strict
-    logging.info("Create brain mask in ASL0 space")
-    fs_brainmask = (t1w_dir / "brainmask_fs.nii.gz").resolve(strict=True)
-    calib2struct_reg = rt.Registration.from_flirt(
-        src2ref=calib2struct, src=calib_name, ref=fs_brainmask
-    )
-    struct2asl0_reg = rt.chain(
-        calib2struct_reg.inverse(), asln2calibration_moco.transforms[0].inverse()
-    )
-    aslfs_mask = struct2asl0_reg.apply_to_image(src=fs_brainmask, ref=asl_spc, order=1)
+    # Generate motion-FoV mask in ASL0 space and brain mask in ASL0 space
+    fov_mask_asl_path = moco_dir / "fov_mask_initial.nii.gz"
     asl_fs_brainmask = label_control_dir / "brain_mask.nii.gz"
-    nb.save(aslfs_mask, asl_fs_brainmask)
-    aslfs_mask = binary_dilation(aslfs_mask.get_fdata(), iterations=1).astype(
-        np.float32
-    )
+    asl_mask_name = label_control_dir / "brain_fov_mask_initial.nii.gz"
+    if steps.pending(
+        "initial_masks", [fov_mask_asl_path, asl_fs_brainmask, asl_mask_name]
+    ):
+        fov_mask_asl = make_motion_fov_mask(asln2asl0, asl_spc, asl_spc, cores=cores)
+        atomic_save(fov_mask_asl, fov_mask_asl_path)
+
+        # get brain mask in ASL0 space
+        logging.info("Create brain mask in ASL0 space")
+        struct2asl0_reg = rt.chain(
+            calib2struct_reg.inverse(), asln2calibration_moco.transforms[0].inverse()
+        )
+        aslfs_mask = struct2asl0_reg.apply_to_image(
+            src=fs_brainmask, ref=asl_spc, order=1
+        )
+        atomic_save(aslfs_mask, asl_fs_brainmask)
+
+        # Combine the dilated FS and FoV masks
+        aslfs_mask = binary_dilation(aslfs_mask.get_fdata(), iterations=1)
+        asl_mask = (aslfs_mask > 0) & (fov_mask_asl.get_fdata() > 0)
+        atomic_save(asl_spc.make_nifti(asl_mask), asl_mask_name)
+        steps.complete("initial_masks")
 
-    # Combine the FS and FoV masks
+    # dilate so not too strict
+    aslfs_mask = binary_dilation(
+        nb.load(asl_fs_brainmask).get_fdata(dtype=DTYPE), iterations=1
+    ).astype(DTYPE)
     # make 4d for application to ASL time series
-    asl_mask = (aslfs_mask > 0) & (fov_mask_asl.get_fdata() > 0)
-    asl_mask = asl_spc.make_nifti(asl_mask)
-    asl_mask_name = label_control_dir / "brain_fov_mask_initial.nii.gz"
-    nb.save(asl_mask, asl_mask_name)
-    mask4d = asl_mask.get_fdata()[..., None]
+    mask4d = nb.load(asl_mask_name).get_fdata(dtype=DTYPE)[..., None]
 
     # Start afresh with the raw ASL series, and apply the motion correction
     # and susceptibility distortion correction to get ASLn aligned with ASL0
-    logging.info(
-        "Apply susceptibility distortion and motion correction to original ASL series."
-    )
     asl02fmap = rt.chain(asl02m0, calib2struct_reg, fmap2struct_reg.inverse())
     sdc_asln2asl0 = rt.chain(asln2asl0, asl02fmap, sdc_warp, asl02fmap.inverse())
     if gd_corr:
@@ -609,180 +885,273 @@ def initial_corrections_asl(
     else:
         dc_asln2asl0 = sdc_asln2asl0
 
-    asl_mc_sdc = asl_name.correct_from_image(
-        sdc_dir,
-        "sdc",
-        dc_asln2asl0.apply_to_image(
-            asl_name.path, calib_name, cores=cores, order=interpolation
-        ),
-    )
+    asl_mc_sdc_name = asl_name.corrected_path(sdc_dir, "mc_sdc")
+    if steps.pending("first_distortion_motion_correction", [asl_mc_sdc_name]):
+        logging.info(
+            "Apply susceptibility distortion and motion correction to original ASL series."
+        )
+        asl_name.correct_from_image(
+            sdc_dir,
+            "mc_sdc",
+            dc_asln2asl0.apply_to_image(
+                asl_name.path, calib_name, cores=cores, order=interpolation
+            ),
+        )
+        steps.complete("first_distortion_motion_correction")
+    asl_mc_sdc = ImagePath(asl_mc_sdc_name)
 
-    # apply moco to empirical banding scaling factors image
+    # apply moco to empirical banding scaling factors image and bias-
+    # and banding-correct the motion- and distortion-corrected ASL series
+    asl_mc_sdc_bc_name = asl_mc_sdc.corrected_path(moco_dir, "bc")
     if not nobandingcorr:
+        eb_mc_name = eb_img.corrected_path(moco_dir, "mc")
+        asl_mc_sdc_bc_eb_name = intermediate_path(moco_dir, f"{asl_mc_sdc.stem}_bc_eb")
+        outputs = [eb_mc_name, asl_mc_sdc_bc_name, asl_mc_sdc_bc_eb_name]
+    else:
+        outputs = [asl_mc_sdc_bc_name]
+    if steps.pending("first_bias_banding_correction", outputs):
+        if not nobandingcorr:
+            logging.info(
+                "Apply motion estimates to the empirical banding scaling factors image"
+            )
+            eb_mc = asln2asl0.apply_to_array(
+                eb_arr, src=eb_img.img, ref=eb_img.img, cores=cores, order=interpolation
+            )
+            eb_mc = np.where(mask4d != 0.0, eb_mc, 1.0).astype(DTYPE)
+            eb_mc = eb_img.correct_from_data(moco_dir, "mc", eb_mc)
+
+        # apply bias-correction to motion- and distortion-corrected ASL series
         logging.info(
-            "Apply motion estimates to the empirical banding scaling factors image"
+            "Apply bias correction to the susceptibility distortion and motion corrected ASL series."
         )
-        eb_mc = asln2asl0.apply_to_array(
-            eb_arr, src=eb_img.img, ref=eb_img.img, cores=cores, order=interpolation
+        asl_mc_sdc_bc = asl_mc_sdc.correct_from_data(
+            moco_dir, "bc", asl_mc_sdc.get_fdata() / bias
         )
-        eb_mc = np.where(mask4d != 0.0, eb_mc, 1.0).astype(np.float32)
-        eb_mc = eb_img.correct_from_data(moco_dir, "mc", eb_mc)
 
-    # apply bias-correction to motion- and distortion-corrected ASL series
-    logging.info(
-        "Apply bias correction to the susceptibility distortion and motion corrected ASL series."
-    )
-    bias_img = nb.load(bias_name)
-    asl_mc_sdc_bc = asl_mc_sdc.correct_from_data(
-        moco_dir, "bc", asl_mc_sdc.get_fdata() / bias_img.get_fdata()[..., None]
-    )
-
-    # apply empirical banding correction
+        # apply empirical banding correction
+        if not nobandingcorr:
+            asl_mc_sdc_bc.correct_from_data(
+                moco_dir, "eb", asl_mc_sdc_bc.get_fdata() * eb_mc.get_fdata()
+            )
+            eb_mc.release()
+        asl_mc_sdc.release()
+        asl_mc_sdc_bc.release()
+        steps.complete("first_bias_banding_correction")
     if not nobandingcorr:
-        asl_mc_sdc_bc_eb = asl_mc_sdc_bc.correct_from_data(
-            moco_dir, "eb", asl_mc_sdc_bc.get_fdata() * eb_mc.get_fdata()
-        )
+        asl_mc_sdc_bc_eb = ImagePath(asl_mc_sdc_bc_eb_name)
     else:
-        asl_mc_sdc_bc_eb = asl_mc_sdc_bc
+        asl_mc_sdc_bc_eb = ImagePath(asl_mc_sdc_bc_name)
 
     # re-estimate satrecov model on distortion- and motion-corrected data
-    logging.info("Re-fitting the satrecov model since data has been motion-corrected.")
+    first_mvn_name = intermediate_path(satrecov_dir / "spatial", "finalMVN")
     satrecov_dir = label_control_dir / "saturation_recovery/second"
     stcorr_dir = label_control_dir / "slicetime_correction/second"
     for d in [satrecov_dir, stcorr_dir]:
         d.mkdir(parents=True, exist_ok=True)
-    t1_name = fit_satrecov_model(asl_mc_sdc_bc_eb.path, satrecov_dir)
-    t1_filt_name = fslmaths_median_filter(t1_name)
+    t1_filt_name = satrecov_dir / "spatial/mean_T1t_filt.nii.gz"
+    if steps.pending("second_satrecov", [satrecov_dir]):
+        logging.info(
+            "Re-fitting the satrecov model since data has been motion-corrected."
+        )
+        init_mvn = None
+        if satrecov_warm_start and satrecov_fitter == "fabber":
+            if first_mvn_name.exists():
+                # the first fit was on the series without motion or
+                # susceptibility distortion correction, so its estimates
+                # are moved through ASL0's distortion correction. They
+                # are already gradient distortion corrected. Without
+                # intensity correction, since they are not intensities
+                logging.info(f"Starting the fit from {first_mvn_name}.")
+                sdc_warp_params = rt.NonLinearRegistration.from_fnirt(
+                    coefficients=dc_name,
+                    src=fmapmag_name,
+                    ref=fmapmag_name,
+                    intensity_correct=False,
+                )
+                sdc_asl0 = rt.chain(asl02fmap, sdc_warp_params, asl02fmap.inverse())
+                init_mvn = intermediate_path(satrecov_dir, "initial_MVN")
+                warm_start_mvn(
+                    first_mvn_name, asl_mask_name, init_mvn, sdc_asl0, cores
+                )
+            else:
+                logging.info(f"{first_mvn_name} not found, fitting from scratch.")
+        start = time.perf_counter()
+        t1_name = fit_satrecov_model(
+            asl_mc_sdc_bc_eb.path,
+            satrecov_dir,
+            satrecov_fitter,
+            cores,
+            asl_mask_name,
+            init_mvn,
+        )
+        second_satrecov_time = time.perf_counter() - start
+        logging.info(f"Second satrecov fit took {second_satrecov_time:.1f} s.")
+        if satrecov_fitter == "fabber":
+            log_fabber_iterations(satrecov_dir)
+        if first_satrecov_time is not None:
+            logging.info(
+                "Time saved relative to the first fit: "
+                f"{first_satrecov_time - second_satrecov_time:.1f} s."
+            )
+        fslmaths_median_filter(t1_name)
+        steps.complete("second_satrecov")
 
     # register T1t estimates back to the original space of the ASL volumes
     # using current motion estimates for improved motion estimation
-    logging.info(
-        "Registering the final T1t estimates back to the original space of each ASL volume."
-    )
-    t1_filt_asln = asln2asl0.inverse().apply_to_image(
-        src=t1_filt_name, ref=asl_spc, order=interpolation, cores=cores
-    )
-    t1_filt_asln = nb.nifti1.Nifti1Image(
-        t1_filt_asln.get_fdata().astype(np.float32), affine=t1_filt_asln.affine
-    )
     t1_filt_asln_name = t1_filt_name.parent / "mean_T1t_filt_asln.nii.gz"
-    nb.save(t1_filt_asln, t1_filt_asln_name)
-
-    # apply sdc to the ASL series so it is fully distortion corrected in its original space
-    logging.info(
-        "Applying susceptibility distortion correction the original ASL series"
-    )
-    sdc_asln2asln = rt.chain(sdc_asln2asl0, asln2asl0.inverse())
-    asl_sdc = asl_name.correct_from_image(
-        sdc_dir,
-        "sdc",
-        sdc_asln2asln.apply_to_image(
-            src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
-        ),
-    )
-
-    # apply bias correction to the distortion corrected ASL series
-    logging.info(
-        "Applying bias correction to the susceptibility distortion corrected ASL series."
-    )
-    asl_sdc_bc = asl_sdc.correct_from_data(
-        bcorr_dir, "bc", (asl_sdc.get_fdata() / bias_img.get_fdata()[..., None])
-    )
-
-    # Reapply banding corrections to ASL series
-    if not nobandingcorr:
+    if steps.pending("t1_to_asln", [t1_filt_asln_name]):
         logging.info(
-            "Applying empirical banding correction to the distortion corrected ASL series."
+            "Registering the final T1t estimates back to the original space of each ASL volume."
         )
-        asl_sdc_bc_eb = asl_sdc_bc.correct_from_data(
-            eb_dir, "eb", (asl_sdc_bc.get_fdata() * eb_img.get_fdata()[..., None])
+        t1_filt_asln = asln2asl0.inverse().apply_to_image(
+            src=t1_filt_name, ref=asl_spc, order=interpolation, cores=cores
         )
-
-        # apply refined slice-time correction to distortion corrected ASL series
-        logging.info(
-            "Apply refined slicetiming correction to the distortion corrected ASL series."
+        t1_filt_asln = nb.nifti1.Nifti1Image(
+            t1_filt_asln.get_fdata(dtype=DTYPE), affine=t1_filt_asln.affine
         )
-        stcorr_img, stfactors_img = apply_slicetime_correction(
-            asl_sdc_bc_eb.path,
-            t1_filt_asln_name,
-            TIS,
-            RPTS,
-            SLICEDT,
-            SLICEBAND,
-            NSLICES,
-        )
-        asl_sdc_bc_eb_st = asl_sdc_bc_eb.correct_from_image(
-            stcorr_dir, "st", stcorr_img
+        atomic_save(t1_filt_asln, t1_filt_asln_name)
+        steps.complete("t1_to_asln")
+
+    # apply sdc to the ASL series so it is fully distortion corrected in
+    # its original space, then bias and banding correct it
+    asl_sdc_name = asl_name.corrected_path(sdc_dir, "sdc")
+    asl_sdc_bc_name = intermediate_path(bcorr_dir, f"{asl_name.stem}_sdc_bc")
+    if not nobandingcorr:
+        asl_sdc_bc_eb_name = intermediate_path(eb_dir, f"{asl_name.stem}_sdc_bc_eb")
+        asl_sdc_bc_eb_st_name = intermediate_path(
+            stcorr_dir, f"{asl_name.stem}_sdc_bc_eb_st"
         )
         stfactors_name = stcorr_dir / "st_scaling_factors.nii.gz"
-        stfactors_img.to_filename(stfactors_name)
-
-        # combined empirical banding and slice-time scaling factors
+        combined_factors_name = stcorr_dir / "combined_scaling_factors_asln.nii.gz"
+        outputs = [
+            asl_sdc_name,
+            asl_sdc_bc_name,
+            asl_sdc_bc_eb_name,
+            asl_sdc_bc_eb_st_name,
+            stfactors_name,
+            combined_factors_name,
+        ]
+    else:
+        combined_factors_name = moco_dir / "combined_scaling_factors_asln.nii.gz"
+        outputs = [asl_sdc_name, asl_sdc_bc_name, combined_factors_name]
+    if steps.pending("second_corrections", outputs):
         logging.info(
-            "Combining the slice-time and empirical banding scaling factors into one set of scaling factors."
+            "Applying susceptibility distortion correction the original ASL series"
         )
-        combined_factors_name = stcorr_dir / "combined_scaling_factors_asln.nii.gz"
-        combined_factors_img = nb.nifti1.Nifti1Image(
-            (stfactors_img.get_fdata() * eb_img.get_fdata()[..., None]).astype(
-                np.float32
+        sdc_asln2asln = rt.chain(sdc_asln2asl0, asln2asl0.inverse())
+        asl_sdc = asl_name.correct_from_image(
+            sdc_dir,
+            "sdc",
+            sdc_asln2asln.apply_to_image(
+                src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
             ),
-            affine=stfactors_img.affine,
         )
-        nb.save(combined_factors_img, combined_factors_name)
 
-    else:
+        # apply bias correction to the distortion corrected ASL series
         logging.info(
-            "No banding correction performed; combined scaling factors will be ones."
+            "Applying bias correction to the susceptibility distortion corrected ASL series."
         )
-        combined_factors_img = nb.nifti1.Nifti1Image(
-            np.ones_like(asl_sdc_bc.get_fdata(), dtype=np.float32),
-            affine=asl_sdc_bc.img.affine,
+        asl_sdc_bc = asl_sdc.correct_from_data(
+            bcorr_dir, "bc", asl_sdc.get_fdata() / bias
         )
-        combined_factors_name = moco_dir / "combined_scaling_factors_asln.nii.gz"
-        nb.save(combined_factors_img, combined_factors_name)
-        asl_sdc_bc_eb_st = asl_sdc_bc
+
+        # Reapply banding corrections to ASL series
+        if not nobandingcorr:
+            logging.info(
+                "Applying empirical banding correction to the distortion corrected ASL series."
+            )
+            asl_sdc_bc_eb = asl_sdc_bc.correct_from_data(
+                eb_dir, "eb", (asl_sdc_bc.get_fdata() * eb_img.get_fdata()[..., None])
+            )
+
+            # apply refined slice-time correction to distortion corrected ASL series
+            logging.info(
+                "Apply refined slicetiming correction to the distortion corrected ASL series."
+            )
+            stcorr_img, stfactors_img = apply_slicetime_correction(
+                asl_sdc_bc_eb.path,
+                t1_filt_asln_name,
+                TIS,
+                RPTS,
+                SLICEDT,
+                SLICEBAND,
+                NSLICES,
+            )
+            asl_sdc_bc_eb.correct_from_image(stcorr_dir, "st", stcorr_img)
+            atomic_save(stfactors_img, stfactors_name)
+
+            # combined empirical banding and slice-time scaling factors
+            logging.info(
+                "Combining the slice-time and empirical banding scaling factors into one set of scaling factors."
+            )
+            combined_factors_img = nb.nifti1.Nifti1Image(
+                stfactors_img.get_fdata(dtype=DTYPE) * eb_img.get_fdata()[..., None],
+                affine=stfactors_img.affine,
+            )
+            atomic_save(combined_factors_img, combined_factors_name)
+            eb_img.release()
+
+        else:
+            logging.info(
+                "No banding correction performed; combined scaling factors will be ones."
+            )
+            combined_factors_img = nb.nifti1.Nifti1Image(
+                np.ones(asl_sdc_bc.img.shape, dtype=DTYPE),
+                affine=asl_sdc_bc.img.affine,
+            )
+            atomic_save(combined_factors_img, combined_factors_name)
+        asl_sdc.release()
+        asl_sdc_bc.release()
+        steps.complete("second_corrections")
+    if not nobandingcorr:
+        asl_sdc_bc_eb_st = ImagePath(asl_sdc_bc_eb_st_name)
+    else:
+        asl_sdc_bc_eb_st = ImagePath(asl_sdc_bc_name)
 
     # re-estimate motion correction for distortion and banding corrected ASL series
-    logging.info("Re-running mcflirt on calibration image and corrected ASL series.")
     mc_out = moco_dir / "second/label_control_mc.nii.gz"
     asln2calibration_final_name = moco_dir / "asln2calibration_final.mat"
-    mcflirt(
-        str(asl_sdc_bc_eb_st.path),
-        reffile=str(calib_name),
-        mats=True,
-        plots=True,
-        out=str(mc_out),
-        stages=4,
-    )
-    # rename mcflirt matrices directory
-    final_mcflirt = mc_out.with_suffix(mc_out.suffix + ".mat")
-    if asln2calibration_final_name.exists():
-        shutil.rmtree(asln2calibration_final_name)
-    final_mcflirt.rename(asln2calibration_final_name)
+    if steps.pending("second_motion_estimation", [asln2calibration_final_name]):
+        logging.info(
+            "Re-running mcflirt on calibration image and corrected ASL series."
+        )
+        if moco_warm_start:
+            # start from the first pass's estimates rather than identity;
+            # only the registrations are produced, not the registered series
+            logging.info(f"Refining the motion estimates in {asln2calibration_name}.")
+            with span("flirt", "subprocess", out=asln2calibration_final_name):
+                refine_mcflirt(
+                    asl_sdc_bc_eb_st,
+                    calib_name,
+                    asln2calibration_name,
+                    asln2calibration_final_name,
+                    cores,
+                )
+        else:
+            with span("mcflirt", "subprocess", out=mc_out):
+                run_mcflirt(
+                    asl_sdc_bc_eb_st,
+                    calib_name,
+                    mc_out,
+                    asln2calibration_final_name,
+                    cores,
+                )
+        steps.complete("second_motion_estimation")
 
     # Update the motion FoV mask
     asl_spc = rt.ImageSpace(asl_sdc_bc_eb_st.path)
-    calib_spc = rt.ImageSpace(calib_name)
-    asln2calibration_final = rt.MotionCorrection.from_mcflirt(
-        asln2calibration_final_name, src=asl_spc, ref=calib_spc
-    )
-    asl02calibration_final = asln2calibration_moco.transforms[0]
-    asln2asl0_final = rt.chain(asln2calibration_moco, asl02m0.inverse())
-    fov_mask_asl = make_motion_fov_mask(asln2asl0, asl_spc, asl_spc, cores=cores)
     fov_mask_asl_path = moco_dir / "fov_mask.nii.gz"
-    nb.save(fov_mask_asl, fov_mask_asl_path)
-
-    # Combine again with the FS brain mask
-    asl_mask = (aslfs_mask > 0) & (fov_mask_asl.get_fdata() > 0)
-    asl_mask = asl_spc.make_nifti(asl_mask)
     asl_mask_name = label_control_dir / "brain_fov_mask.nii.gz"
-    nb.save(asl_mask, asl_mask_name)
-    mask4d = asl_mask.get_fdata()[..., None]
+    if steps.pending("final_masks", [fov_mask_asl_path, asl_mask_name]):
+        fov_mask_asl = make_motion_fov_mask(asln2asl0, asl_spc, asl_spc, cores=cores)
+        atomic_save(fov_mask_asl, fov_mask_asl_path)
+
+        # Combine again with the FS brain mask
+        asl_mask = (aslfs_mask > 0) & (fov_mask_asl.get_fdata() > 0)
+        atomic_save(asl_spc.make_nifti(asl_mask), asl_mask_name)
+        steps.complete("final_masks")
 
     # apply gdc, refined moco and sdc to the original ASL series
-    logging.info(
-        "Applying distortion correction and improved motion estimates to the original ASL series."
-    )
     asln2calibration_final = rt.MotionCorrection.from_mcflirt(
         mats=asln2calibration_final_name, src=asl_spc, ref=calib_name
     )
@@ -797,48 +1166,56 @@ def initial_corrections_asl(
     if gd_corr:
         dc_asln2asl0_final = rt.chain(gdc_warp, dc_asln2asl0_final)
 
-    asl_gdc_mc_sdc = asl_name.correct_from_image(
-        label_control_dir,
-        "gdc_mc_sdc",
-        dc_asln2asl0_final.apply_to_image(
-            src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
-        ),
-    )
+    asl_gdc_mc_sdc_name = asl_name.corrected_path(label_control_dir, "gdc_mc_sdc")
+    if steps.pending("final_distortion_motion_correction", [asl_gdc_mc_sdc_name]):
+        logging.info(
+            "Applying distortion correction and improved motion estimates to the original ASL series."
+        )
+        asl_name.correct_from_image(
+            label_control_dir,
+            "gdc_mc_sdc",
+            dc_asln2asl0_final.apply_to_image(
+                src=asl_name.path, ref=asl_spc, order=interpolation, cores=cores
+            ),
+        )
+        steps.complete("final_distortion_motion_correction")
+    asl_gdc_mc_sdc = ImagePath(asl_gdc_mc_sdc_name)
 
     # apply bias correction to the fully distortion and motion corrected ASL series
-    logging.info(
-        "Applying bias correction to the distortion and motion corrected ASL series."
-    )
-    asl_gdc_mc_sdc_bc = asl_gdc_mc_sdc.correct_from_data(
-        label_control_dir,
-        "bc",
-        asl_gdc_mc_sdc.get_fdata() / bias_img.get_fdata()[..., None],
-    )
-
-    # apply final motion estimates to scaling factors
-    logging.info("Applying motion estimates to the scaling factors.")
-    combined_factors_moco = asln2asl0_final.apply_to_image(
-        src=combined_factors_name,
-        ref=asl_spc,
-        order=interpolation,
-        cores=cores,
-    )
-    combined_factors_moco.to_filename(
-        label_control_dir / "combined_scaling_factors_mc.nii.gz"
-    )
-
-    # apply banding corrections to the motion corrected ASL series
-    if not nobandingcorr:
-        logging.info("Banding correcting the registered ASL series.")
-        asl_gdc_mc_sdc_bc_st_eb = asl_gdc_mc_sdc_bc.correct_from_data(  # noqa
-            label_control_dir,
-            "eb_st",
-            asl_gdc_mc_sdc_bc.get_fdata() * combined_factors_moco.get_fdata(),
+    corrected_name = label_control_dir / "label_control_corrected.nii.gz"
+    combined_factors_mc_name = label_control_dir / "combined_scaling_factors_mc.nii.gz"
+    if steps.pending("final_corrections", [combined_factors_mc_name, corrected_name]):
+        logging.info(
+            "Applying bias correction to the distortion and motion corrected ASL series."
         )
-        asl_gdc_mc_sdc_bc_st_eb.img.to_filename(
-            label_control_dir / "label_control_corrected.nii.gz"
+        asl_gdc_mc_sdc_bc = asl_gdc_mc_sdc.correct_from_data(
+            label_control_dir,
+            "bc",
+            asl_gdc_mc_sdc.get_fdata() / bias,
         )
-    else:
-        asl_gdc_mc_sdc_bc.img.to_filename(
-            label_control_dir / "label_control_corrected.nii.gz"
+
+        # apply final motion estimates to scaling factors
+        logging.info("Applying motion estimates to the scaling factors.")
+        combined_factors_moco = asln2asl0_final.apply_to_image(
+            src=combined_factors_name,
+            ref=asl_spc,
+            order=interpolation,
+            cores=cores,
         )
+        atomic_save(combined_factors_moco, combined_factors_mc_name)
+
+        # apply banding corrections to the motion corrected ASL series
+        if not nobandingcorr:
+            logging.info("Banding correcting the registered ASL series.")
+            asl_gdc_mc_sdc_bc_st_eb = asl_gdc_mc_sdc_bc.correct_from_data(  # noqa
+                label_control_dir,
+                "eb_st",
+                asl_gdc_mc_sdc_bc.get_fdata()
+                * combined_factors_moco.get_fdata(dtype=DTYPE),
+            )
+            atomic_save(asl_gdc_mc_sdc_bc_st_eb.img, corrected_name)
+        else:
+            atomic_save(asl_gdc_mc_sdc_bc.img, corrected_name)
+        asl_gdc_mc_sdc.release()
+        asl_gdc_mc_sdc_bc.release()
+        steps.complete("final_corrections")
@@ -13,8 +13,14 @@ Chappell, M.J.P. van Osch
 import nibabel as nb
 import numpy as np
 
+from hcpasl import pgzip
+from hcpasl.timing import MBPCASL
+from hcpasl.utils import DTYPE
 
-def tag_control_differencing(series, scaling_factors, outdir, mask=None):
+
+def tag_control_differencing(
+    series, scaling_factors, outdir, mask=None, timing=MBPCASL
+):
     """
     Perform tag-control differencing of a scaled ASL sequence.
 
@@ -30,6 +36,9 @@ def tag_control_differencing(series, scaling_factors, outdir, mask=None):
         Path to the directory in which to save the results.
     mask : pathlib.Path:
         operate only within mask
+    timing : hcpasl.timing.AcquisitionTiming, optional
+        Timing of the acquisition, which gives the order of the label
+        and control images. Default is the HCP mbPCASL acquisition.
 
     .. [1] Suzuki, Yuriko, et al. "A framework for motion
        correction of background suppressed arterial spin labeling
@@ -47,15 +56,15 @@ def tag_control_differencing(series, scaling_factors, outdir, mask=None):
     S_st = nb.load(scaling_factors)
 
     # calculate X_perf = X_tc * S_st
-    X_tc = np.ones((1, 1, 1, 86)) * 0.5
-    X_tc[0, 0, 0, 0::2] = -0.5
-    X_perf = X_tc * S_st.get_fdata()
+    X_tc = timing.label_control_weights.reshape(1, 1, 1, -1)
+    X_perf = X_tc * S_st.get_fdata(dtype=DTYPE)
 
     # split X_perf and Y_moco into even and odd indices
     X_odd = X_perf[:, :, :, 1::2]
     X_even = X_perf[:, :, :, 0::2]
-    Y_odd = Y_moco.get_fdata()[:, :, :, 1::2]
-    Y_even = Y_moco.get_fdata()[:, :, :, 0::2]
+    Y = Y_moco.get_fdata(dtype=DTYPE)
+    Y_odd = Y[:, :, :, 1::2]
+    Y_even = Y[:, :, :, 0::2]
 
     # ignore voxels where below would lead to dividing by zero
     nonzero_mask = np.abs(X_odd - X_even) > 1e-6
@@ -66,7 +75,7 @@ def tag_control_differencing(series, scaling_factors, outdir, mask=None):
 
     # only perform calculation within the provided mask
     if mask is not None:
-        mask = nb.load(mask).get_fdata()
+        mask = nb.load(mask).get_fdata(dtype=DTYPE)
         if mask.ndim == 3:
             mask = mask[..., np.newaxis]
         nonzero_mask = np.logical_and(nonzero_mask, mask)
@@ -89,7 +98,7 @@ def tag_control_differencing(series, scaling_factors, outdir, mask=None):
     # save both images
     B_perf_name = outdir / "beta_perf.nii.gz"
     B_perf_img = nb.nifti1.Nifti1Image(B_perf, affine=Y_moco.affine)
-    nb.save(B_perf_img, B_perf_name)
+    pgzip.save_image(B_perf_img, B_perf_name)
     B_baseline_name = outdir / "beta_baseline.nii.gz"
     B_baseline_img = nb.nifti1.Nifti1Image(B_baseline, affine=Y_moco.affine)
-    nb.save(B_baseline_img, B_baseline_name)
+    pgzip.save_image(B_baseline_img, B_baseline_name)
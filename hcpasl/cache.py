@@ -0,0 +1,163 @@
+"""
+Content-addressed cache of completed pipeline stages.
+
+A stage's key is a hash of its parameters, the contents of its input
+artifacts, the hcpasl version and the versions of the external tools
+and libraries it may call. When a stage completes its key and the
+digests of its outputs are recorded, and on later runs the stage is
+skipped if its key is unchanged and its outputs are still intact.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import threading
+from importlib import metadata
+from pathlib import Path
+
+from hcpasl import __sha1__, __version__
+
+# python packages whose versions contribute to every stage's key
+PACKAGES = ("regtricks", "pyfab", "fslpy", "nibabel", "numpy", "scipy", "gradunwarp")
+
+_CHUNK = 1 << 20
+
+
+def _read_first_line(path):
+    try:
+        with open(path, "r") as f:
+            return f.readline().strip()
+    except OSError:
+        return None
+
+
+def _wb_command_version():
+    wb_command = Path(os.environ.get("CARET7DIR", "")) / "wb_command"
+    try:
+        result = subprocess.run(
+            [str(wb_command), "-version"], capture_output=True, text=True, timeout=60
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    for line in result.stdout.splitlines():
+        if line.strip().lower().startswith("version"):
+            return line.split(":", 1)[-1].strip()
+    return None
+
+
+def environment_versions():
+    """
+    Versions of hcpasl, the external tools and the python packages
+    used by the pipeline. Tools or packages which cannot be found are
+    recorded as None.
+    """
+    env = os.environ
+    versions = {
+        "hcpasl": f"{__version__} ({__sha1__})",
+        "fsl": _read_first_line(Path(env.get("FSLDIR", "")) / "etc/fslversion"),
+        "freesurfer": _read_first_line(
+            Path(env.get("FREESURFER_HOME", "")) / "build-stamp.txt"
+        ),
+        "hcppipelines": _read_first_line(Path(env.get("HCPPIPEDIR", "")) / "version.txt"),
+        "workbench": _wb_command_version(),
+    }
+    for package in PACKAGES:
+        try:
+            versions[package] = metadata.version(package)
+        except metadata.PackageNotFoundError:
+            versions[package] = None
+    return versions
+
+
+class StageCache:
+    """Keys and output digests of completed stages, stored as json"""
+
+    def __init__(self, path, versions=None):
+        """
+        Parameters
+        ----------
+        path : pathlib.Path
+            Path to the json file in which the cache is stored.
+        versions : dict, optional
+            Tool and package versions to include in every key.
+            Default is the result of `environment_versions()`.
+        """
+        self.path = Path(path)
+        self.versions = environment_versions() if versions is None else versions
+        self._lock = threading.Lock()
+        self._stages, self._digests = {}, {}
+        if self.path.exists():
+            try:
+                with open(self.path, "r") as f:
+                    contents = json.load(f)
+                self._stages = contents["stages"]
+                self._digests = contents["digests"]
+            except (OSError, ValueError, KeyError):
+                logging.warning(f"Ignoring unreadable stage cache {self.path}")
+
+    def digest(self, path):
+        """
+        Content digest of a file or directory, or None if it does not
+        exist. File digests are reused while a file's size and
+        modification time are unchanged.
+        """
+        path = Path(path)
+        if path.is_dir():
+            h = hashlib.sha256()
+            for child in sorted(p for p in path.rglob("*") if p.is_file()):
+                h.update(str(child.relative_to(path)).encode())
+                h.update(self.digest(child).encode())
+            return h.hexdigest()
+        try:
+            st = path.stat()
+        except OSError:
+            return None
+        stamp = [st.st_size, st.st_mtime_ns]
+        with self._lock:
+            known = self._digests.get(str(path))
+        if known is not None and known[:2] == stamp:
+            return known[2]
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(_CHUNK), b""):
+                h.update(chunk)
+        with self._lock:
+            self._digests[str(path)] = [*stamp, h.hexdigest()]
+        return h.hexdigest()
+
+    def key(self, stage):
+        """Key of a stage given the current state of its inputs"""
+        contents = {
+            "stage": stage.number,
+            "params": {k: str(v) for k, v in stage.params.items()},
+            "versions": self.versions,
+            "inputs": {str(p): self.digest(p) for p in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(contents, sort_keys=True).encode()).hexdigest()
+
+    def is_current(self, stage, key):
+        """Whether `stage` last completed with `key` and its outputs are intact"""
+        with self._lock:
+            entry = self._stages.get(str(stage.number))
+        if entry is None or entry["key"] != key:
+            return False
+        outputs = {str(p): self.digest(p) for p in stage.outputs}
+        return None not in outputs.values() and outputs == entry["outputs"]
+
+    def record(self, stage, key):
+        """Record that `stage` completed with `key` and save the cache"""
+        outputs = {str(p): self.digest(p) for p in stage.outputs}
+        with self._lock:
+            self._stages[str(stage.number)] = {"key": key, "outputs": outputs}
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            tmp = self.path.with_name(f".{self.path.name}.tmp")
+            with open(tmp, "w") as f:
+                json.dump(
+                    {"stages": self._stages, "digests": self._digests},
+                    f,
+                    sort_keys=True,
+                    indent=4,
+                )
+            os.replace(tmp, self.path)
@@ -12,7 +12,7 @@ import numpy as np
 import regtricks as rt
 
 from .tissue_masks import generate_tissue_mask
-from .utils import sp_run, ImagePath
+from .utils import sp_run, DTYPE, ImagePath
 from .registration import register_asl2struct
 
 
@@ -161,12 +161,12 @@ def initial_corrections_calibration(
             logging.info(
                 f"Applying empirical banding scaling factors to {calib_gdc.stem}"
             )
-            mt_sfs = np.loadtxt(eb_factors)
+            mt_sfs = np.loadtxt(eb_factors, dtype=DTYPE)
             assert len(mt_sfs) == calib_gdc.img.shape[2]
             calib_gdc_eb = calib_gdc.correct_from_data(
                 calib_dir / "empirical_banding_correction",
                 "eb",
-                calib_gdc.img.get_fdata() * mt_sfs,
+                calib_gdc.get_fdata() * mt_sfs,
             )
         else:
             calib_gdc_eb = calib_gdc
@@ -262,9 +262,9 @@ def initial_corrections_calibration(
         sp_run(dilall_cmd)
 
         logging.info(f"Performing bias correction on {calib_gdc_sdc.stem}")
-        bias_img = nb.load(bias_final)
+        bias = nb.load(bias_final).get_fdata(dtype=DTYPE)
         calib_gdc_sdc_bc = calib_gdc_sdc.correct_from_data(
-            biascorr_dir, "bc", calib_gdc_sdc.img.get_fdata() / bias_img.get_fdata()
+            biascorr_dir, "bc", calib_gdc_sdc.get_fdata() / bias
         )
 
         if not nobandingcorr:
@@ -272,7 +272,7 @@ def initial_corrections_calibration(
                 f"Performing empirical banding correction to {calib_gdc_sdc_bc.stem}"
             )
             calib_gdc_sdc_bc_eb = calib_gdc_sdc_bc.correct_from_data(
-                biascorr_dir, "eb", calib_gdc_sdc_bc.img.get_fdata() * mt_sfs
+                biascorr_dir, "eb", calib_gdc_sdc_bc.get_fdata() * mt_sfs
             )
         else:
             calib_gdc_sdc_bc_eb = calib_gdc_sdc_bc
@@ -0,0 +1,121 @@
+"""
+Bounded cache of the data decoded from images.
+
+`ImagePath.get_fdata` decodes an image's data once and keeps it here,
+so that later calls, including those made through other `ImagePath`s
+to the same unchanged image, reuse the array rather than decompressing
+the file again. The least recently used arrays are evicted once the
+cache holds more than `MAX_BYTES`, and a chain of corrections releases
+the images it has finished with as it goes.
+
+Cached arrays are shared, so callers are given read-only views of
+them. The arrays themselves are left as they were loaded, since an
+image held in memory may hand back its producer's own array.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# largest total size of the arrays held, in bytes
+MAX_BYTES = 2 * 1024**3
+
+_lock = threading.Lock()
+_arrays = OrderedDict()
+_nbytes = 0
+_hits = 0
+_misses = 0
+
+
+def get(path, version, load):
+    """
+    The data of the image at `path`, decoding it with `load()` if it is
+    not cached.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Location of the image.
+    version : hashable
+        Identifies the image's current contents. Data cached for a
+        different version of the image is decoded again.
+    load : callable
+        Returns the image's data as a numpy array.
+
+    Returns
+    -------
+    numpy.ndarray
+        Read-only array of the image's data.
+    """
+    global _hits, _misses
+    path = Path(path)
+    with _lock:
+        cached = _arrays.get(path)
+        if cached is not None and cached[0] == version:
+            _arrays.move_to_end(path)
+            _hits += 1
+            return cached[1]
+        _misses += 1
+    data = load().view()
+    data.flags.writeable = False
+    with _lock:
+        _discard(path)
+        if data.nbytes <= MAX_BYTES:
+            _store(path, version, data)
+    return data
+
+
+def _store(path, version, data):
+    global _nbytes
+    _arrays[path] = (version, data)
+    _nbytes += data.nbytes
+    while _nbytes > MAX_BYTES:
+        _, (_, evicted) = _arrays.popitem(last=False)
+        _nbytes -= evicted.nbytes
+
+
+def _discard(path):
+    global _nbytes
+    cached = _arrays.pop(path, None)
+    if cached is not None:
+        _nbytes -= cached[1].nbytes
+
+
+def release(path):
+    """Drop any data cached for the image at `path`"""
+    with _lock:
+        _discard(Path(path))
+
+
+def clear():
+    """Drop all cached data"""
+    global _nbytes
+    with _lock:
+        _arrays.clear()
+        _nbytes = 0
+
+
+def stats():
+    """
+    Returns
+    -------
+    dict
+        Numbers of cache hits and misses so far, and the number and
+        total size in bytes of the arrays currently held.
+    """
+    with _lock:
+        return {
+            "hits": _hits,
+            "misses": _misses,
+            "arrays": len(_arrays),
+            "bytes": _nbytes,
+        }
+
+
+def log_stats():
+    s = stats()
+    logging.info(
+        f"Image data cache: {s['hits']} hits, {s['misses']} misses, "
+        f"{s['arrays']} arrays ({s['bytes'] / 1024**2:.1f} MB) held."
+    )
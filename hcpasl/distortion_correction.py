@@ -1,7 +1,6 @@
 import logging
 import os
 import os.path as op
-import subprocess as sp
 from pathlib import Path
 
 import nibabel as nb
@@ -9,7 +8,8 @@ import numpy as np
 import regtricks as rt
 from fsl.wrappers import bet
 
-from hcpasl.utils import sp_run
+from hcpasl import pgzip
+from hcpasl.utils import DTYPE, sp_run
 
 
 def generate_gdc_warp(vol, coeffs_path, distcorr_dir, interpolation=1):
@@ -55,11 +55,15 @@ def generate_topup_params(pars_filepath):
 def stack_fmaps(pa_sefm, ap_sefm, savename):
     """Stack two SEFMs into a single 4D image."""
 
-    rt.ImageSpace.save_like(
+    pgzip.save_like(
         ref=pa_sefm,
         data=np.stack(
-            (nb.load(pa_sefm).get_fdata(), nb.load(ap_sefm).get_fdata()), axis=-1
-        ).astype(np.float32),
+            (
+                nb.load(pa_sefm).get_fdata(dtype=DTYPE),
+                nb.load(ap_sefm).get_fdata(dtype=DTYPE),
+            ),
+            axis=-1,
+        ),
         path=savename,
     )
 
@@ -108,7 +112,7 @@ def apply_gdc_and_sdc(pa_ap_sefms, topup_dir, gdc_warp, interpolation=3, gd_corr
     # apply corrections and save in stacked image
     pa_ap_sefms_gdc_sdc = [
         topup_gdc_sdc_moco[n].apply_to_array(
-            data=pa_ap_sefms.get_fdata()[:, :, :, n],
+            data=pa_ap_sefms.get_fdata(dtype=DTYPE)[:, :, :, n],
             src=pa_ap_sefms,
             ref=pa_ap_sefms,
             order=interpolation,
@@ -116,7 +120,7 @@ def apply_gdc_and_sdc(pa_ap_sefms, topup_dir, gdc_warp, interpolation=3, gd_corr
         for n in range(0, 2)
     ]
     pa_ap_sefms_gdc_sdc = nb.nifti1.Nifti1Image(
-        np.concatenate([arr[..., np.newaxis] for arr in pa_ap_sefms_gdc_sdc], axis=-1),
+        np.stack(pa_ap_sefms_gdc_sdc, axis=-1).astype(DTYPE),
         affine=pa_ap_sefms.affine,
     )
 
@@ -176,7 +180,7 @@ def generate_topup_fmaps(
     else:
         topup_input_pa_ap_sefms = nb.load(pa_ap_sefms)
     topup_input_pa_ap_sefms_name = topup_dir / "stacked_sefms_gdc_topup_input.nii.gz"
-    nb.save(topup_input_pa_ap_sefms, topup_input_pa_ap_sefms_name)
+    pgzip.save_image(topup_input_pa_ap_sefms, topup_input_pa_ap_sefms_name)
 
     # Run topup to get fmap in Hz
     topup_fmap = op.join(topup_dir, "topup_fmap_hz.nii.gz")
@@ -202,9 +206,9 @@ def generate_topup_fmaps(
     # Convert fmap from Hz to rad/s
     logging.info("Converting fieldmap from Hz to rad/s.")
     fmap_spc = rt.ImageSpace(topup_fmap)
-    fmap_arr_hz = nb.load(topup_fmap).get_fdata()
-    fmap_arr = fmap_arr_hz * 2 * np.pi
-    fmap_spc.save_image(fmap_arr.astype(np.float32), fmap)
+    fmap_arr_hz = nb.load(topup_fmap).get_fdata(dtype=DTYPE)
+    fmap_arr = fmap_arr_hz * DTYPE(2 * np.pi)
+    fmap_spc.save_image(fmap_arr, fmap)
 
     # Apply GDC warp from gradient_unwarp and topup's SDC
     # warp (just generated) in one interpolation step
@@ -222,7 +226,8 @@ def generate_topup_fmaps(
     # Mean across volumes of corrected sefms to get fmapmag
     logging.info("Taking mean of corrected fieldmap images to get fmapmag.nii.gz")
     fmapmag_img = nb.nifti1.Nifti1Image(
-        pa_ap_sefms_gdc_sdc.get_fdata().mean(-1), affine=pa_ap_sefms_gdc_sdc.affine
+        pa_ap_sefms_gdc_sdc.get_fdata(dtype=DTYPE).mean(-1),
+        affine=pa_ap_sefms_gdc_sdc.affine,
     )
     nb.save(fmapmag_img, fmapmag)
 
@@ -291,7 +296,7 @@ def register_fmap(fmapmag, fmapmagbrain, s, sbet, out_dir, wm_tissseg):
         schedule,
     ]
     for cmd in (init_cmd, sec_cmd, bbr_cmd):
-        sp.run(cmd)
+        sp_run(cmd)
     return str(bbr_xform)
 
 
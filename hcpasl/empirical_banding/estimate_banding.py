@@ -21,28 +21,19 @@ BAND_RANGE = {
     "combined": range(1, 5),
 }
 PLOT_LIMS = {"wm": 1000, "gm": 1000, "csf": 1500, "combined": 1000}
-# scan parameters
-slice_in_band = np.tile(np.arange(0, 10), 6).reshape(1, 1, -1)
-slicedt = 0.059
 
 
 def slicetime_correction(image, tissue, tr):
     """
     Rescale data to the given TR to account for T1 relaxation.
     """
-    slice_times = tr + (slice_in_band * slicedt)
-    denominator = 1 - np.exp(-slice_times / T1_VALS[tissue])
-    numerator = 1 - np.exp(-tr / T1_VALS[tissue])
-    rescaled_image = image * (numerator / denominator)
-    return rescaled_image
+    slice_times = utils.slice_times([tr])[..., 0]
+    return image * utils.satrecov_scaling(T1_VALS[tissue], tr, slice_times)
 
 
 def undo_st_correction(rescaled_image, tissue, ti):
-    slice_times = 8 + (slice_in_band * slicedt)
-    numerator = 1 - np.exp(-slice_times / T1_VALS[tissue])
-    denominator = 1 - np.exp(-ti / T1_VALS[tissue])
-    descaled_image = rescaled_image * (numerator / denominator)
-    return descaled_image
+    slice_times = utils.slice_times([8])[..., 0]
+    return rescaled_image * utils.satrecov_scaling(T1_VALS[tissue], slice_times, ti)
 
 
 def fit_linear_model(slice_means, method="separate", resolution=10000):
@@ -11,12 +11,12 @@ import os.path as op
 
 import nibabel as nb
 import regtricks as rt
-from fsl.wrappers import bet, fslmaths, fslroi
+from fsl.wrappers import bet, fslmaths
 
 from hcpasl import distortion_correction
 from hcpasl.bias_estimation import bias_estimation, register_fmap
 from hcpasl.tissue_masks import generate_tissue_mask, generate_tissue_mask_in_ref_space
-from hcpasl.utils import linear_asl_reg
+from hcpasl.utils import linear_asl_reg, split_volumes
 
 
 def setup(subject_dir):
@@ -83,10 +83,7 @@ def setup(subject_dir):
 
     # split mbpcasl sequence into its calibration images
     calib_names = [d / f"calib{n}.nii.gz" for n, d in enumerate(calib_dirs)]
-    [
-        fslroi(str(mbpcasl), calib_name, n, 1)
-        for calib_name, n in zip(calib_names, (88, 89))
-    ]
+    split_volumes(mbpcasl, dict(zip(calib_names, (88, 89))))
 
     # return helpful dictionary
     names = {
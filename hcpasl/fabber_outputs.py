@@ -0,0 +1,151 @@
+"""
+Reading and preparing Fabber's satrecov outputs.
+
+Fabber saves each voxel's posterior as an MVN image of
+n(n+1)/2 + n + 1 volumes for a model of n parameters: the lower
+triangle of the covariance matrix, row by row, then the means of the
+parameters in the model's order, then a volume of ones.
+"""
+
+import logging
+import re
+
+import nibabel as nb
+import numpy as np
+
+from hcpasl.utils import DTYPE, atomic_save
+
+# parameters of Fabber's satrecov model, in the order of its MVN
+SATRECOV_PARAMS = ("M0t", "T1t", "A")
+# iteration numbers reported in Fabber's log, as in "Iteration 3" or
+# "*** Spatial iteration *** 3"
+FABBER_ITERATION = re.compile(r"iteration\W*(\d+)", re.IGNORECASE)
+
+
+def mvn_layout(n_volumes):
+    """
+    Layout of an MVN image of `n_volumes` volumes.
+
+    Returns
+    -------
+    n_params : int
+        Number of model parameters.
+    rows, cols : numpy.ndarray
+        Row and column, within the covariance matrix, of each of the
+        first n(n+1)/2 volumes.
+    """
+    n_params = int(round((np.sqrt(1 + 8 * n_volumes) - 3) / 2))
+    if n_params < 1 or n_params * (n_params + 3) // 2 + 1 != n_volumes:
+        raise ValueError(f"{n_volumes} volumes are not the layout of an MVN.")
+    rows, cols = np.tril_indices(n_params)
+    return n_params, rows, cols
+
+
+def split_mvn(mvn):
+    """
+    Split MVN data into each voxel's means and covariance matrix.
+
+    Parameters
+    ----------
+    mvn : numpy.ndarray
+        MVN data, with the volumes along the last axis.
+
+    Returns
+    -------
+    means : numpy.ndarray
+        Array of shape (..., n_params).
+    covariance : numpy.ndarray
+        Symmetric array of shape (..., n_params, n_params).
+    """
+    n_params, rows, cols = mvn_layout(mvn.shape[-1])
+    n_cov = len(rows)
+    covariance = np.zeros((*mvn.shape[:-1], n_params, n_params), dtype=mvn.dtype)
+    covariance[..., rows, cols] = mvn[..., :n_cov]
+    covariance[..., cols, rows] = mvn[..., :n_cov]
+    return mvn[..., n_cov : n_cov + n_params], covariance
+
+
+def join_mvn(means, covariance):
+    """MVN data of the given means and covariance matrices, see `split_mvn`"""
+    n_params = means.shape[-1]
+    rows, cols = np.tril_indices(n_params)
+    ones = np.ones((*means.shape[:-1], 1), dtype=means.dtype)
+    return np.concatenate([covariance[..., rows, cols], means, ones], axis=-1)
+
+
+def fabber_iterations(log):
+    """Largest iteration number reported in a Fabber log, if any"""
+    counts = [int(n) for n in FABBER_ITERATION.findall(log)]
+    return max(counts) if counts else None
+
+
+def log_fabber_iterations(results_dir):
+    """
+    Log the number of iterations of each of Fabber's satrecov runs in
+    `results_dir`, as reported in their logfiles.
+    """
+    for name in ("nospatial", "spatial"):
+        log_name = results_dir / name / "logfile"
+        if not log_name.exists():
+            continue
+        n_iter = fabber_iterations(log_name.read_text())
+        if n_iter is None:
+            logging.info(f"No iteration count found in {log_name}.")
+        else:
+            logging.info(f"Fabber {name} run in {results_dir}: {n_iter} iterations.")
+
+
+def warm_start_mvn(mvn_name, mask_name, out_name, reg=None, cores=1):
+    """
+    Prepare a Fabber posterior from an earlier fit to start a new fit
+    within `mask_name`.
+
+    Only the parameter means are carried over. Voxels of the earlier
+    fit outside its mask, whose posterior is all zeros, are given the
+    median of the voxels which were fitted, and the means are then
+    resampled with `reg` onto the grid of the new fit. The covariance
+    is reset to a broad, uncorrelated one rather than carrying over the
+    earlier fit's confidence: each parameter's variance is its variance
+    across the voxels of the earlier fit, or its median posterior
+    variance if that is larger.
+
+    Parameters
+    ----------
+    mvn_name : pathlib.Path
+        finalMVN of the earlier fit.
+    mask_name : pathlib.Path
+        Mask of the voxels to be fitted, on the grid of the new fit.
+    out_name : pathlib.Path
+        Location to save the posterior.
+    reg : regtricks.Registration, optional
+        Transformation from the earlier fit's voxel grid to the new
+        fit's. The means are linearly interpolated. Default is to use
+        them voxel for voxel.
+    cores : int, optional
+        Number of cores used to resample the means. Default is 1.
+    """
+    mvn_img = nb.load(mvn_name)
+    mvn = mvn_img.get_fdata(dtype=DTYPE)
+    mask_img = nb.load(mask_name)
+    mask = mask_img.get_fdata() > 0
+    fitted = np.any(mvn != 0, axis=-1)
+    means, covariance = split_mvn(mvn)
+    posterior_var = np.diagonal(covariance[fitted], axis1=-2, axis2=-1)
+    variance = np.maximum(means[fitted].var(axis=0), np.median(posterior_var, axis=0))
+    reset_covariance = np.diag(variance).astype(DTYPE)
+
+    means = means.copy()
+    means[~fitted] = np.median(means[fitted], axis=0)
+    if reg is not None:
+        logging.info(f"Resampling the posterior means of {mvn_name}.")
+        means = reg.apply_to_array(
+            means, src=mvn_img, ref=mask_img, order=1, cores=cores
+        )
+
+    warm = np.zeros((*mask.shape, mvn.shape[-1]), dtype=DTYPE)
+    n_voxels = np.count_nonzero(mask)
+    warm[mask] = join_mvn(
+        means[mask].astype(DTYPE),
+        np.broadcast_to(reset_covariance, (n_voxels, *reset_covariance.shape)),
+    )
+    atomic_save(nb.Nifti1Image(warm, mask_img.affine, mask_img.header), out_name)
@@ -6,9 +6,16 @@ import regtricks as rt
 import nibabel as nb
 import numpy as np
 
-from .utils import SLICEBAND, SLICEDT, TIS, sp_run, ASL_SHAPE, ImagePath
+from . import pgzip
+from .utils import (
+    sp_run,
+    satrecov_scaling,
+    ASL_SHAPE,
+    DTYPE,
+    ImagePath,
+)
 from .registration import register_asl2struct
-from .asl_correction import create_ti_image
+from .timing import MBPCASL, AcquisitionTiming
 
 
 def fully_correct_asl_calibration_aslt1w(
@@ -281,38 +288,37 @@ def fully_correct_asl_calibration_aslt1w(
         )
     else:
         asl_sfs = nb.nifti1.Nifti1Image(
-            np.ones(asl_gdc_mc_sdc.img.shape, dtype=np.float32),
+            np.ones(asl_gdc_mc_sdc.img.shape, dtype=DTYPE),
             affine=asl_gdc_mc_sdc.img.affine,
         )
-    asl_sfs.to_filename(asl_corr_dir / "label_control_scaling_factors.nii.gz")
+    pgzip.save_image(asl_sfs, asl_corr_dir / "label_control_scaling_factors.nii.gz")
 
     # apply bias field and banding corrections to ASL series
     logging.info(
         "Applying SE-based bias correction and banding corrections to ASL series."
     )
-    bias = nb.load(bias_name)
-    asl_gdc_mc_sdc_bc_st_eb = np.zeros(asl_gdc_mc_sdc.img.shape, dtype=np.float32)
+    bias = nb.load(bias_name).get_fdata(dtype=DTYPE)[..., None]
+    asl_gdc_mc_sdc_bc_st_eb = np.zeros(asl_gdc_mc_sdc.img.shape, dtype=DTYPE)
     np.divide(
-        asl_gdc_mc_sdc.get_fdata() * asl_sfs.get_fdata(),
-        bias.get_fdata()[..., None],
+        asl_gdc_mc_sdc.get_fdata() * asl_sfs.get_fdata(dtype=DTYPE),
+        bias,
         out=asl_gdc_mc_sdc_bc_st_eb,
-        where=(bias.get_fdata()[..., None] != 0),
+        where=(bias != 0),
     )
     asl_gdc_mc_sdc_bc_st_eb = asl_gdc_mc_sdc.correct_from_data(
         asl_corr_dir, "bc", asl_gdc_mc_sdc_bc_st_eb
     )
-    asl_gdc_mc_sdc_bc_st_eb.img.to_filename(
-        asl_corr_dir / "label_control_corrected.nii.gz"
+    pgzip.save_image(
+        asl_gdc_mc_sdc_bc_st_eb.img, asl_corr_dir / "label_control_corrected.nii.gz"
     )
 
     # create TI timing image in ASL space and register to ASL-gridded T1w space
     logging.info("Creating TI image in ASLT1w space for use in oxford_asl.")
     ti_aslt1w_name = tis_aslt1w_dir / "timing_img.nii.gz"
-    create_ti_image(str(asl_name), TIS, SLICEBAND, SLICEDT, str(ti_aslt1w_name))
     ti_aslt1w = asl2struct_reg.apply_to_image(
-        src=ti_aslt1w_name, ref=aslt1_spc, order=1
+        src=MBPCASL.ti_image(asl_spc, per_volume=False), ref=aslt1_spc, order=1
     )
-    nb.save(ti_aslt1w, ti_aslt1w_name)
+    pgzip.save_image(ti_aslt1w, ti_aslt1w_name)
 
     # register T1 image, estimated by the satrecov model, to ASL-gridded T1w space
     logging.info("Registering estimated T1t image to ASLT1w space.")
@@ -320,17 +326,16 @@ def fully_correct_asl_calibration_aslt1w(
         src=t1_est, ref=aslt1_spc, order=interpolation
     )
     t1_est_aslt1w_name = reg_dir / "mean_T1t_filt.nii.gz"
-    nb.save(t1_est_aslt1w, t1_est_aslt1w_name)
+    pgzip.save_image(t1_est_aslt1w, t1_est_aslt1w_name)
 
     # create timing image in calibration space and register to ASL-gridded T1w space
-    calib_timing = calib_name.path.parent / "calib_timing.nii.gz"
-    create_ti_image(str(calib_name.path), [8], SLICEBAND, SLICEDT, str(calib_timing))
-    calib_timing = ImagePath(calib_timing)
+    calib_spc = rt.ImageSpace(calib_name.path)
+    calib_timing = AcquisitionTiming([8], [1], n_slices=calib_spc.size[2])
     m02struct = rt.chain(m02asl0, asl2struct_reg)
-    calib_timing = calib_timing.correct_from_image(
-        calib_dir,
-        "",
-        m02struct.apply_to_image(src=calib_timing.path, ref=aslt1w_spc, order=1),
+    calib_timing = m02struct.apply_to_image(
+        src=calib_timing.ti_image(calib_spc, per_volume=False),
+        ref=aslt1w_spc,
+        order=1,
     )
 
     # register calibration image's empirical banding scaling factors to ASL-gridded T1w space
@@ -338,7 +343,7 @@ def fully_correct_asl_calibration_aslt1w(
         logging.info(
             "Registering calibration image's empirical banding scaling factors to ASLT1w space."
         )
-        eb_sfs = np.loadtxt(eb_factors)
+        eb_sfs = np.loadtxt(eb_factors, dtype=DTYPE)
         eb_arr = np.tile(eb_sfs, (ASL_SHAPE[0], ASL_SHAPE[1], 1))
         eb_img = m02struct.apply_to_array(
             data=eb_arr,
@@ -346,43 +351,31 @@ def fully_correct_asl_calibration_aslt1w(
             ref=aslt1_spc,
             order=interpolation,
         )
-        eb_img = aslt1_spc.make_nifti(eb_img.astype(np.float32))
-        eb_img.to_filename(calib_dir / "eb_scaling_factors.nii.gz")
+        eb_img = aslt1_spc.make_nifti(eb_img.astype(DTYPE))
+        pgzip.save_image(eb_img, calib_dir / "eb_scaling_factors.nii.gz")
 
         # perform slicetime correction on the calibration image
-        num = np.zeros_like(t1_est_aslt1w.get_fdata())
-        np.divide(
-            -8,
-            t1_est_aslt1w.get_fdata(),
-            out=num,
-            where=(t1_est_aslt1w.get_fdata() > 0),
-        )
-
-        num = 1 - np.exp(num)
-        den = np.zeros_like(t1_est_aslt1w.get_fdata())
-        fltr = (t1_est_aslt1w.get_fdata() > 0) & (calib_timing.get_fdata() > 0.1)
-        np.divide(
-            -calib_timing.get_fdata(),
-            t1_est_aslt1w.get_fdata(),
-            out=den,
-            where=fltr,
+        calib_ti = calib_timing.get_fdata(dtype=DTYPE).reshape(aslt1w_spc.size)
+        st_img = satrecov_scaling(
+            t1_est_aslt1w.get_fdata(dtype=DTYPE), 8, calib_ti, where=calib_ti > 0.1
         )
-        den = 1 - np.exp(den)
-        st_img = np.ones_like(den, dtype=np.float32)
-        np.divide(num, den, where=(den > 0), out=st_img)
         st_img = nb.nifti1.Nifti1Image(st_img, affine=calib_gdc_sdc.img.affine)
-        st_img.to_filename(calib_dir / "st_scaling_factors.nii.gz")
+        pgzip.save_image(st_img, calib_dir / "st_scaling_factors.nii.gz")
 
         # correct the registered, gdc_sdc, bias-corrected calibration image for empirical banding effect and slice-time effect
         calib_gdc_sdc_bc_st_eb = calib_gdc_sdc_bc.correct_from_data(
             calib_dir,
             "st_eb",
-            calib_gdc_sdc_bc.get_fdata() * eb_img.get_fdata() * st_img.get_fdata(),
+            calib_gdc_sdc_bc.get_fdata()
+            * eb_img.get_fdata(dtype=DTYPE)
+            * st_img.get_fdata(dtype=DTYPE),
+        )
+        pgzip.save_image(
+            calib_gdc_sdc_bc_st_eb.img, calib_dir / "calib0_corrected.nii.gz"
         )
-        calib_gdc_sdc_bc_st_eb.img.to_filename(calib_dir / "calib0_corrected.nii.gz")
 
     else:
-        calib_gdc_sdc_bc.img.to_filename(calib_dir / "calib0_corrected.nii.gz")
+        pgzip.save_image(calib_gdc_sdc_bc.img, calib_dir / "calib0_corrected.nii.gz")
 
     # Transform raw ASL and calibration to ASLT1w for QC
     logging.info("Transforming raw ASL to ASLT1w space for QC.")
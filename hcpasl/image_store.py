@@ -0,0 +1,134 @@
+"""
+In-memory store of the images produced by chains of corrections.
+
+`ImagePath.correct_from_image` and `correct_from_data` hand each
+corrected image to the store, which writes it to disk in the
+background, rather than saving it and loading it back. Until an
+image's write has finished, and afterwards for as long as some
+`ImagePath` still refers to it, `ImagePath(path)` is given the image
+held in memory instead of reading and decompressing the file.
+
+Anything which needs the file itself must wait for its write to
+finish. `ImagePath.path` does so, as do the run journal before
+recording a step's outputs and the scheduler before declaring a
+stage complete.
+"""
+
+import itertools
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from hcpasl import accounting
+
+# threads writing images in the background; most of the work is zlib
+# compression, which runs without the GIL
+WRITE_THREADS = 2
+
+_lock = threading.Lock()
+_images = weakref.WeakValueDictionary()
+_pending = {}
+_executor = None
+# version of the image last put at each path, never reused
+_versions = {}
+_counter = itertools.count()
+
+
+def _key(path):
+    return Path(path).resolve()
+
+
+def put(path, img, save):
+    """
+    Hold `img` in memory as the image at `path` and write it there in
+    the background by calling `save(img, path)`.
+
+    Writes to the same path are made in the order they were put.
+    """
+    global _executor
+    path = _key(path)
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                WRITE_THREADS, thread_name_prefix="image_store"
+            )
+        previous = _pending.get(path)
+
+        def write():
+            if previous is not None:
+                previous[0].result()
+            save(img, path)
+
+        future = _executor.submit(write)
+        _pending[path] = (future, accounting.current_stage())
+        _images[path] = img
+        _versions[path] = next(_counter)
+    future.add_done_callback(lambda f: _finished(path, f))
+
+
+def _finished(path, future):
+    # failed writes are kept so that the next wait() raises their error
+    if future.exception() is not None:
+        return
+    with _lock:
+        if _pending.get(path, (None,))[0] is future:
+            del _pending[path]
+
+
+def get(path):
+    """
+    The image held in memory for `path` and its version.
+
+    Returns
+    -------
+    img : nibabel.nifti1.Nifti1Image or None
+        The image, or None if none is held for `path`.
+    version : int or None
+        Distinguishes `img` from every other image put at any path,
+        so that data decoded from an earlier image at the same path is
+        not mistaken for its data.
+    """
+    path = _key(path)
+    with _lock:
+        img = _images.get(path)
+        if img is None:
+            return None, None
+        return img, _versions[path]
+
+
+def wait(paths=None, stage=None):
+    """
+    Wait for pending writes to finish, re-raising the first error.
+
+    Parameters
+    ----------
+    paths : iterable of pathlib.Path, optional
+        Only wait for writes to these files or to files within these
+        directories. Default is every pending write.
+    stage : int, optional
+        Only wait for writes made while running this stage.
+    """
+    if paths is not None:
+        paths = [_key(p) for p in paths if p is not None]
+    with _lock:
+        futures = [
+            future
+            for path, (future, written_by) in _pending.items()
+            if (stage is None or written_by == stage)
+            and (
+                paths is None
+                or any(path == p or p in path.parents for p in paths)
+            )
+        ]
+    error = None
+    for future in futures:
+        try:
+            future.result()
+        except Exception as e:
+            logging.error(f"Background image write failed: {e}")
+            if error is None:
+                error = e
+    if error is not None:
+        raise error
@@ -0,0 +1,203 @@
+"""
+Crash-safe journal of the steps completed within long pipeline stages.
+
+The journal is an append-only file of json lines, each flushed and
+fsync'd before the next step starts, so it survives the process being
+killed at any point. A truncated final line is ignored when the
+journal is read.
+
+Steps within a scope (for example, `initial_corrections_asl`) form a
+chain. When resuming, steps are skipped while they were recorded as
+complete under the same parameters and inputs and their output files
+are unchanged since. Once one step runs, every later step runs too.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from hcpasl import image_store
+
+
+def file_stamps(paths):
+    """
+    Size and modification time of every file in `paths`, descending
+    into directories. Paths which do not exist are given as None.
+    """
+    stamps = {}
+    for path in paths:
+        path = Path(path)
+        if path.is_dir():
+            files = sorted(p for p in path.rglob("*") if p.is_file())
+        else:
+            files = [path]
+        for f in files:
+            try:
+                st = f.stat()
+                stamps[str(f)] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                stamps[str(f)] = None
+    return stamps
+
+
+class RunJournal:
+    """Append-only record of the steps completed for a subject"""
+
+    def __init__(self, path=None, resume=False):
+        """
+        Parameters
+        ----------
+        path : pathlib.Path, optional
+            Journal file. If None, nothing is recorded and every step
+            is run.
+        resume : bool, optional
+            Whether steps recorded as complete in a previous run may
+            be skipped. Default is False.
+        """
+        self.path = None if path is None else Path(path)
+        self.resume = resume
+        self._lock = threading.Lock()
+        self._records = []
+        self._truncated = False
+        if self.path is not None and self.path.exists():
+            with open(self.path, "r") as f:
+                lines = f.readlines()
+            # a write interrupted mid-line must not swallow the next record
+            self._truncated = bool(lines) and not lines[-1].endswith("\n")
+            for n, line in enumerate(lines):
+                try:
+                    self._records.append(json.loads(line))
+                except ValueError:
+                    if n != len(lines) - 1:
+                        logging.warning(
+                            f"Ignoring corrupt line {n + 1} of {self.path}"
+                        )
+
+    def write(self, record):
+        """Append a record to the journal and flush it to disk"""
+        if self.path is None:
+            return
+        record = {"time": time.time(), **record}
+        with self._lock:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            with open(self.path, "a") as f:
+                if self._truncated:
+                    f.write("\n")
+                    self._truncated = False
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def scope(self, name, params=None, inputs=()):
+        """
+        Start the chain of steps named `name`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the chain, unique within the journal.
+        params : dict, optional
+            Options which change the chain's results.
+        inputs : iterable of pathlib.Path
+            Files or directories read by the chain. Steps recorded
+            before any of these changed are not reused.
+
+        Returns
+        -------
+        JournalScope
+        """
+        params = {k: str(v) for k, v in (params or {}).items()}
+        signature = {"params": params, "inputs": file_stamps(p for p in inputs if p)}
+        # replay the journal: a fresh run or a change of parameters or
+        # inputs discards earlier steps, and starting a step discards
+        # it and every later step
+        completed, matching = {}, False
+        for record in self._records:
+            if record.get("scope") != name:
+                continue
+            if record["event"] == "begin":
+                matching = record["signature"] == signature
+                if not record["resume"] or not matching:
+                    completed = {}
+            elif not matching:
+                continue
+            elif record["event"] == "start":
+                completed = {
+                    step: r
+                    for step, r in completed.items()
+                    if r["index"] < record["index"]
+                }
+            elif record["event"] == "complete":
+                completed[record["step"]] = record
+        if not self.resume:
+            completed = {}
+        self.write(
+            {
+                "event": "begin",
+                "scope": name,
+                "resume": self.resume,
+                "signature": signature,
+            }
+        )
+        return JournalScope(self, name, completed)
+
+
+class JournalScope:
+    """The chain of steps within one scope of a RunJournal"""
+
+    def __init__(self, journal, name, completed):
+        self.journal = journal
+        self.name = name
+        self._completed = completed
+        self._index = 0
+        self._running = False
+        self._outputs = {}
+
+    def pending(self, step, outputs):
+        """
+        Whether `step` needs to be run.
+
+        A step is skipped if it was recorded as complete and its
+        `outputs` are unchanged since, and no earlier step has run.
+        If the step is to be run its start is recorded, and
+        `complete()` must be called once its outputs are written.
+        """
+        index, self._index = self._index, self._index + 1
+        outputs = [Path(p) for p in outputs if p is not None]
+        record = self._completed.get(step)
+        if (
+            not self._running
+            and record is not None
+            and record["index"] == index
+            and None not in record["outputs"].values()
+            and record["outputs"] == file_stamps(outputs)
+        ):
+            logging.info(f"Resuming {self.name}: skipping completed step {step}.")
+            return False
+        self._running = True
+        self._outputs[step] = (index, outputs)
+        self.journal.write(
+            {"event": "start", "scope": self.name, "step": step, "index": index}
+        )
+        return True
+
+    def complete(self, step):
+        """Record that `step` has finished writing its outputs"""
+        index, outputs = self._outputs.pop(step)
+        image_store.wait(outputs)
+        stamps = file_stamps(outputs)
+        missing = [p for p, s in stamps.items() if s is None]
+        if missing:
+            raise RuntimeError(f"Step {step} did not write its outputs: {missing}")
+        self.journal.write(
+            {
+                "event": "complete",
+                "scope": self.name,
+                "step": step,
+                "index": index,
+                "outputs": stamps,
+            }
+        )
@@ -3,10 +3,10 @@ from glob import glob
 from pathlib import Path
 from shutil import copy, move
 
-from hcpasl.utils import sp_run
+from hcpasl.utils import sp_run_many
 
 
-def copy_key_outputs(path, t1w_preproc, mni_raw):
+def copy_key_outputs(path, t1w_preproc, mni_raw, cores=1):
     source_path_T1 = path + "/T1w/ASL/perfusion_estimation/native_space/"
     destination_path_T1 = path + "/T1w/ASL/"
 
@@ -44,6 +44,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
 
     # Mask grey matter partial volume corrected perfusion and arrival results to restrict
     # to grey matter-contaiming voxels only
+    mask_cmds = []
     for gm_pvcorr_var, gm_pvcorr_var_out in zip(gm_pvcorr_vars, gm_pvcorr_vars_out):
         mask_cmd = [
             "fslmaths",
@@ -52,7 +53,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
             gm_mask,
             source_path_T1 + pv_prefix + "/" + gm_pvcorr_var_out,
         ]
-        sp_run(mask_cmd)
+        mask_cmds.append(mask_cmd)
 
     wm_mask = source_path_T1 + "wm_mask.nii.gz"
     wm_pvcorr_vars = ["perfusion_wm_var_calib.nii.gz", "arrival_wm_var.nii.gz"]
@@ -71,7 +72,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
             wm_mask,
             source_path_T1 + pv_prefix + "/" + wm_pvcorr_var_out,
         ]
-        sp_run(mask_cmd)
+        mask_cmds.append(mask_cmd)
 
     # Make key outputs more prominent in /T1w/ASL/ and warp the voxelwise results to
     # MNI space
@@ -82,6 +83,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
         "arrival_var.nii.gz",
         "aCBV_calib.nii.gz",
     ]
+    warp_cmds = []
     for x in nonpv_img_files:
         copy((source_path_T1 + x), (destination_path_T1 + x))
         if x != "aCBV_calib.nii.gz":
@@ -94,7 +96,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
                 asl_grid_mni,
                 (destination_path_MNI_voxel + x),
             ]
-            sp_run(warp_cmd)
+            warp_cmds.append(warp_cmd)
 
     # Make key perfusion summary values more priminent in /T1w/ASL/
     nonpv_txt_files = [
@@ -131,11 +133,8 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
         "arrival_wm_var_masked.nii.gz",
         "aCBV_calib.nii.gz",
     ]
+    n_nonpv_warps = len(warp_cmds)
     for en, out in zip(pv_img_files, pv_out_files):
-        copy(
-            (source_path_T1 + pv_prefix + "/" + en),
-            (destination_path_T1 + pv_prefix + "_" + out),
-        )
         if en != "aCBV_calib.nii.gz":
             pv_warp_cmd = [
                 script,
@@ -146,7 +145,21 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
                 asl_grid_mni,
                 (destination_path_MNI_voxel + pv_prefix + "/" + out),
             ]
-            sp_run(pv_warp_cmd)
+            warp_cmds.append(pv_warp_cmd)
+
+    # The first warp creates asl_grid_mni, which the other warps reuse, and
+    # the pvcorr warps read the masked variance estimates
+    masks = list(range(len(mask_cmds)))
+    first_warp = len(mask_cmds)
+    deps = {}
+    for n in range(1, len(warp_cmds)):
+        deps[first_warp + n] = [first_warp] + (masks if n >= n_nonpv_warps else [])
+    sp_run_many(mask_cmds + warp_cmds, deps=deps, cores=cores)
+    for en, out in zip(pv_img_files, pv_out_files):
+        copy(
+            (source_path_T1 + pv_prefix + "/" + en),
+            (destination_path_T1 + pv_prefix + "_" + out),
+        )
 
     # Make key pvcorr perfusion summary results more prominent in /T1w/ASL/
     pv_txt_files = [
@@ -194,6 +207,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
 
     # Make key perfusion and arrival CIFTI files more prominent in /MNINonLinear/ASL/
     cifti_files = ["perfusion_calib_Atlas*.dscalar.nii", "arrival_Atlas*.dscalar.nii"]
+    stats_cmds, moves = [], []
     for b in cifti_files:
         fname = [Path(f).name for f in glob(source_path_MNI + b)]
         for f in fname:
@@ -208,8 +222,7 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
                 ">",
                 destination_path_MNI + f"{stem}_mean_nonzero.txt",
             ]
-            cmd = " ".join(cmd)
-            sp_run(cmd, shell=True)
+            stats_cmds.append(" ".join(cmd))
 
             cmd = [
                 f"{os.environ['CARET7DIR']}/wb_command",
@@ -220,8 +233,15 @@ def copy_key_outputs(path, t1w_preproc, mni_raw):
                 ">",
                 destination_path_MNI + f"pvcorr_{stem}_mean_nonzero.txt",
             ]
-            cmd = " ".join(cmd)
-            sp_run(cmd, shell=True)
-
-            move((source_path_MNI + f), (destination_path_MNI + f))
-            move((source_path_MNI_pv + f), destination_path_MNI + pv_prefix + "_" + f)
+            stats_cmds.append(" ".join(cmd))
+
+            moves.append(((source_path_MNI + f), (destination_path_MNI + f)))
+            moves.append(
+                (
+                    (source_path_MNI_pv + f),
+                    destination_path_MNI + pv_prefix + "_" + f,
+                )
+            )
+    sp_run_many(stats_cmds, cores=cores, shell=True)
+    for src, dst in moves:
+        move(src, dst)
@@ -0,0 +1,196 @@
+"""
+Motion estimation of the ASL series with mcflirt.
+
+mcflirt registers every volume of the series to a fixed reference
+image, but does so one volume at a time. Here the series is instead
+split into groups of consecutive volumes which are registered by
+concurrent mcflirt runs, and their outputs are merged back into the
+layout of a single run: one MAT_nnnn file per volume in a .mat
+directory, one line per volume in the .par file and the registered
+series.
+
+`refine_mcflirt` instead refines existing estimates, such as those of
+an earlier mcflirt run on a less corrected version of the series: each
+volume is registered by flirt starting from its earlier transform,
+without flirt's initial search and only at its finer scales.
+"""
+
+import logging
+import shutil
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+
+from hcpasl import pgzip
+from hcpasl.utils import atomic_save, get_package_data_name, sp_run_many
+
+# flirt options matching the 6 DOF, normalised correlation registrations
+# made by mcflirt
+REFINE_OPTIONS = ["-dof", "6", "-cost", "normcorr"]
+# flirt schedule of the refinement, which skips the search and the 8mm
+# and 1mm optimisations of flirt's default schedule
+REFINE_SCHEDULE = "moco_refine.sch"
+
+
+def _chunk_bounds(n_volumes, n_chunks):
+    """Start and end of each of `n_chunks` groups of consecutive volumes"""
+    bounds = np.linspace(0, n_volumes, n_chunks + 1).round().astype(int)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def run_mcflirt(src, reffile, out, mats_dir, cores=1, stages=4):
+    """
+    Register each volume of a series to a reference image with mcflirt,
+    running groups of volumes concurrently.
+
+    Parameters
+    ----------
+    src : hcpasl.utils.ImagePath
+        Series to register.
+    reffile : pathlib.Path
+        Reference image.
+    out : pathlib.Path
+        Location of the registered series. mcflirt's motion parameters
+        are saved alongside it as {`out`}.par.
+    mats_dir : pathlib.Path
+        Directory in which to save the registration of each volume,
+        as mcflirt's MAT_0000, MAT_0001, ...
+    cores : int, optional
+        Number of mcflirt runs to make at once. Default is 1.
+    stages : int, optional
+        Number of mcflirt's search stages. Default is 4.
+    """
+    out, mats_dir = Path(out), Path(mats_dir)
+    work_dir = out.parent / f".{out.name}.chunks"
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+
+    n_volumes = src.img.shape[3]
+    chunks = _chunk_bounds(n_volumes, min(cores, n_volumes))
+    logging.info(
+        f"Registering {n_volumes} volumes to {reffile} in {len(chunks)} groups."
+    )
+    if len(chunks) == 1:
+        inputs = [src.path]
+    else:
+        # save each group from the series held in memory, uncompressed
+        # since they are only read once
+        data = np.asanyarray(src.img.dataobj)
+        inputs = [work_dir / f"chunk_{n:03d}.nii" for n in range(len(chunks))]
+        for chunk_in, (start, stop) in zip(inputs, chunks):
+            atomic_save(
+                nb.Nifti1Image(data[..., start:stop], src.img.affine, src.img.header),
+                chunk_in,
+            )
+    outputs = [work_dir / f"chunk_{n:03d}_mc" for n in range(len(chunks))]
+    cmds = [
+        [
+            "mcflirt",
+            "-in",
+            str(chunk_in),
+            "-reffile",
+            str(reffile),
+            "-out",
+            str(chunk_out),
+            "-mats",
+            "-plots",
+            "-stages",
+            str(stages),
+        ]
+        for chunk_in, chunk_out in zip(inputs, outputs)
+    ]
+    sp_run_many(cmds, cores=cores)
+
+    # merge the groups' outputs, renumbering the matrices
+    if mats_dir.exists():
+        shutil.rmtree(mats_dir)
+    mats_dir.mkdir(parents=True)
+    registered, pars = [], []
+    for chunk_out, (start, stop) in zip(outputs, chunks):
+        chunk_mats = chunk_out.with_name(f"{chunk_out.name}.mat")
+        for n in range(stop - start):
+            (chunk_mats / f"MAT_{n:04d}").replace(mats_dir / f"MAT_{start + n:04d}")
+        pars.append(chunk_out.with_name(f"{chunk_out.name}.par").read_text())
+        (chunk_img,) = work_dir.glob(f"{chunk_out.name}.nii*")
+        chunk_img = nb.load(chunk_img)
+        registered.append(np.asanyarray(chunk_img.dataobj))
+    out.with_name(f"{out.name}.par").write_text("".join(pars))
+    registered = np.concatenate(registered, axis=-1)
+    pgzip.save_image(
+        nb.Nifti1Image(registered, chunk_img.affine, chunk_img.header), out
+    )
+    shutil.rmtree(work_dir)
+
+
+def refine_mcflirt(src, reffile, init_mats, mats_dir, cores=1):
+    """
+    Refine the registration of each volume of a series to a reference
+    image, starting from an earlier estimate.
+
+    Each volume is registered with flirt, initialised with its earlier
+    transform. The schedule `REFINE_SCHEDULE` skips flirt's search over
+    rotations, which mcflirt's first stages would otherwise repeat from
+    identity, and its coarsest and finest scales, so that each volume
+    is only optimised at 4mm and 2mm.
+
+    Parameters
+    ----------
+    src : hcpasl.utils.ImagePath
+        Series to register.
+    reffile : pathlib.Path
+        Reference image.
+    init_mats : pathlib.Path
+        mcflirt .mat directory of earlier estimates, one per volume of
+        `src`.
+    mats_dir : pathlib.Path
+        Directory in which to save the refined registrations, as
+        mcflirt's MAT_0000, MAT_0001, ...
+    cores : int, optional
+        Number of flirt runs to make at once. Default is 1.
+    """
+    init_mats, mats_dir = Path(init_mats), Path(mats_dir)
+    work_dir = mats_dir.parent / f".{mats_dir.name}.volumes"
+    if work_dir.exists():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+
+    data = np.asanyarray(src.img.dataobj)
+    n_volumes = data.shape[3]
+    if len(list(init_mats.glob("MAT_*"))) != n_volumes:
+        raise ValueError(
+            f"{init_mats} does not hold a transform for each of {n_volumes} volumes."
+        )
+    logging.info(f"Refining the registration of {n_volumes} volumes to {reffile}.")
+    schedule = get_package_data_name(REFINE_SCHEDULE)
+    volumes = [work_dir / f"vol_{n:04d}.nii" for n in range(n_volumes)]
+    for n, volume in enumerate(volumes):
+        atomic_save(
+            nb.Nifti1Image(data[..., n], src.img.affine, src.img.header), volume
+        )
+    cmds = [
+        [
+            "flirt",
+            "-in",
+            str(volume),
+            "-ref",
+            str(reffile),
+            "-init",
+            str(init_mats / f"MAT_{n:04d}"),
+            "-omat",
+            str(work_dir / f"MAT_{n:04d}"),
+            *REFINE_OPTIONS,
+            "-schedule",
+            str(schedule),
+        ]
+        for n, volume in enumerate(volumes)
+    ]
+    sp_run_many(cmds, cores=cores)
+
+    if mats_dir.exists():
+        shutil.rmtree(mats_dir)
+    mats_dir.mkdir(parents=True)
+    for n in range(n_volumes):
+        (work_dir / f"MAT_{n:04d}").replace(mats_dir / f"MAT_{n:04d}")
+    shutil.rmtree(work_dir)
@@ -0,0 +1,193 @@
+"""
+Parallel gzip codec for compressed NIfTI images.
+
+nibabel compresses and decompresses .nii.gz files in a single thread.
+Here the serialised image is instead split into blocks which are
+deflated concurrently, zlib releasing the GIL while it works, and
+written one after another as the members of a multi-member gzip file.
+Any gzip reader, nibabel and FSL included, reads such a file as the
+concatenation of its members.
+
+Each member's header records the member's compressed size in an extra
+field, so that `load_image` can find every member without inflating
+the file first and inflate them concurrently too. Files without the
+field, such as those written by other programs, are decompressed in a
+single thread.
+"""
+
+import gzip
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import nibabel as nb
+
+# uncompressed bytes in each gzip member
+BLOCK_SIZE = 1024**2
+# nibabel's default compression level
+COMPRESS_LEVEL = 1
+
+# extra field subfield holding the member's total size in bytes
+_SUBFIELD_ID = b"HA"
+_EXTRA = struct.Struct("<2sHI")
+_HEADER = struct.Struct("<BBBBIBBH")
+_TRAILER = struct.Struct("<II")
+
+_threads = 1
+
+
+def set_threads(threads):
+    """Number of threads used to compress and decompress each image"""
+    global _threads
+    _threads = max(int(threads), 1)
+
+
+def _map(func, items, threads):
+    if threads is None:
+        threads = _threads
+    if threads == 1 or len(items) == 1:
+        return list(map(func, items))
+    with ThreadPoolExecutor(threads, thread_name_prefix="pgzip") as pool:
+        return list(pool.map(func, items))
+
+
+def _member(block, level=COMPRESS_LEVEL):
+    """A gzip member holding `block`"""
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(block) + deflate.flush()
+    size = _HEADER.size + _EXTRA.size + len(body) + _TRAILER.size
+    # ID1, ID2, CM=deflate, FLG=FEXTRA, MTIME, XFL, OS=unknown, XLEN
+    header = _HEADER.pack(0x1F, 0x8B, 8, 4, 0, 0, 255, _EXTRA.size)
+    extra = _EXTRA.pack(_SUBFIELD_ID, 4, size)
+    trailer = _TRAILER.pack(zlib.crc32(block), len(block) & 0xFFFFFFFF)
+    return header + extra + body + trailer
+
+
+def compress(data, threads=None):
+    """
+    Compress `data` as a multi-member gzip stream.
+
+    Parameters
+    ----------
+    data : bytes-like
+        Data to compress.
+    threads : int, optional
+        Number of threads to use. Default is the number set by
+        `set_threads`.
+
+    Returns
+    -------
+    bytes
+    """
+    view = memoryview(data).cast("B")
+    blocks = [view[i : i + BLOCK_SIZE] for i in range(0, len(view), BLOCK_SIZE)]
+    return b"".join(_map(_member, blocks or [view], threads))
+
+
+def _member_sizes(data):
+    """Sizes of the members of `data`, or None if not written by `compress`"""
+    sizes, offset = [], 0
+    while offset < len(data):
+        try:
+            *magic, flags, _, _, _, xlen = _HEADER.unpack_from(data, offset)
+            subfield, length, size = _EXTRA.unpack_from(data, offset + _HEADER.size)
+        except struct.error:
+            return None
+        if (
+            magic != [0x1F, 0x8B, 8]
+            or flags != 4
+            or xlen != _EXTRA.size
+            or subfield != _SUBFIELD_ID
+            or length != 4
+        ):
+            return None
+        sizes.append(size)
+        offset += size
+    return sizes if offset == len(data) else None
+
+
+def _inflate(member):
+    return zlib.decompress(member, 16 + zlib.MAX_WBITS)
+
+
+def decompress(data, threads=None):
+    """
+    Decompress a gzip stream, in parallel if it was written by `compress`.
+
+    Parameters
+    ----------
+    data : bytes
+        Compressed data.
+    threads : int, optional
+        Number of threads to use. Default is the number set by
+        `set_threads`.
+
+    Returns
+    -------
+    bytes
+    """
+    sizes = _member_sizes(data)
+    if sizes is None:
+        return gzip.decompress(data)
+    view, members, offset = memoryview(data), [], 0
+    for size in sizes:
+        members.append(view[offset : offset + size])
+        offset += size
+    return b"".join(_map(_inflate, members, threads))
+
+
+def save_image(img, path, threads=None):
+    """
+    Save a nibabel image, compressing it in parallel if `path` ends in .gz.
+
+    Parameters
+    ----------
+    img : nibabel.nifti1.Nifti1Image
+        Image to save.
+    path : pathlib.Path or str
+        Location to save it.
+    threads : int, optional
+        Number of threads to use. Default is the number set by
+        `set_threads`.
+    """
+    path = Path(path)
+    if path.suffix != ".gz":
+        nb.save(img, path)
+        return
+    if not isinstance(img, nb.Nifti1Image):
+        img = nb.Nifti1Image.from_image(img)
+    path.write_bytes(compress(img.to_bytes(), threads))
+
+
+def load_image(path, threads=None):
+    """
+    Load a nibabel image, decompressing it in parallel if `path` ends
+    in .gz. Unlike `nibabel.load`, the image's data is read into memory.
+
+    Parameters
+    ----------
+    path : pathlib.Path or str
+        Location of the image.
+    threads : int, optional
+        Number of threads to use. Default is the number set by
+        `set_threads`.
+
+    Returns
+    -------
+    nibabel.nifti1.Nifti1Image
+    """
+    path = Path(path)
+    if path.suffix != ".gz":
+        return nb.load(path)
+    return nb.Nifti1Image.from_bytes(decompress(path.read_bytes(), threads))
+
+
+def save_like(ref, data, path, threads=None):
+    """
+    Save `data` in the voxel grid of the image `ref`, like
+    `regtricks.ImageSpace.save_like`, compressing it in parallel.
+    """
+    import regtricks as rt
+
+    save_image(rt.ImageSpace(ref).make_nifti(data), path, threads)
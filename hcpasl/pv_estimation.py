@@ -12,6 +12,8 @@ import numpy as np
 import regtricks as rt
 import scipy
 
+from hcpasl import pgzip
+
 # Map from FS aparc+aseg labels to tissue types
 # NB cortex is ignored
 FS_LUT = {
@@ -125,10 +127,13 @@ def generate_ventricle_mask(aparc_aseg, t1_asl):
     return output
 
 
-def run_pv_estimation(subject_dir, cores, outdir, interpolation):
+def run_pv_estimation(subject_dir, cores, outdir, interpolation, work_dir=None):
+    # the pipeline's outputs may be held outside the subject's directory
+    if work_dir is None:
+        work_dir = op.join(subject_dir, outdir)
     t1_dir = op.join(subject_dir, "T1w")
-    t1_asl_dir = op.join(subject_dir, outdir, "T1w", "ASL")
-    asl = op.join(subject_dir, outdir, "ASL/label_control/label_control.nii.gz")
+    t1_asl_dir = op.join(work_dir, "T1w", "ASL")
+    asl = op.join(work_dir, "ASL/label_control/label_control.nii.gz")
     struct = op.join(t1_dir, "T1w_acpc_dc_restore.nii.gz")
 
     # Create ASL-gridded version of T1 image
@@ -144,14 +149,14 @@ def run_pv_estimation(subject_dir, cores, outdir, interpolation):
     )
 
     # Create PVEs directory
-    pve_dir = op.join(subject_dir, outdir, "T1w", "ASL", "pvs")
+    pve_dir = op.join(work_dir, "T1w", "ASL", "pvs")
     os.makedirs(pve_dir, exist_ok=True)
 
     # Create a ventricle CSF mask in T1 ASL space
     ventricle_mask = op.join(pve_dir, "vent_csf_mask.nii.gz")
     aparc_aseg = op.join(t1_dir, "aparc+aseg.nii.gz")
     vmask = generate_ventricle_mask(aparc_aseg, t1_asl_grid)
-    rt.ImageSpace.save_like(t1_asl_grid, vmask.astype(np.int32), ventricle_mask)
+    pgzip.save_like(t1_asl_grid, vmask.astype(np.int32), ventricle_mask)
 
     # Estimate PVs in ASL0 space then register them to ASLT1w space
     # Yes this seems stupid but theres a good reason for it
@@ -170,7 +175,7 @@ def run_pv_estimation(subject_dir, cores, outdir, interpolation):
     fileroot = op.join(pve_dir, "pv")
     for idx, suffix in enumerate(["GM", "WM"]):
         p = "{}_{}.nii.gz".format(fileroot, suffix)
-        rt.ImageSpace.save_like(t1_asl_grid, pvs_stacked.dataobj[..., idx], p)
+        pgzip.save_like(t1_asl_grid, pvs_stacked.dataobj[..., idx], p)
 
 
 def main():
@@ -6,10 +6,15 @@ from string import Template
 
 import regtricks as rt
 
-from hcpasl.utils import get_package_data_name, get_roi_stats_script, sp_run
+from hcpasl.utils import (
+    get_package_data_name,
+    get_roi_stats_script,
+    sp_run,
+    sp_run_many,
+)
 
 #Set regname to "MSMAll" if used
-def create_qc_report(subject_id, subject_dir, outdir, regname="None"):
+def create_qc_report(subject_id, subject_dir, outdir, regname="None", cores=1):
     if not outdir:
         outdir = subject_dir
     else:
@@ -53,6 +58,7 @@ def create_qc_report(subject_id, subject_dir, outdir, regname="None"):
     wb_cmd = os.environ["CARET7DIR"] + "/wb_command"
     snapdir = scene_final.parent / f"snapshots"
     snapdir.mkdir(exist_ok=True)
+    cmds = []
     for idx in range(1, 8):
         png = snapdir / f"{subject_id}_hcp_asl_qc.wb_scene{idx}.png"
         cmd = [
@@ -65,7 +71,8 @@ def create_qc_report(subject_id, subject_dir, outdir, regname="None"):
             "100",
             "-use-window-size",
         ]
-        sp_run(cmd)
+        cmds.append(cmd)
+    sp_run_many(cmds, cores=cores)
 
 
 def roi_stats(
@@ -0,0 +1,265 @@
+"""
+Vectorised fit of the saturation recovery model.
+
+An in-process alternative to running Fabber's `satrecov` model, first
+without and then with spatial priors, in
+`hcpasl.asl_correction.fit_satrecov_model`. The model
+
+    S(t) = M0t * (1 - exp(-t / T1t))
+
+is fitted to the control images of every voxel at once, t being the
+time at which the voxel's slice was acquired in each volume. Given
+T1t the model is linear in M0t, so each voxel's fit starts from the
+best of a grid of T1t values with M0t profiled out, and is then
+refined by damped Gauss-Newton steps on both parameters together.
+
+The spatial fit stands in for Fabber's spatial VB prior: each voxel's
+T1t is given a Gaussian prior centred on the mean T1t of its face
+neighbours, whose variance is learnt from the current estimates in the
+way Fabber learns its spatial precision.
+"""
+
+import logging
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+from scipy.ndimage import convolve
+
+from hcpasl import pgzip
+from hcpasl.timing import MBPCASL
+from hcpasl.trace import span
+from hcpasl.utils import DTYPE, intermediate_path
+
+# ways of fitting the model in fit_satrecov_model
+FITTERS = ("fabber", "numpy")
+
+# T1t values, in s, from which each voxel's fit is started
+T1_GRID = np.geomspace(0.2, 5.0, 48)
+# range to which T1t estimates are limited, in s
+T1_BOUNDS = (0.05, 10.0)
+# Gauss-Newton iterations of the voxelwise fit
+N_ITER = 10
+# rounds of spatial regularisation, and Gauss-Newton iterations in each
+N_SPATIAL = 5
+N_SPATIAL_ITER = 3
+# Levenberg-Marquardt damping of each Gauss-Newton step
+DAMPING = 1e-3
+# times a step which does not reduce the cost is halved
+MAX_HALVINGS = 4
+
+# face neighbours of a voxel
+_NEIGHBOURS = np.zeros((3, 3, 3))
+_NEIGHBOURS[[0, 2, 1, 1, 1, 1], [1, 1, 0, 2, 1, 1], [1, 1, 1, 1, 0, 2]] = 1
+
+
+def _recovery(t, t1):
+    """1 - exp(-t / t1) and its derivative with respect to t1"""
+    decay = np.exp(-t / t1[:, None])
+    return 1 - decay, -t * decay / t1[:, None] ** 2
+
+
+class _VoxelData:
+    """
+    Signal and acquisition times of the voxels being fitted.
+
+    Control images acquired at the same TI share their acquisition
+    times, so the fit only needs each voxel's sum of squares and its
+    sum of the signal at each TI.
+    """
+
+    def __init__(self, control, timing, mask):
+        # the TI at which each control image was acquired
+        pair_ti = timing.volume_ti_index[0::2]
+        if control.shape[2:] != (timing.n_slices, len(pair_ti)):
+            raise ValueError(
+                f"Control images of shape {control.shape} do not match "
+                f"{len(pair_ti)} label-control pairs of {timing.n_slices} slices."
+            )
+        self.mask = mask
+        signal = control[mask].astype(np.float64)
+        self.n_images = signal.shape[1]
+        self.sum_sq = (signal**2).sum(axis=1)
+        self.sums = np.stack(
+            [signal[:, pair_ti == ti].sum(axis=1) for ti in range(len(timing.tis))],
+            axis=-1,
+        )
+        self.counts = np.bincount(pair_ti, minlength=len(timing.tis))
+        # slices within a band share their times, so group voxels by them
+        times = timing.slice_times[0, 0].astype(np.float64)
+        self.times, slice_group = np.unique(times, axis=0, return_inverse=True)
+        self.group = slice_group.reshape(-1)[np.nonzero(mask)[2]]
+        self.t = self.times[self.group]
+
+    def sse(self, m0, f):
+        """Residual sum of squares of the model M0t * `f`"""
+        sf = (self.sums * f).sum(axis=1)
+        ff = (self.counts * f**2).sum(axis=1)
+        return self.sum_sq - 2 * m0 * sf + m0**2 * ff
+
+    def to_volume(self, values):
+        volume = np.zeros(self.mask.shape, dtype=DTYPE)
+        volume[self.mask] = values
+        return volume
+
+
+def _grid_start(data):
+    """Best T1t of T1_GRID for each voxel, with M0t profiled out"""
+    t1 = np.empty(len(data.sums))
+    for group, times in enumerate(data.times):
+        in_group = data.group == group
+        f = -np.expm1(-times[None, :] / T1_GRID[:, None])
+        sf = data.sums[in_group] @ f.T
+        # reduction in the residual sum of squares, for a positive M0t
+        score = sf * np.abs(sf) / (data.counts * f**2).sum(axis=1)
+        t1[in_group] = T1_GRID[np.argmax(score, axis=1)]
+    f, _ = _recovery(data.t, t1)
+    m0 = (data.sums * f).sum(axis=1) / (data.counts * f**2).sum(axis=1)
+    return m0, t1
+
+
+def _refine(data, m0, t1, n_iter, noise_var=1.0, prior_mean=0.0, prior_prec=0.0):
+    """
+    Damped Gauss-Newton minimisation of each voxel's cost
+
+        sum((S - M0t * f(T1t))**2) / noise_var + prior_prec * (T1t - prior_mean)**2
+
+    Steps which do not reduce a voxel's cost are halved, and that voxel
+    is left unchanged if none of them do.
+    """
+    counts, sums = data.counts, data.sums
+
+    def cost(m0, t1):
+        f, _ = _recovery(data.t, t1)
+        return data.sse(m0, f) / noise_var + prior_prec * (t1 - prior_mean) ** 2
+
+    current = cost(m0, t1)
+    for _ in range(n_iter):
+        f, df = _recovery(data.t, t1)
+        j = m0[:, None] * df
+        # residuals summed over the images at each TI
+        r = sums - counts * m0[:, None] * f
+        a00 = (1 + DAMPING) * (counts * f**2).sum(axis=1) / noise_var
+        a01 = (counts * f * j).sum(axis=1) / noise_var
+        a11 = (1 + DAMPING) * ((counts * j**2).sum(axis=1) / noise_var + prior_prec)
+        g0 = (f * r).sum(axis=1) / noise_var
+        g1 = (j * r).sum(axis=1) / noise_var - prior_prec * (t1 - prior_mean)
+        det = a00 * a11 - a01**2
+        solvable = det > 0
+        det[~solvable] = 1
+        d_m0 = np.where(solvable, (a11 * g0 - a01 * g1) / det, 0)
+        d_t1 = np.where(solvable, (a00 * g1 - a01 * g0) / det, 0)
+
+        pending, step = solvable, 1.0
+        for _ in range(MAX_HALVINGS):
+            trial_m0 = m0 + step * d_m0
+            trial_t1 = np.clip(t1 + step * d_t1, *T1_BOUNDS)
+            trial = cost(trial_m0, trial_t1)
+            better = pending & (trial < current)
+            m0[better], t1[better] = trial_m0[better], trial_t1[better]
+            current[better] = trial[better]
+            pending = pending & ~better
+            if not pending.any():
+                break
+            step /= 2
+    return m0, t1
+
+
+def _regularise(data, m0, t1):
+    """Refit T1t with a prior centred on the mean T1t of its neighbours"""
+    mask = data.mask.astype(np.float64)
+    neighbours = convolve(mask, _NEIGHBOURS, mode="constant")[data.mask]
+    has_neighbours = neighbours > 0
+    dof = max(data.n_images - 2, 1)
+    for _ in range(N_SPATIAL):
+        f, _ = _recovery(data.t, t1)
+        noise_var = np.maximum(data.sse(m0, f) / dof, np.finfo(DTYPE).tiny)
+        t1_volume = data.to_volume(t1).astype(np.float64)
+        total = convolve(t1_volume, _NEIGHBOURS, mode="constant")[data.mask]
+        prior_mean = np.where(has_neighbours, total / np.maximum(neighbours, 1), t1)
+        spread = np.mean((t1 - prior_mean)[has_neighbours] ** 2)
+        if not spread > 0:
+            break
+        prior_prec = np.where(has_neighbours, 1 / spread, 0)
+        m0, t1 = _refine(
+            data, m0, t1, N_SPATIAL_ITER, noise_var, prior_mean, prior_prec
+        )
+    return m0, t1
+
+
+def fit_satrecov(control, timing=MBPCASL, mask=None, spatial=True):
+    """
+    Fit the saturation recovery model to the control images.
+
+    Parameters
+    ----------
+    control : numpy.ndarray
+        4D array of the control images, grouped by TI.
+    timing : hcpasl.timing.AcquisitionTiming, optional
+        Timing of the label-control series the control images were
+        taken from. Default is the HCP mbPCASL acquisition.
+    mask : numpy.ndarray, optional
+        3D boolean array of the voxels to fit. Default is every voxel
+        whose mean control signal is positive.
+    spatial : bool, optional
+        Whether to regularise the T1t estimates spatially, as a second
+        Fabber run with spatial priors does. Default is True.
+
+    Returns
+    -------
+    fits : dict
+        `(M0t, T1t)` 3D arrays from the voxelwise fit, under
+        "nospatial", and, if `spatial`, from the spatially regularised
+        fit under "spatial". Both are 0 outside the mask.
+    """
+    if mask is None:
+        mean = control.mean(axis=-1)
+        mask = np.isfinite(mean) & (mean > 0)
+    data = _VoxelData(control, timing, np.asarray(mask, dtype=bool))
+    logging.info(f"Fitting the satrecov model in {len(data.sums)} voxels.")
+    with span("numpy satrecov", "satrecov", method="voxelwise"):
+        m0, t1 = _refine(data, *_grid_start(data), N_ITER)
+    fits = {"nospatial": (data.to_volume(m0), data.to_volume(t1))}
+    if spatial:
+        with span("numpy satrecov", "satrecov", method="spatial"):
+            m0, t1 = _regularise(data, m0, t1)
+        fits["spatial"] = (data.to_volume(m0), data.to_volume(t1))
+    return fits
+
+
+def fit_satrecov_to_dir(control, results_dir, ref_nii, timing=MBPCASL, mask=None):
+    """
+    Fit the saturation recovery model and save its estimates as Fabber
+    would, as {`results_dir`}/{nospatial,spatial}/mean_{M0t,T1t} in the
+    intermediate image format.
+
+    Parameters
+    ----------
+    control : numpy.ndarray
+        4D array of the control images, grouped by TI.
+    results_dir : pathlib.Path
+        Parent directory for the results.
+    ref_nii : nibabel.nifti1.Nifti1Image
+        Image in the space of the control images, whose affine is used
+        to save the results.
+    timing : hcpasl.timing.AcquisitionTiming, optional
+        Timing of the label-control series. Default is the HCP
+        mbPCASL acquisition.
+    mask : numpy.ndarray, optional
+        Voxels to fit. Default is every voxel whose mean control
+        signal is positive.
+
+    Returns
+    -------
+    pathlib.Path
+        Path of the spatially regularised T1t estimate.
+    """
+    for name, (m0, t1) in fit_satrecov(control, timing, mask).items():
+        out_dir = Path(results_dir) / name
+        out_dir.mkdir(parents=True, exist_ok=True)
+        for param, volume in (("M0t", m0), ("T1t", t1)):
+            pgzip.save_image(
+                nb.Nifti1Image(volume, ref_nii.affine),
+                intermediate_path(out_dir, f"mean_{param}"),
+            )
+    return intermediate_path(Path(results_dir) / "spatial", "mean_T1t")
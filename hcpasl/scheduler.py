@@ -0,0 +1,230 @@
+"""
+Dependency-aware scheduling of pipeline stages.
+
+Each stage declares the artifacts (files or directories) it reads and
+writes. A stage becomes ready once every earlier stage that produces
+one of its inputs has finished, and ready stages are run concurrently
+within a fixed core budget. If a `StageCache` is given, stages whose
+key is unchanged since they last completed are skipped.
+
+Stages run in threads, alongside the image store's writer threads and
+the threads reading the output of external commands. Forking a process
+while other threads hold locks can deadlock the child, and regtricks
+and toblerone start worker processes with multiprocessing when given
+more than one core. `run_stages` therefore makes multiprocessing spawn
+its worker processes rather than fork them, and anything else a stage
+uses to start processes must do the same.
+"""
+
+import logging
+import multiprocessing as mp
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from hcpasl import accounting, data_cache, image_store
+from hcpasl.trace import span
+
+# how worker processes are started while stages run in threads
+START_METHOD = "spawn"
+
+
+class Stage:
+    """A numbered pipeline stage and the artifacts it reads and writes"""
+
+    def __init__(
+        self,
+        number,
+        description,
+        func,
+        inputs=(),
+        outputs=(),
+        cores=1,
+        params=None,
+        cacheable=True,
+    ):
+        """
+        Parameters
+        ----------
+        number : int
+            Stage number, used for ordering and logging.
+        description : str
+            Human-readable description of the stage.
+        func : callable
+            Called as `func(cores)` with the number of cores granted
+            to the stage by the scheduler.
+        inputs : iterable of pathlib.Path
+            Files or directories read by the stage. `None` entries
+            are ignored.
+        outputs : iterable of pathlib.Path
+            Files or directories written by the stage. `None` entries
+            are ignored.
+        cores : int, optional
+            Maximum number of cores the stage can make use of.
+            Default is 1.
+        params : dict, optional
+            Options which change the stage's results. These are part
+            of the stage's cache key.
+        cacheable : bool, optional
+            Whether a `StageCache` may skip the stage. Stages which
+            read files they do not declare as inputs must not be
+            skipped, since changes to those files would go unnoticed.
+            Default is True.
+        """
+        self.number = number
+        self.description = description
+        self.func = func
+        self.inputs = [Path(p) for p in inputs if p is not None]
+        self.outputs = [Path(p) for p in outputs if p is not None]
+        self.cores = max(int(cores), 1)
+        self.params = {} if params is None else dict(params)
+        self.cacheable = cacheable
+
+    def reads_from(self, other):
+        """Whether this stage reads an artifact written by `other`"""
+        return any(_overlaps(i, o) for i in self.inputs for o in other.outputs)
+
+    def writes_with(self, other):
+        """Whether this stage writes an artifact also written by `other`"""
+        return any(_overlaps(a, b) for a in self.outputs for b in other.outputs)
+
+    def __repr__(self):
+        return f"Stage({self.number}, {self.description!r})"
+
+
+def _overlaps(a, b):
+    """Paths refer to the same artifact or one is a directory containing the other"""
+    return a == b or a in b.parents or b in a.parents
+
+
+def stage_dependencies(stages):
+    """
+    Derive the dependencies between a set of stages.
+
+    A stage depends on an earlier stage if it reads one of its
+    outputs, writes one of its inputs or writes one of the same
+    artifacts. Stages are never reordered relative to one another
+    if they conflict in any of these ways.
+
+    Parameters
+    ----------
+    stages : list of Stage
+
+    Returns
+    -------
+    dict
+        Mapping from stage number to the set of stage numbers it
+        depends on.
+    """
+    deps = {}
+    for stage in stages:
+        deps[stage.number] = {
+            earlier.number
+            for earlier in stages
+            if earlier.number < stage.number
+            and (
+                stage.reads_from(earlier)
+                or earlier.reads_from(stage)
+                or stage.writes_with(earlier)
+            )
+        }
+    return deps
+
+
+def _run_stage(stage, cores, cache=None):
+    if not stage.cacheable:
+        cache = None
+    if cache is not None:
+        key = cache.key(stage)
+        if cache.is_current(stage, key):
+            logging.info(
+                f"Stage {stage.number} is unchanged since it last completed, "
+                f"skipping: {stage.description}"
+            )
+            return
+    logging.info(f"Stage {stage.number}: {stage.description} (cores: {cores})")
+    start = time.perf_counter()
+    with span(f"Stage {stage.number}", "stage", description=stage.description):
+        with accounting.stage(stage.number):
+            stage.func(cores)
+            image_store.wait(stage=stage.number)
+    if cache is not None:
+        cache.record(stage, key)
+    logging.info(
+        f"Stage {stage.number} finished in {time.perf_counter() - start:.1f}s."
+    )
+
+
+def run_stages(stages, cores=1, cache=None):
+    """
+    Run stages as soon as their dependencies have finished.
+
+    Ready stages are started in stage order. Each is granted up to
+    the number of cores it can use, while reserving one core for
+    every other stage that is ready at the same time. If a stage
+    fails no further stages are started, running stages are allowed
+    to finish and the first error is re-raised.
+
+    multiprocessing's default start method is set to `START_METHOD`,
+    see the module docstring.
+
+    Parameters
+    ----------
+    stages : list of Stage
+        Stages to run. Dependencies on stages not in this list are
+        assumed to have been satisfied by a previous run.
+    cores : int, optional
+        Total number of cores shared by concurrently running stages.
+        Default is 1, in which case stages run one at a time in order.
+    cache : hcpasl.cache.StageCache, optional
+        If provided, cacheable stages are skipped if their key is
+        unchanged since they last completed and their outputs are
+        intact, and each such stage's key is recorded once it
+        completes.
+    """
+    cores = max(int(cores), 1)
+    # libraries which start worker processes use the default start method
+    if mp.get_start_method(allow_none=True) != START_METHOD:
+        mp.set_start_method(START_METHOD, force=True)
+    stages = sorted(stages, key=lambda s: s.number)
+    deps = stage_dependencies(stages)
+    for stage in stages:
+        logging.info(
+            f"Stage {stage.number} waits for stages: {sorted(deps[stage.number])}"
+        )
+
+    pending, running, done = list(stages), {}, set()
+    free, error = cores, None
+    with ThreadPoolExecutor(max_workers=cores) as pool:
+        while pending or running:
+            if error is None:
+                ready = [s for s in pending if deps[s.number] <= done]
+                for n, stage in enumerate(ready):
+                    if free < 1:
+                        break
+                    reserve = min(len(ready) - n - 1, free - 1)
+                    granted = max(min(stage.cores, free - reserve), 1)
+                    pending.remove(stage)
+                    free -= granted
+                    running[pool.submit(_run_stage, stage, granted, cache)] = (
+                        stage,
+                        granted,
+                    )
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, granted = running.pop(future)
+                free += granted
+                try:
+                    future.result()
+                except BaseException as e:
+                    logging.error(f"Stage {stage.number} failed.")
+                    if error is None:
+                        error = e
+                else:
+                    done.add(stage.number)
+    if error is not None:
+        raise error
+    image_store.wait()
+    data_cache.log_stats()
@@ -0,0 +1,167 @@
+"""
+Node-local scratch space for a subject's intermediate files.
+
+A `Workspace` mirrors the subject's output directory on local disk
+(or tmpfs). Stages run in the workspace write every intermediate
+there: only the artifacts a stage declares as outputs, which are the
+ones read by later stages and by `copy_key_outputs`, are copied back
+to the shared output directory when it finishes. Declared inputs
+found in the shared directory but not in the workspace, for example
+the outputs of stages run previously, are copied in before it starts.
+"""
+
+import logging
+import os
+import threading
+from pathlib import Path
+from shutil import copy2, rmtree
+
+from hcpasl import accounting, image_store
+from hcpasl.scheduler import Stage
+from hcpasl.trace import span
+
+
+def _files(path):
+    """Files within `path`, or `path` itself if it is a file"""
+    if path.is_dir():
+        return sorted(p for p in path.rglob("*") if p.is_file())
+    return [path]
+
+
+def sync(src, dst):
+    """
+    Copy the file or directory `src` to `dst`, skipping files whose
+    copy is already up to date.
+
+    Files are copied with their modification times, so a copy is
+    taken to be up to date if its size and modification time match.
+    Each file is written to a temporary name and renamed into place.
+
+    Returns
+    -------
+    int
+        Number of bytes copied.
+    """
+    src, dst = Path(src), Path(dst)
+    copied = 0
+    for f in _files(src):
+        target = dst / f.relative_to(src) if src.is_dir() else dst
+        st = f.stat()
+        try:
+            existing = target.stat()
+            if (existing.st_size, existing.st_mtime_ns) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                continue
+        except FileNotFoundError:
+            pass
+        target.parent.mkdir(exist_ok=True, parents=True)
+        tmp = target.with_name(
+            f".{os.getpid()}_{threading.get_native_id()}_{target.name}"
+        )
+        copy2(f, tmp)
+        os.replace(tmp, target)
+        copied += st.st_size
+    return copied
+
+
+class Workspace:
+    """Local mirror of a subject's shared output directory"""
+
+    def __init__(self, shared_dir, local_dir):
+        """
+        Parameters
+        ----------
+        shared_dir : pathlib.Path
+            The subject's output directory, $subject_dir/$outdir.
+        local_dir : pathlib.Path
+            Directory on local storage in which to mirror it. This is
+            created if it does not exist.
+        """
+        self.shared_dir = Path(shared_dir)
+        self.local_dir = Path(local_dir)
+        self.local_dir.mkdir(exist_ok=True, parents=True)
+
+    def local(self, path):
+        """Path of `path` in the workspace, if it is in the shared directory"""
+        path = Path(path)
+        if path == self.shared_dir or self.shared_dir in path.parents:
+            return self.local_dir / path.relative_to(self.shared_dir)
+        return path
+
+    def shared(self, path):
+        """Path of `path` in the shared directory, if it is in the workspace"""
+        path = Path(path)
+        if path == self.local_dir or self.local_dir in path.parents:
+            return self.shared_dir / path.relative_to(self.local_dir)
+        return path
+
+    def stage_in(self, paths):
+        """Copy artifacts in the shared directory into the workspace"""
+        copied = 0
+        with span("stage in", "io"):
+            for path in paths:
+                local = self.local(path)
+                if local != path and path.exists():
+                    copied += sync(path, local)
+        if copied:
+            logging.info(f"Copied {copied / 1024**2:.1f} MB into {self.local_dir}")
+
+    def stage_out(self, paths):
+        """Copy artifacts in the workspace back to the shared directory"""
+        copied = 0
+        with span("stage out", "io"):
+            for path in paths:
+                local = self.local(path)
+                if local == path:
+                    continue
+                if not local.exists():
+                    logging.info(f"{local} was not written, not copying it back.")
+                    continue
+                copied += sync(local, path)
+        logging.info(f"Copied {copied / 1024**2:.1f} MB back to {self.shared_dir}")
+
+    def stage(self, stage, local=True):
+        """
+        Adapt a stage declared with paths in the workspace.
+
+        Parameters
+        ----------
+        stage : hcpasl.scheduler.Stage
+            Stage whose inputs and outputs may be given as paths in
+            the workspace.
+        local : bool, optional
+            Whether the stage itself works in the workspace. If so,
+            its inputs are copied in before it runs and its outputs
+            are copied back once it finishes. Default is True.
+
+        Returns
+        -------
+        hcpasl.scheduler.Stage
+            The stage with its inputs and outputs declared by their
+            paths in the shared directory.
+        """
+        inputs = [self.shared(p) for p in stage.inputs]
+        outputs = [self.shared(p) for p in stage.outputs]
+
+        def run_locally(cores):
+            self.stage_in(inputs)
+            stage.func(cores)
+            image_store.wait(stage=accounting.current_stage())
+            self.stage_out(outputs)
+
+        return Stage(
+            stage.number,
+            stage.description,
+            run_locally if local else stage.func,
+            inputs=inputs,
+            outputs=outputs,
+            cores=stage.cores,
+            params=stage.params,
+            cacheable=stage.cacheable,
+        )
+
+    def remove(self):
+        """Delete the workspace and everything in it"""
+        rmtree(self.local_dir, ignore_errors=True)
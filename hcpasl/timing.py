@@ -0,0 +1,129 @@
+"""
+Timing of the mbPCASL acquisition.
+
+The time at which a voxel is acquired depends only on its volume's TI
+and its slice's position within its band, so an `AcquisitionTiming`
+holds compact per-volume and per-slice tables which broadcast against
+4D images. Voxelwise timing images are only built when an image is
+needed, for example to be registered or to be passed to oxford_asl
+with --tiimg.
+"""
+
+import numpy as np
+
+from hcpasl.utils import (
+    DTYPE,
+    NSLICES,
+    RPTS,
+    SLICEBAND,
+    SLICEDT,
+    TIS,
+    slice_times,
+)
+
+
+class AcquisitionTiming:
+    """TIs, repeats and slice timing of a multi-band, multi-TI ASL series"""
+
+    def __init__(
+        self,
+        tis=TIS,
+        rpts=RPTS,
+        slicedt=SLICEDT,
+        sliceband=SLICEBAND,
+        n_slices=NSLICES,
+        iaf="tc",
+    ):
+        """
+        Parameters
+        ----------
+        tis : list
+            TIs of the acquisition, in s.
+        rpts : list
+            Number of label-control pairs acquired at each TI. The
+            series is grouped by TI, as `IBF` "tis".
+        slicedt : float
+            Time taken to acquire each slice, in s.
+        sliceband : int
+            Number of slices in each band.
+        n_slices : int
+            Number of slices.
+        iaf : {"tc", "ct"}
+            Whether each pair starts with its label (tag) or control.
+        """
+        if len(rpts) != len(tis):
+            raise ValueError(f"Repeats {rpts} do not match TIs {tis}.")
+        self.tis = np.asarray(tis, dtype=DTYPE)
+        self.rpts = list(rpts)
+        self.slicedt = slicedt
+        self.sliceband = sliceband
+        self.n_slices = n_slices
+        self.iaf = iaf
+
+        # index into `tis` of the TI of each volume
+        self.volume_ti_index = np.repeat(np.arange(len(tis)), 2 * np.array(rpts))
+        # TI of each volume
+        self.volume_tis = self.tis[self.volume_ti_index]
+        # (1, 1, n_slices, len(tis)) acquisition time of each slice at each TI
+        self.slice_times = slice_times(tis, slicedt, sliceband, n_slices)
+
+    @property
+    def n_volumes(self):
+        return len(self.volume_ti_index)
+
+    @property
+    def label_control_weights(self):
+        """
+        Weight of the perfusion signal in each volume: -0.5 for label
+        images and 0.5 for control images.
+        """
+        weights = np.full(self.n_volumes, 0.5, dtype=DTYPE)
+        first = 0 if self.iaf == "tc" else 1
+        weights[first::2] = -0.5
+        return weights
+
+    def volume_times(self, per_volume=True):
+        """
+        Acquisition time of each slice of each volume.
+
+        Parameters
+        ----------
+        per_volume : bool, optional
+            If False, give one time per TI rather than per volume.
+            Default is True.
+
+        Returns
+        -------
+        numpy.ndarray
+            Array of shape (1, 1, n_slices, n) which broadcasts against
+            a 4D image of n volumes.
+        """
+        if per_volume:
+            return self.slice_times[..., self.volume_ti_index]
+        return self.slice_times
+
+    def ti_image(self, space, per_volume=True):
+        """
+        Voxelwise image of the acquisition time of each voxel.
+
+        Parameters
+        ----------
+        space : regtricks.ImageSpace
+            Voxel grid of the acquisition.
+        per_volume : bool, optional
+            If False, the image has one volume per TI rather than one
+            per volume of the series. Default is True.
+
+        Returns
+        -------
+        nibabel.nifti1.Nifti1Image
+        """
+        times = self.volume_times(per_volume)
+        size = tuple(space.size)
+        if size[2] != self.n_slices:
+            raise ValueError(f"{size} does not have {self.n_slices} slices.")
+        return space.make_nifti(np.broadcast_to(times, size + times.shape[-1:]))
+
+
+# timing of the HCP Lifespan mbPCASL acquisition
+MBPCASL = AcquisitionTiming()
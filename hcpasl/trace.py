@@ -0,0 +1,129 @@
+"""
+Timeline of a pipeline run in Chrome's trace-event format.
+
+Once `start_trace()` has been called, every `span()` records a
+complete ("X") event with the process and thread it ran on. The
+events are written by `save_trace()` to a json file which can be
+opened in chrome://tracing or https://ui.perfetto.dev to see how
+stages and the steps within them overlap and nest.
+
+When no trace has been started, `span()` does nothing.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+_tracer = None
+
+
+class Tracer:
+    """Collects trace events from every thread of the process"""
+
+    def __init__(self):
+        self.start = time.perf_counter_ns()
+        self.events = []
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, cat, start, end, args):
+        tid = threading.get_native_id()
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.start) / 1000,
+            "dur": (end - start) / 1000,
+            "pid": os.getpid(),
+            "tid": tid,
+            "args": {k: str(v) for k, v in args.items()},
+        }
+        with self._lock:
+            self.events.append(event)
+            self.threads[tid] = threading.current_thread().name
+
+    def to_json(self):
+        with self._lock:
+            metadata = [
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": os.getpid(),
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+                for tid, name in self.threads.items()
+            ]
+            return {"traceEvents": metadata + self.events, "displayTimeUnit": "ms"}
+
+
+@contextmanager
+def span(name, cat="hcpasl", **args):
+    """
+    Record the time spent in the body of the `with` statement.
+
+    Parameters
+    ----------
+    name : str
+        Name of the event shown on the timeline.
+    cat : str, optional
+        Category of the event, used to filter the timeline.
+    **args
+        Extra details shown when the event is selected.
+    """
+    tracer = _tracer
+    if tracer is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        tracer.add(name, cat, start, time.perf_counter_ns(), args)
+
+
+def traced(name, cat="hcpasl"):
+    """Decorator which records each call of a function as a span"""
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, cat):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _trace_regtricks():
+    """Record regtricks' resampling of images and arrays"""
+    try:
+        import regtricks as rt
+    except ImportError:
+        return
+    for method in ("apply_to_image", "apply_to_array"):
+        for cls in rt.Registration.__mro__:
+            func = cls.__dict__.get(method)
+            if func is not None and not hasattr(func, "__wrapped__"):
+                setattr(cls, method, traced(f"regtricks.{method}", "regtricks")(func))
+
+
+def start_trace():
+    """Start recording spans from every thread of the process"""
+    global _tracer
+    _trace_regtricks()
+    _tracer = Tracer()
+
+
+def save_trace(path):
+    """Write the spans recorded since `start_trace()` to `path`"""
+    if _tracer is None:
+        raise RuntimeError("start_trace() must be called before save_trace().")
+    with open(path, "w") as f:
+        json.dump(_tracer.to_json(), f)
+    logging.info(f"Trace of {len(_tracer.events)} events written to {path}")
@@ -3,18 +3,23 @@ import logging
 import os
 import shutil
 import subprocess
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import threading
+import time
 from importlib.resources import path as resource_path
 from pathlib import Path
 
 import numpy as np
 import nibabel as nb
-from fsl.data import atlases
-from fsl.data.image import Image
-from fsl.wrappers import LOAD, fslmaths, fslroi
-from fsl.wrappers.fnirt import applywarp, invwarp
-from fsl.wrappers.misc import fslroi
 
 from . import resources
+from . import accounting
+from . import data_cache
+from . import image_store
+from . import pgzip
+from .accounting import command_name, record_usage
+from .trace import span
 
 # ASL sequence parameters
 ASL_SHAPE = (86, 86, 60, 86)
@@ -28,46 +33,138 @@ NSLICES = 60
 BOLUS = 1.5  # s
 TE = 19  # ms
 
+# data type in which image data is held, processed and saved throughout
+# the pipeline. float64, as nibabel's get_fdata() returns by default,
+# until float32 processing has been shown to give equivalent outputs
+# with scripts/compare_outputs.py
+DTYPE = np.float64
+
+# file extensions of the formats intermediate images can be stored in
+INTERMEDIATE_FORMATS = {"nii.gz": ".nii.gz", "nii": ".nii"}
+_intermediate_ext = INTERMEDIATE_FORMATS["nii.gz"]
+
+# bounds on the subprocess output held in memory by sp_run
+MAX_LINE_LENGTH = 4096  # characters logged per line
+TAIL_LINES = 100  # lines of stderr kept for the error message
+
+
+def set_intermediate_format(fmt):
+    """
+    Choose the format of the intermediate images written by chains of
+    corrections.
+
+    Uncompressed NIfTI takes around three times the disk space but is
+    memory-mapped when loaded, so reading part of an image does not
+    mean decompressing all of it. The pipeline's final outputs are
+    gzipped either way.
+
+    Parameters
+    ----------
+    fmt : {"nii.gz", "nii"}
+        Format to use from now on.
+    """
+    global _intermediate_ext
+    _intermediate_ext = INTERMEDIATE_FORMATS[fmt]
+
+
+def intermediate_path(dir, stem):
+    """Path of the intermediate image `stem` in `dir`"""
+    return dir / f"{stem}{_intermediate_ext}"
+
 
 class ImagePath:
     """Keep track of the name and path to an image as corrections are applied to it"""
 
     def __init__(self, path):
-        self.path = path.resolve(strict=True)
-        self.stem = self.path.stem.split(".")[0]
-        self.img = nb.load(self.path)
+        # images still held in memory by the image store are not reloaded
+        self.img, version = image_store.get(path)
+        if self.img is None:
+            self._path = path.resolve(strict=True)
+            with span("ImagePath.load", "io", path=self._path):
+                self.img = nb.load(self._path)
+            st = self._path.stat()
+            self._version = (st.st_mtime_ns, st.st_size)
+            self._on_disk = True
+        else:
+            self._path = path.resolve()
+            self._version = ("memory", version)
+            self._on_disk = False
+        self.stem = self._path.stem.split(".")[0]
+
+    @property
+    def path(self):
+        """Location of the image, once any pending write to it has finished"""
+        image_store.wait([self._path])
+        return self._path
+
+    def corrected_path(self, dir, suffix):
+        """Path of the image `correct_from_image(dir, suffix, ...)` saves"""
+        return intermediate_path(dir, f"{self.stem}_{suffix}")
 
     def correct_from_image(self, dir, suffix, newimg):
         dir.mkdir(exist_ok=True, parents=True)
-        stem = f"{self.stem}_{suffix}"
-        path = dir / f"{stem}.nii.gz"
-        data = newimg.get_fdata()
-        if data.dtype.kind == "f":
-            data = data.astype(np.float32)
-        else:
-            data = data.astype(np.int32)
+        path = self.corrected_path(dir, suffix)
+        data = newimg.get_fdata(dtype=DTYPE)
         newimg = nb.nifti1.Nifti1Image(data, affine=newimg.affine, header=newimg.header)
-        nb.save(newimg, path)
+        # save the data as held in memory rather than rescaled to the
+        # header's original data type
+        newimg.set_data_dtype(data.dtype)
+        data_cache.release(path)
+        image_store.put(path, newimg, atomic_save)
         return ImagePath(path)
 
     def correct_from_data(self, dir, suffix, newdata):
         if newdata.dtype.kind == "f":
-            newdata = newdata.astype(np.float32)
+            newdata = newdata.astype(DTYPE, copy=False)
         else:
             newdata = newdata.astype(np.int32)
         newimg = nb.nifti1.Nifti1Image(newdata, self.img.affine, header=self.img.header)
         return self.correct_from_image(dir, suffix, newimg)
 
     def save(self):
-        self.img.to_filename(self.path)
+        atomic_save(self.img, self.path)
 
     def get_fdata(self):
-        return self.img.get_fdata().astype(np.float32)
+        """
+        The image's data as a read-only array of type `DTYPE`.
+
+        The data is decoded once and cached, see `hcpasl.data_cache`,
+        until it is released or evicted.
+        """
+        return data_cache.get(self._path, self._version, self._load)
+
+    def _load(self):
+        with span("ImagePath.get_fdata", "io", path=self._path):
+            # decompress in parallel rather than through nibabel
+            img = pgzip.load_image(self._path) if self._on_disk else self.img
+            # nibabel's own cache would keep a second copy of the data
+            return img.get_fdata(dtype=DTYPE, caching="unchanged")
+
+    def release(self):
+        """Free the image's cached data once it is no longer needed"""
+        data_cache.release(self._path)
+        self.img.uncache()
 
     def __str__(self):
         return str(self.path)
 
 
+def atomic_save(img, path):
+    """
+    Save a nibabel image via a temporary file in the same directory,
+    so that `path` never holds a partially-written image.
+    """
+    path = Path(path)
+    tmp = path.with_name(f".{os.getpid()}_{threading.get_ident()}_{path.name}")
+    try:
+        with span("save", "io", path=path):
+            pgzip.save_image(img, tmp)
+            os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
 def load_json(subject_dir):
     """
     Load json but with some error-checking to make sure it exists.
@@ -126,6 +223,8 @@ def binarise(pve_name, threshold=0.5):
     to obtain a white matter segmentation from a white matter
     PVE image.
     """
+    from fsl.data.image import Image
+
     pve = Image(str(pve_name))
     seg = Image(np.where(pve.data > threshold, 1.0, 0.0), header=pve.header)
     return seg
@@ -165,6 +264,10 @@ def get_ventricular_csf_mask(fslanatdir, interpolation=3):
         Order of interpolation to use when performing registration.
         Default is 3.
     """
+    from fsl.data import atlases
+    from fsl.data.image import Image
+    from fsl.wrappers import LOAD, applywarp, fslmaths, invwarp
+
     # get ventricles mask from Harv-Ox
     atlases.rescanAtlases()
     harvox = atlases.loadAtlas("harvardoxford-subcortical", resolution=2.0)
@@ -182,17 +285,48 @@ def get_ventricular_csf_mask(fslanatdir, interpolation=3):
     return vent_t1_nii
 
 
+def split_volumes(src, outputs):
+    """
+    Save subsets of the volumes of a 4D image as separate images,
+    reading it once.
+
+    The image is decompressed once, in memory, or memory-mapped if it
+    is uncompressed, and the subsets are saved concurrently. Like
+    fslroi, each subset keeps the original image's data type.
+
+    Parameters
+    ----------
+    src : pathlib.Path
+        4D image to split.
+    outputs : dict
+        Maps the path of each image to save to the volumes it holds:
+        a slice, or an int for a single volume saved as a 3D image.
+    """
+    with span("split volumes", "io", path=src):
+        img = pgzip.load_image(src)
+        dtype = img.get_data_dtype()
+
+        def save(item):
+            path, volumes = item
+            subset = nb.Nifti1Image(
+                np.asanyarray(img.dataobj[..., volumes]), img.affine, img.header
+            )
+            subset.set_data_dtype(dtype)
+            atomic_save(subset, path)
+
+        with ThreadPoolExecutor(len(outputs), thread_name_prefix="split") as pool:
+            list(pool.map(save, outputs.items()))
+
+
 def split_asl(asl, tis_name, calib0_name, calib1_name):
     """
     Split ASL sequence into its constituent label-control series and
     calibration images (final 2 vols).
     """
-    fslroi(str(asl), str(tis_name), 0, 86)
-    fslroi(str(asl), str(calib0_name), 88, 1)
-    fslroi(str(asl), str(calib1_name), 89, 1)
+    split_volumes(asl, {tis_name: slice(0, 86), calib0_name: 88, calib1_name: 89})
 
 
-def setup_logger(file_path):
+def setup_logger(file_path, stream=True):
     """
     Convenience function which returns a logger object with a
     specified name and level of reporting.
@@ -212,6 +346,9 @@ def setup_logger(file_path):
     mode : str, default="w"
         The mode of operation for the FileHandler. The default mode,
         "w", overwrites a logfile of the same name if it exists.
+    stream : bool, default=True
+        If False, only log to the file. Any handlers already attached
+        to the root logger are removed first.
     """
 
     # set up logger's base reporting level and formatting
@@ -223,7 +360,11 @@ def setup_logger(file_path):
 
     # set up FileHandler and StreamHanlder
     handlers = [logging.FileHandler(file_path, mode="w")]
-    handlers.append(logging.StreamHandler())
+    if stream:
+        handlers.append(logging.StreamHandler())
+    else:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
 
     # add formatting to handlers and add to logger
     for handler in handlers:
@@ -263,24 +404,200 @@ def make_motion_fov_mask(mc_transform, src, ref, cores=1):
     Apply logical all across time to get valid FoV voxels
     Save mask in source space"""
 
-    fov = np.ones(ref.size)
+    fov = np.ones(ref.size, dtype=DTYPE)
     fov_motion = mc_transform.apply_to_array(fov, ref, src, order=1, cores=cores)
     fov_valid = (fov_motion > 0.9).all(-1)
     return src.make_nifti(fov_valid)
 
 
+def slice_times(tis, slicedt=SLICEDT, sliceband=SLICEBAND, n_slices=NSLICES):
+    """
+    Times at which each slice is acquired after each TI.
+
+    Slices are acquired in bands of `sliceband`, the n-th slice of a
+    band at TI + n * `slicedt`, so there are only len(`tis`) x
+    `sliceband` distinct times.
+
+    Returns
+    -------
+    numpy.ndarray
+        Array of shape (1, 1, `n_slices`, len(`tis`)) which broadcasts
+        against a 4D image with one volume per TI.
+    """
+    slice_in_band = np.tile(np.arange(sliceband, dtype=DTYPE), n_slices // sliceband)
+    tis = np.asarray(tis, dtype=DTYPE)
+    return (tis + DTYPE(slicedt) * slice_in_band[:, None])[None, None]
+
+
+def satrecov_scaling(t1, nominal, actual, where=True, out=None):
+    """
+    Scaling factors which correct for a signal being measured at a
+    different time than intended, according to the saturation recovery
+    model S(t) = M0 * (1 - exp(-t / T1)):
+
+        (1 - exp(-nominal / T1)) / (1 - exp(-actual / T1))
+
+    The arguments are broadcast against each other, so a compact table
+    of times, see `slice_times`, can be used with a full T1 map without
+    expanding it. Factors are 1 where T1 is not positive, outside
+    `where` and where the denominator is not positive.
+
+    Parameters
+    ----------
+    t1 : array-like
+        T1 estimates.
+    nominal : array-like
+        Times at which the signal should have been measured.
+    actual : array-like
+        Times at which the signal was measured.
+    where : array-like of bool, optional
+        Voxels at which to evaluate the factors. Default is everywhere.
+    out : numpy.ndarray, optional
+        `DTYPE` array of the broadcast shape to write the factors into.
+
+    Returns
+    -------
+    numpy.ndarray
+        `DTYPE` array of scaling factors, `out` if it was provided.
+    """
+    t1, nominal, actual = [np.asarray(a, dtype=DTYPE) for a in (t1, nominal, actual)]
+    shape = np.broadcast_shapes(t1.shape, nominal.shape, actual.shape)
+    if out is None:
+        out = np.empty(shape, dtype=DTYPE)
+    den = np.zeros(shape, dtype=DTYPE)
+    valid = (t1 > 0) & where
+
+    # 1 - exp(x) is evaluated as -expm1(x), in place
+    out.fill(0)
+    np.divide(-nominal, t1, out=out, where=valid)
+    np.expm1(out, out=out)
+    np.negative(out, out=out)
+    np.divide(-actual, t1, out=den, where=valid)
+    np.expm1(den, out=den)
+    np.negative(den, out=den)
+
+    np.divide(out, den, out=out, where=den > 0)
+    np.copyto(out, 1, where=den <= 0)
+    return out
+
+
+def _stream_output(stream, name, tail=None):
+    """
+    Log each line read from `stream` as it arrives, keeping the last
+    lines in `tail`. Lines longer than MAX_LINE_LENGTH are split.
+    """
+    with stream:
+        for line in iter(lambda: stream.readline(MAX_LINE_LENGTH), ""):
+            line = line.rstrip("\n")
+            logging.info(f"[{name}] {line}")
+            if tail is not None:
+                tail.append(line)
+
+
 def sp_run(cmd, **kwargs):
+    """
+    Run a command, logging its stdout and stderr line by line as it
+    runs. If the command fails the last lines of its stderr are logged
+    and the program exits.
+    """
     logging.info(cmd)
     env = {**os.environ, **kwargs.pop("env", {})}
-    result = subprocess.run(cmd, capture_output=True, text=True, env=env, **kwargs)
-    if result.returncode == 0:
-        logging.info(result.stdout)
-    else:
-        logging.error(f"Subprocess {cmd} failed with exit code {result.returncode}.")
-        logging.error(result.stderr)
+    name = command_name(cmd)
+    with span(name, "subprocess", cmd=cmd):
+        start = time.perf_counter()
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            errors="replace",
+            env=env,
+            **kwargs,
+        )
+        stderr_tail = deque(maxlen=TAIL_LINES)
+        readers = [
+            threading.Thread(target=_stream_output, args=(proc.stdout, name)),
+            threading.Thread(
+                target=_stream_output, args=(proc.stderr, name, stderr_tail)
+            ),
+        ]
+        for reader in readers:
+            reader.start()
+        # reap the child ourselves to get its resource usage
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+        for reader in readers:
+            reader.join()
+    record_usage(cmd, time.perf_counter() - start, rusage, proc.returncode)
+    if proc.returncode != 0:
+        logging.error(f"Subprocess {cmd} failed with exit code {proc.returncode}.")
+        logging.error("\n".join(stderr_tail))
         exit(-1)
 
 
+def sp_run_many(cmds, deps=None, cores=1, **kwargs):
+    """
+    Run a batch of commands concurrently, each via `sp_run`.
+
+    Commands are started in order as soon as the commands they depend
+    on have finished, with at most `cores` running at once. If a
+    command fails no further commands are started, those running are
+    allowed to finish and the program exits as it would in `sp_run`.
+
+    Parameters
+    ----------
+    cmds : list
+        Commands to run, each as would be passed to `sp_run`.
+    deps : dict, optional
+        Mapping from the index of a command in `cmds` to the indices
+        of the commands which must finish before it starts.
+    cores : int, optional
+        Maximum number of commands to run at once. Default is 1, in
+        which case commands run one at a time in order.
+    **kwargs
+        Passed on to `sp_run` for every command.
+    """
+    deps = {i: set((deps or {}).get(i, ())) for i in range(len(cmds))}
+    for i, before in deps.items():
+        if not before <= set(range(len(cmds))) - {i}:
+            raise ValueError(f"Invalid dependencies for command {i}: {before}")
+    cores = max(int(cores), 1)
+    # attribute the commands' resource usage to the caller's stage
+    stage = accounting.current_stage()
+
+    def run(cmd):
+        with accounting.stage(stage):
+            sp_run(cmd, **kwargs)
+
+    pending, running, done, error = list(range(len(cmds))), {}, set(), None
+    with ThreadPoolExecutor(cores, thread_name_prefix="sp_run_many") as pool:
+        while pending or running:
+            if error is None:
+                for i in [i for i in pending if deps[i] <= done]:
+                    if len(running) >= cores:
+                        break
+                    pending.remove(i)
+                    running[pool.submit(run, cmds[i])] = i
+            if not running:
+                if error is None:
+                    raise ValueError(
+                        f"Circular dependencies between commands {sorted(pending)}"
+                    )
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i = running.pop(future)
+                try:
+                    future.result()
+                except BaseException as e:
+                    if error is None:
+                        error = e
+                else:
+                    done.add(i)
+    if error is not None:
+        raise error
+
+
 def get_roi_stats_script():
     """FSL script can have two different names (with or without .py extension)"""
     roi_script_name = Path(os.environ["FSLDIR"]) / "bin/oxford_asl_roi_stats"
@@ -0,0 +1,151 @@
+"""
+Benchmark the warm-started second motion estimation against mcflirt.
+
+Registers a series to a reference image twice, once with mcflirt from
+scratch, as the second motion estimation of stage 3 does by default,
+and once by refining earlier estimates, as it does with
+--moco_warm_start. Reports the time each takes and the RMS deviation
+(Jenkinson, 1999) between their transforms for every volume, and
+between the earlier estimates and mcflirt's for reference.
+
+This is the check --moco_warm_start has to pass on real data before it
+is recommended: the script exits with status 1 if any refined transform
+deviates from mcflirt's by more than --tolerance, or if the refinement
+is not faster.
+
+For a subject processed by the pipeline, the inputs are
+ASL/label_control/slicetime_correction/second/*_st.nii.gz (or the
+series in bias_correction/ if banding corrections were switched off),
+ASL/calibration/calib0/calib0_initial_corrected.nii.gz and
+ASL/label_control/motion_correction/asln2m0.mat.
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+
+from hcpasl.motion_estimation import refine_mcflirt, run_mcflirt
+from hcpasl.utils import ImagePath
+
+# radius of the sphere over which the RMS deviation is measured, in mm,
+# as in FSL's rmsdiff
+RMS_RADIUS = 80.0
+# largest acceptable RMS deviation from mcflirt, in mm: a tenth of the
+# 2.5 mm voxels of the HCP ASL series
+TOLERANCE = 0.25
+
+
+def rms_deviation(mat1, mat2, centre, radius=RMS_RADIUS):
+    """
+    RMS deviation between two affine transforms over a sphere.
+
+    Parameters
+    ----------
+    mat1, mat2 : numpy.ndarray
+        4x4 FSL transforms.
+    centre : numpy.ndarray
+        Centre of the sphere in FSL coordinates, in mm.
+    radius : float, optional
+        Radius of the sphere, in mm. Default is 80, as in rmsdiff.
+
+    Returns
+    -------
+    float
+        RMS deviation, in mm.
+    """
+    diff = mat1 @ np.linalg.inv(mat2) - np.eye(4)
+    linear, translation = diff[:3, :3], diff[:3, 3]
+    shift = translation + linear @ centre
+    return float(np.sqrt(radius**2 / 5 * np.trace(linear.T @ linear) + shift @ shift))
+
+
+def load_mats(mats_dir):
+    return [np.loadtxt(mat) for mat in sorted(Path(mats_dir).glob("MAT_*"))]
+
+
+def summarise(name, deviations):
+    print(
+        f"{name:<28}mean {np.mean(deviations):7.3f} mm, "
+        f"median {np.median(deviations):7.3f} mm, "
+        f"max {np.max(deviations):7.3f} mm"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare refining earlier motion estimates with re-running "
+        + "mcflirt."
+    )
+    parser.add_argument("series", help="4D series to register.")
+    parser.add_argument("reference", help="Reference image.")
+    parser.add_argument(
+        "init_mats", help="mcflirt .mat directory of earlier estimates."
+    )
+    parser.add_argument(
+        "--cores",
+        help="Number of registrations to run at once. Default is 1.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--outdir",
+        help="Directory in which to keep both sets of transforms.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        help="Largest acceptable RMS deviation of a refined transform from "
+        + f"mcflirt's, in mm. Default is {TOLERANCE}.",
+        type=float,
+        default=TOLERANCE,
+    )
+    args = parser.parse_args()
+
+    series = ImagePath(Path(args.series).resolve(strict=True))
+    reference = Path(args.reference).resolve(strict=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        outdir = Path(args.outdir) if args.outdir else Path(tmp)
+        full_mats, refined_mats = outdir / "mcflirt.mat", outdir / "refined.mat"
+
+        start = time.perf_counter()
+        run_mcflirt(series, reference, outdir / "mcflirt.nii.gz", full_mats, args.cores)
+        full_time = time.perf_counter() - start
+        start = time.perf_counter()
+        refine_mcflirt(series, reference, args.init_mats, refined_mats, args.cores)
+        refined_time = time.perf_counter() - start
+
+        full, refined = load_mats(full_mats), load_mats(refined_mats)
+    initial = load_mats(args.init_mats)
+
+    print(f"mcflirt from scratch:       {full_time:8.1f} s")
+    print(f"refined from earlier mats:  {refined_time:8.1f} s")
+    print(f"speed-up:                   {full_time / refined_time:8.1f}x")
+
+    # centre of the reference volume in FSL coordinates
+    ref_img = nb.load(reference)
+    centre = (np.array(ref_img.shape[:3]) - 1) / 2 * ref_img.header.get_zooms()[:3]
+    print(f"RMS deviation from mcflirt over {len(full)} volumes:")
+    deviations = {}
+    for name, mats in (("refined", refined), ("earlier estimates", initial)):
+        deviations[name] = [rms_deviation(a, b, centre) for a, b in zip(mats, full)]
+        summarise(name, deviations[name])
+
+    failures = []
+    if len(refined) != len(full):
+        failures.append(f"{len(refined)} refined transforms for {len(full)} volumes")
+    elif max(deviations["refined"]) > args.tolerance:
+        failures.append(f"refined transforms deviate by more than {args.tolerance} mm")
+    if refined_time >= full_time:
+        failures.append("refinement is not faster than mcflirt")
+    if failures:
+        print("FAIL: " + "; ".join(failures))
+        sys.exit(1)
+    print("PASS")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Benchmark the numpy saturation recovery fit against Fabber's.
+
+Times the voxelwise and spatially regularised fits of
+`hcpasl.satrecov` on the control images of an ASL series and, given
+the `mean_T1t.nii.gz` estimated by Fabber on the same series or asked
+to run Fabber itself, compares their T1t estimates with Fabber's, both
+as fitted and after the 3x3x3 median filter applied before slice-time
+correction. It also compares the M0t estimates, if Fabber's
+`mean_M0t.nii.gz` is alongside its `mean_T1t.nii.gz`, and the factors
+by which the filtered T1t estimates scale the series at each TI in
+slice-time correction.
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+from scipy.ndimage import median_filter
+
+from hcpasl.asl_correction import fit_satrecov_model, split_asl_label_control
+from hcpasl.satrecov import fit_satrecov
+from hcpasl.timing import MBPCASL
+from hcpasl.utils import DTYPE, IBF, NTIS, RPTS, ImagePath, satrecov_scaling
+
+
+def compare_estimates(ref, test, mask):
+    """
+    Summarise the differences between two estimates.
+
+    Parameters
+    ----------
+    ref : numpy.ndarray
+        Reference estimate.
+    test : numpy.ndarray
+        Estimate to compare with the reference, of the same shape.
+    mask : numpy.ndarray
+        Voxels to compare, broadcast against the estimates.
+
+    Returns
+    -------
+    dict
+        Mean and median difference, median and 95th percentile of the
+        absolute difference, and correlation of the estimates.
+    """
+    mask = np.broadcast_to(mask, ref.shape)
+    ref, test = ref[mask], test[mask]
+    diff = test - ref
+    return {
+        "mean": float(diff.mean()),
+        "median": float(np.median(diff)),
+        "median_abs": float(np.median(np.abs(diff))),
+        "p95_abs": float(np.percentile(np.abs(diff), 95)),
+        "r": float(np.corrcoef(ref, test)[0, 1]),
+    }
+
+
+def _timed(func, repeats):
+    """Result of `func()` and the shortest of `repeats` run times"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, min(times)
+
+
+def _load_fabber(t1_name):
+    """Fabber's T1t and, if it was saved alongside, M0t estimates"""
+    t1_name = Path(t1_name)
+    ref = {"T1t": nb.load(t1_name).get_fdata(dtype=DTYPE)}
+    m0_names = sorted(t1_name.parent.glob("mean_M0t.nii*"))
+    if m0_names:
+        ref["M0t"] = nb.load(m0_names[0]).get_fdata(dtype=DTYPE)
+    return ref
+
+
+def _stcorr_factors(t1):
+    """Slice-time correction factors at each TI, from `t1` after the median filter"""
+    return satrecov_scaling(
+        median_filter(t1, 3)[..., np.newaxis], MBPCASL.tis, MBPCASL.volume_times(False)
+    )
+
+
+def _print_row(label, stats):
+    print(f"{label:<20}" + "".join(f"{v:9.4f}" for v in stats.values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time the numpy satrecov fit and compare it with Fabber's."
+    )
+    parser.add_argument(
+        "asl",
+        help="Label-control ASL series, for example "
+        + "ASL/label_control/label_control_corrected.nii.gz.",
+    )
+    parser.add_argument(
+        "--fabber_t1",
+        help="Fabber's T1t estimate on the same series, for example "
+        + "ASL/label_control/saturation_recovery/second/spatial/mean_T1t.nii.gz.",
+    )
+    parser.add_argument(
+        "--run_fabber",
+        help="Run and time Fabber's two satrecov fits, and compare with their "
+        + "results rather than with --fabber_t1.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--mask",
+        help="Mask of the voxels in which to compare the estimates. Default is "
+        + "every voxel fitted by both.",
+    )
+    parser.add_argument(
+        "--repeats",
+        help="Number of times to run each numpy fit. Default is 3.",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--outdir",
+        help="Directory in which to save the numpy T1t estimates.",
+    )
+    args = parser.parse_args()
+
+    asl = ImagePath(Path(args.asl).resolve(strict=True))
+    control, _ = split_asl_label_control(asl, NTIS, "tc", IBF, RPTS)
+
+    fits, voxelwise_time = _timed(
+        lambda: fit_satrecov(control, spatial=False), args.repeats
+    )
+    fits, spatial_time = _timed(lambda: fit_satrecov(control), args.repeats)
+    print(f"numpy voxelwise fit:          {voxelwise_time:8.2f} s")
+    print(f"numpy voxelwise+spatial fits: {spatial_time:8.2f} s")
+    if args.outdir:
+        outdir = Path(args.outdir)
+        outdir.mkdir(parents=True, exist_ok=True)
+        for name, (_, t1) in fits.items():
+            nb.save(
+                nb.Nifti1Image(t1, asl.img.affine), outdir / f"{name}_T1t.nii.gz"
+            )
+
+    ref = None
+    if args.run_fabber:
+        with tempfile.TemporaryDirectory() as fabber_dir:
+            t1_name, fabber_time = _timed(
+                lambda: fit_satrecov_model(asl.path, Path(fabber_dir)), 1
+            )
+            ref = _load_fabber(t1_name)
+        print(f"fabber vb+spatialvb fits:     {fabber_time:8.2f} s")
+        print(f"speed-up:                     {fabber_time / spatial_time:8.1f}x")
+    elif args.fabber_t1:
+        ref = _load_fabber(args.fabber_t1)
+    if ref is None:
+        return
+
+    ref_t1 = ref["T1t"]
+    mask = (fits["nospatial"][1] > 0) & (ref_t1 > 0)
+    if args.mask:
+        mask &= nb.load(args.mask).get_fdata() > 0
+    header = f"{'':<20}{'mean':>9}{'median':>9}{'med|d|':>9}{'95%|d|':>9}{'r':>9}"
+    print(f"Differences from Fabber's T1t in {mask.sum()} voxels, in s:")
+    print(header)
+    for name, (_, t1) in fits.items():
+        _print_row(name, compare_estimates(ref_t1, t1, mask))
+        _print_row(
+            f"{name} filtered",
+            compare_estimates(median_filter(ref_t1, 3), median_filter(t1, 3), mask),
+        )
+
+    if "M0t" in ref:
+        print("Differences from Fabber's M0t, in the units of the series:")
+        print(header)
+        for name, (m0, _) in fits.items():
+            _print_row(name, compare_estimates(ref["M0t"], m0, mask))
+
+    print("Differences from the slice-time correction factors of Fabber's T1t:")
+    print(header)
+    ref_factors = _stcorr_factors(ref_t1)
+    for name, (_, t1) in fits.items():
+        factors = _stcorr_factors(t1)
+        _print_row(name, compare_estimates(ref_factors, factors, mask[..., np.newaxis]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+Compare the images in two runs' output directories.
+
+Used to check that a change to the pipeline leaves its results
+numerically equivalent, for example before moving its processing from
+float64 to float32 (`hcpasl.utils.DTYPE`): every NIfTI image found under the reference
+directory is compared voxelwise with the image at the same relative
+path under the other directory.
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+
+
+def compare_images(ref, test, rtol, atol):
+    """
+    Compare two images voxelwise.
+
+    Parameters
+    ----------
+    ref : pathlib.Path
+        Reference image.
+    test : pathlib.Path
+        Image to compare with the reference.
+    rtol : float
+        Relative tolerance, as in `numpy.isclose`.
+    atol : float
+        Absolute tolerance, as in `numpy.isclose`.
+
+    Returns
+    -------
+    max_abs : float
+        Largest absolute difference between the images.
+    max_rel : float
+        Largest absolute difference relative to the reference, over
+        voxels where the reference is nonzero.
+    n_bad : int
+        Number of voxels not within tolerance. -1 if the images'
+        shapes differ.
+    """
+    ref_data = nb.load(ref).get_fdata()
+    test_data = nb.load(test).get_fdata()
+    if ref_data.shape != test_data.shape:
+        return np.inf, np.inf, -1
+    diff = np.abs(test_data - ref_data)
+    nonzero = ref_data != 0
+    max_abs = float(diff.max()) if diff.size else 0.0
+    max_rel = (
+        float((diff[nonzero] / np.abs(ref_data[nonzero])).max())
+        if nonzero.any()
+        else 0.0
+    )
+    close = np.isclose(test_data, ref_data, rtol=rtol, atol=atol, equal_nan=True)
+    return max_abs, max_rel, int((~close).sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the NIfTI images in two pipeline output directories."
+    )
+    parser.add_argument("reference", help="Output directory of the reference run.")
+    parser.add_argument("test", help="Output directory of the run to check.")
+    parser.add_argument(
+        "--rtol",
+        type=float,
+        default=1e-4,
+        help="Relative tolerance for each voxel. Default is 1e-4.",
+    )
+    parser.add_argument(
+        "--atol",
+        type=float,
+        default=1e-5,
+        help="Absolute tolerance for each voxel. Default is 1e-5.",
+    )
+    parser.add_argument(
+        "--pattern",
+        default="*.nii*",
+        help="Glob pattern of the images to compare. Default is '*.nii*'.",
+    )
+    args = parser.parse_args()
+
+    ref_dir, test_dir = Path(args.reference), Path(args.test)
+    failed = 0
+    for ref in sorted(ref_dir.rglob(args.pattern)):
+        rel = ref.relative_to(ref_dir)
+        test = test_dir / rel
+        if not test.exists():
+            print(f"MISSING  {rel}")
+            failed += 1
+            continue
+        max_abs, max_rel, n_bad = compare_images(ref, test, args.rtol, args.atol)
+        if n_bad == -1:
+            print(f"SHAPE    {rel}")
+            failed += 1
+        elif n_bad:
+            print(
+                f"DIFFER   {rel}: {n_bad} voxels, "
+                f"max abs {max_abs:.3g}, max rel {max_rel:.3g}"
+            )
+            failed += 1
+        else:
+            print(f"OK       {rel}: max abs {max_abs:.3g}, max rel {max_rel:.3g}")
+    print(f"{failed} image(s) differ.")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""
+Run the hcp-asl pipeline for many subjects from a manifest.
+
+Subjects are processed in a pool of worker processes, each with its
+own core and memory budget. A failure, including a call to `exit()`
+from a failed subprocess, only affects the subject in which it
+occurs. A summary of every subject's outcome is written at the end.
+"""
+
+import argparse
+import csv
+import logging
+import multiprocessing as mp
+import os
+import resource
+import time
+import traceback
+from multiprocessing.connection import wait
+from pathlib import Path
+from shutil import rmtree
+
+# thread pools used by numerical libraries and FSL tools
+THREAD_ENV_VARS = (
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "NUMEXPR_NUM_THREADS",
+    "FSL_NUM_THREADS",
+)
+REQUIRED_COLUMNS = ("subid", "subdir", "mbpcasl", "fmap_ap", "fmap_pa")
+OPTIONAL_COLUMNS = ("grads", "struct", "sbrain", "wmparc", "ribbon", "outdir")
+
+
+def read_manifest(manifest):
+    """
+    Read a csv manifest of subjects to process.
+
+    Parameters
+    ----------
+    manifest : pathlib.Path
+        csv file with a header row. Columns subid, subdir, mbpcasl,
+        fmap_ap and fmap_pa are required. grads, struct, sbrain,
+        wmparc, ribbon and outdir are optional and may be left
+        empty for individual subjects.
+
+    Returns
+    -------
+    list of dict
+        One dictionary per subject, with empty entries set to None.
+    """
+    with open(manifest, "r", newline="") as f:
+        reader = csv.DictReader(f)
+        missing = set(REQUIRED_COLUMNS) - set(reader.fieldnames or ())
+        if missing:
+            raise ValueError(f"Manifest {manifest} is missing columns: {missing}")
+        rows = []
+        for row in reader:
+            row = {
+                k: (row.get(k) or "").strip() or None
+                for k in REQUIRED_COLUMNS + OPTIONAL_COLUMNS
+            }
+            for k in REQUIRED_COLUMNS:
+                if row[k] is None:
+                    raise ValueError(f"Manifest row {reader.line_num} has no {k}.")
+            rows.append(row)
+    subids = [row["subid"] for row in rows]
+    if len(set(subids)) != len(subids):
+        raise ValueError(f"Manifest {manifest} contains duplicate subject IDs.")
+    return rows
+
+
+def limit_resources(cores, mem_gb=None):
+    """
+    Limit the current process, and any it starts, to `cores` threads
+    per thread pool and, optionally, `mem_gb` GB of address space.
+    """
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(cores)
+    if mem_gb is not None:
+        limit = int(mem_gb * 1024**3)
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def process_manifest_row(row, args):
+    """
+    Process a single subject from the manifest.
+
+    This is run in a child process. Its log is written only to the
+    subject's log file and its exit code reports success (0) or
+    failure (1).
+    """
+    from scripts.run_pipeline import find_structural_inputs, process_subject
+    from hcpasl import __sha1__, __timestamp__, __version__
+    from hcpasl.utils import setup_logger
+
+    limit_resources(args.cores, args.mem_gb)
+    subject_dir = Path(row["subdir"]).resolve(strict=True)
+    outdir = row["outdir"] if row["outdir"] is not None else args.outdir
+    base_dir = subject_dir / outdir
+    if args.clean:
+        for d in ["ASL", "T1w/ASL", "MNINonLinear/ASL"]:
+            if (base_dir / d).exists():
+                rmtree(base_dir / d, ignore_errors=True)
+    log_path = base_dir / f"T1w/ASL/{row['subid']}_hcp_asl.log"
+    log_path.parent.mkdir(exist_ok=True, parents=True)
+    setup_logger(log_path, stream=False)
+    logging.info(
+        f"HCP-ASL pipeline v{__version__} (commit {__sha1__} on {__timestamp__})."
+    )
+    logging.info(f"Batch worker for subject {row['subid']} (pid {os.getpid()}).")
+    for k, v in row.items():
+        logging.info(f"{k}: {v}")
+
+    try:
+        inputs = find_structural_inputs(
+            subject_dir, row["struct"], row["sbrain"], row["wmparc"], row["ribbon"]
+        )
+        process_subject(
+            subid=row["subid"],
+            subject_dir=subject_dir,
+            eb_factors=args.mtname,
+            cores=args.cores,
+            interpolation=args.interpolation,
+            gradients=(
+                Path(row["grads"]).resolve(strict=True) if row["grads"] else None
+            ),
+            mbpcasl=Path(row["mbpcasl"]).resolve(strict=True),
+            territories_atlas=args.territories_atlas,
+            territories_labels=args.territories_labels,
+            structural={"struct": inputs["struct"], "sbrain": inputs["sbrain"]},
+            fmaps={
+                "AP": Path(row["fmap_ap"]).resolve(strict=True),
+                "PA": Path(row["fmap_pa"]).resolve(strict=True),
+            },
+            use_t1=args.use_t1,
+            wmparc=inputs["wmparc"],
+            ribbon=inputs["ribbon"],
+            nobandingcorr=args.nobandingcorr,
+            outdir=outdir,
+            stages=args.stages,
+            use_cache=not args.nocache,
+            resume=args.resume,
+            scratch=Path(args.scratch).resolve() if args.scratch else None,
+            intermediate_format=args.intermediate_format,
+            satrecov_fitter=args.satrecov_fitter,
+            satrecov_warm_start=args.satrecov_warm_start,
+            moco_warm_start=args.moco_warm_start,
+        )
+    # sp_run calls exit() on failure so SystemExit must be caught too
+    except BaseException:
+        logging.error(f"Error processing subject {subject_dir}:")
+        logging.error(traceback.format_exc())
+        logging.shutdown()
+        os._exit(1)
+    logging.info(f"Finished processing subject {subject_dir}.")
+    logging.shutdown()
+
+
+def run_batch(rows, args):
+    """
+    Process the subjects in `rows` with up to `args.workers` running
+    at once.
+
+    Returns
+    -------
+    list of dict
+        Outcome of each subject, in manifest order.
+    """
+    # spawned rather than forked, since this process has already run
+    # check_environment and each subject runs threads of its own; `row`
+    # and `args` are pickled to the child
+    ctx = mp.get_context("spawn")
+    pending, running, results = list(rows), {}, {}
+    try:
+        while pending or running:
+            while pending and len(running) < args.workers:
+                row = pending.pop(0)
+                proc = ctx.Process(
+                    target=process_manifest_row,
+                    args=(row, args),
+                    name=f"hcp_asl_{row['subid']}",
+                )
+                proc.start()
+                logging.info(f"Started subject {row['subid']} (pid {proc.pid}).")
+                running[proc.sentinel] = (proc, row, time.perf_counter())
+            for sentinel in wait(list(running)):
+                proc, row, start = running.pop(sentinel)
+                proc.join()
+                duration = time.perf_counter() - start
+                status = "success" if proc.exitcode == 0 else "failed"
+                logging.info(
+                    f"Subject {row['subid']} {status} after {duration / 60:.1f} min "
+                    f"(exit code {proc.exitcode})."
+                )
+                results[row["subid"]] = {
+                    "subid": row["subid"],
+                    "status": status,
+                    "exitcode": proc.exitcode,
+                    "minutes": f"{duration / 60:.1f}",
+                }
+    except KeyboardInterrupt:
+        logging.error("Interrupted, terminating running subjects.")
+        for proc, _, _ in running.values():
+            proc.terminate()
+            proc.join()
+        raise
+    return [results[row["subid"]] for row in rows]
+
+
+def main():
+    """
+    Main entry point for batch processing with the hcp-asl pipeline.
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the HCP ASL minimal processing pipeline for each "
+        + "subject in a manifest, processing several subjects at once."
+    )
+    required = parser.add_argument_group("required arguments")
+    required.add_argument(
+        "--manifest",
+        help="csv file with one row per subject and columns "
+        + ", ".join(REQUIRED_COLUMNS)
+        + " and, optionally, "
+        + ", ".join(OPTIONAL_COLUMNS)
+        + ". These are as for the arguments of process_hcp_asl.",
+        required=True,
+    )
+    batch = parser.add_argument_group("batch arguments")
+    batch.add_argument(
+        "--workers",
+        help="Number of subjects to process at once. Default is 1.",
+        default=1,
+        type=int,
+    )
+    batch.add_argument(
+        "--cores",
+        help="Number of cores available to each subject. Default is 1.",
+        default=1,
+        type=int,
+    )
+    batch.add_argument(
+        "--mem_gb",
+        help="Limit on the address space of each subject's processes, in GB. "
+        + "Default is no limit.",
+        type=float,
+    )
+    batch.add_argument(
+        "--summary",
+        help="Path of the csv summary of each subject's outcome. Default is "
+        + "hcp_asl_batch_summary.csv in the current working directory.",
+        default="hcp_asl_batch_summary.csv",
+    )
+    optional = parser.add_argument_group(
+        "pipeline arguments", description="(applied to every subject)"
+    )
+    optional.add_argument(
+        "--use_t1",
+        help="Use the T1 estimates from the satrecov model in perfusion "
+        + "estimation via oxford_asl.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--mtname",
+        help="Filename for scaling factors used for empirical banding "
+        + "correction. If not provided, the pipeline will "
+        + "use the scaling factors included with the distribution.",
+    )
+    optional.add_argument(
+        "--stages",
+        help="Pipeline stages (zero-indexed, separated by spaces) to run, eg 0 3 5",
+        nargs="+",
+        type=int,
+        default=set(range(14)),
+        metavar="N",
+    )
+    optional.add_argument(
+        "--interpolation",
+        help="Interpolation order for registrations. Default is 3.",
+        default=3,
+        type=int,
+        choices=range(0, 5 + 1),
+    )
+    optional.add_argument(
+        "--nobandingcorr",
+        help="Don't apply empirical banding and slice-time corrections.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--territories_atlas",
+        help="Location of vascular territory atlas.",
+    )
+    optional.add_argument(
+        "--territories_labels",
+        help="Location of txt file with labels for vascular territory atlas.",
+    )
+    optional.add_argument(
+        "--outdir",
+        help="Name of output directory to be created within each subject's "
+        + "directory, unless given in the manifest.",
+        default="",
+    )
+    optional.add_argument(
+        "--nocache",
+        help="Run every requested stage, even those whose inputs, options "
+        + "and software versions are unchanged since they last completed.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--resume",
+        help="Resume long stages from the last step completed by a previous, "
+        + "interrupted run, rather than from the start of the stage.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--scratch",
+        help="Directory on node-local storage (for example /tmp or $TMPDIR) "
+        + "in which to write intermediate files. Only the outputs needed by "
+        + "later stages are copied back to each subject's outdir.",
+    )
+    optional.add_argument(
+        "--intermediate_format",
+        help="Format of intermediate images. Uncompressed nii images take "
+        + "more disk space but are memory-mapped rather than decompressed "
+        + "when read. Final outputs are always gzipped. Default is nii.gz.",
+        choices=("nii.gz", "nii"),
+        default="nii.gz",
+    )
+    optional.add_argument(
+        "--satrecov_fitter",
+        help="How to fit the saturation recovery model used for slice-time "
+        + "correction: with two Fabber runs, or with a vectorised fit in "
+        + "numpy, which is much faster. Default is fabber.",
+        choices=("fabber", "numpy"),
+        default="fabber",
+    )
+    optional.add_argument(
+        "--satrecov_warm_start",
+        help="Start Fabber's second fit of the saturation recovery model "
+        + "from the posterior of the first fit, and stop it once it has "
+        + "converged rather than after a fixed number of iterations.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--moco_warm_start",
+        help="Experimental: refine the first motion estimates with flirt, "
+        + "starting from each volume's first-pass transform, rather than "
+        + "re-running mcflirt from scratch on the distortion-corrected series. "
+        + "Not yet checked against mcflirt on real data, see "
+        + "scripts/benchmark_moco.py.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--clean",
+        help="Remove all previous outputs found within each subject's outdir",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.workers < 1 or args.cores < 1:
+        parser.error("--workers and --cores must be at least 1")
+    args.stages = set(args.stages)
+
+    logging.basicConfig(
+        level="INFO",
+        format="%(asctime)s %(levelname)s %(module)s/%(funcName)s: %(message)s",
+    )
+    if args.workers * args.cores > os.cpu_count():
+        logging.warning(
+            f"{args.workers} workers with {args.cores} cores each exceeds the "
+            f"{os.cpu_count()} cores available."
+        )
+
+    # limit thread pools before the pipeline's modules are imported so
+    # that subjects started from this process inherit the limits
+    for var in THREAD_ENV_VARS:
+        os.environ[var] = str(args.cores)
+    from scripts.run_pipeline import check_environment
+    from hcpasl.utils import get_package_data_name
+
+    check_environment()
+    if args.mtname:
+        args.mtname = Path(args.mtname).resolve(strict=True)
+    elif not args.nobandingcorr:
+        args.mtname = get_package_data_name("empirical_banding_factors.txt")
+    if args.territories_atlas is None:
+        args.territories_atlas = get_package_data_name(
+            "vascular_territories_atlas.nii.gz"
+        )
+    if args.territories_labels is None:
+        args.territories_labels = get_package_data_name(
+            "vascular_territories_atlas_labels.txt"
+        )
+
+    rows = read_manifest(Path(args.manifest))
+    logging.info(
+        f"Processing {len(rows)} subjects with {args.workers} workers "
+        f"of {args.cores} cores each."
+    )
+    results = run_batch(rows, args)
+
+    with open(args.summary, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["subid", "status", "exitcode", "minutes"])
+        writer.writeheader()
+        writer.writerows(results)
+    failed = [r["subid"] for r in results if r["status"] != "success"]
+    logging.info(
+        f"{len(results) - len(failed)} of {len(results)} subjects processed "
+        f"successfully. Summary written to {args.summary}."
+    )
+    if failed:
+        logging.error(f"Failed subjects: {', '.join(failed)}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
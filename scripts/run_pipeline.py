@@ -7,36 +7,28 @@ the directories of the subjects of interest and finally the
 name of the empirical banding correction scaling factors image.
 """
 
+import time
+
+_IMPORT_START = time.perf_counter()
+
 import argparse
 import logging
 import os
 from pathlib import Path
 from shutil import copy, rmtree
 
+# only modules with no third-party dependencies are imported here, so
+# that --help, argument errors and environment checks are fast. The
+# processing modules, which import numpy, nibabel, regtricks, fabber,
+# fslpy and scipy, are imported by the stages which use them, which
+# tests/test_imports.py checks.
 from hcpasl import __sha1__, __timestamp__, __version__
-from hcpasl.asl_correction import initial_corrections_asl
-from hcpasl.fully_corrected import fully_correct_asl_calibration_aslt1w
-from hcpasl.asl_differencing import tag_control_differencing
-from hcpasl.distortion_correction import derive_gdc_sdc
-from hcpasl.key_outputs import copy_key_outputs
-from hcpasl.calibration_correction import initial_corrections_calibration
-from hcpasl.pv_estimation import run_pv_estimation
-from hcpasl.qc import create_qc_report, roi_stats
-from hcpasl.utils import (
-    copy_oxford_asl_inputs,
-    get_package_data_name,
-    get_roi_stats_script,
-    setup_logger,
-    sp_run,
-    split_asl,
-    IBF,
-    TIS,
-    BOLUS,
-    TE,
-    SLICEDT,
-    SLICEBAND,
-    RPTS,
-)
+from hcpasl.accounting import save_summary, start_accounting
+from hcpasl.cache import StageCache
+from hcpasl.journal import RunJournal
+from hcpasl.scheduler import Stage, run_stages
+from hcpasl.scratch import Workspace
+from hcpasl.trace import save_trace, start_trace
 
 
 def process_subject(
@@ -57,6 +49,13 @@ def process_subject(
     nobandingcorr=False,
     outdir="hcp_asl",
     stages=set(range(14)),
+    use_cache=True,
+    resume=False,
+    scratch=None,
+    intermediate_format="nii.gz",
+    satrecov_fitter="fabber",
+    satrecov_warm_start=False,
+    moco_warm_start=False,
 ):
     """
     Run the hcp-asl pipeline for a given subject.
@@ -95,9 +94,10 @@ def process_subject(
         Whether or not to use the estimated T1 map in the
         oxford_asl run in structural space.
     cores : int, optional
-        Number of cores to use.
-        When applying motion correction, this is the number
-        of cores that will be used by regtricks. Default is 1.
+        Number of cores to use. This is shared between stages
+        which are run concurrently; when applying motion correction,
+        this is the number of cores that will be used by regtricks.
+        Default is 1.
     interpolation : int, optional
         The interpolation order to use for registrations.
         Regtricks passes this on to scipy's map_coordinates.
@@ -112,20 +112,87 @@ def process_subject(
     stages: set, optional
         List or set of integer stage numbers (zero-indexed) to run.
         All prior stages are assumed to have run successfully.
+        Each stage declares the files it reads and writes; stages
+        which do not depend on one another are run concurrently
+        within the `cores` budget.
+    use_cache : bool, optional
+        If True, stages whose inputs, parameters and software versions
+        are unchanged since they last completed are skipped. The cache
+        is stored in $outdir/ASL/stage_cache.json. Stages 11-13 are
+        always run. Default is True.
+        The resources used by each external command are recorded in
+        $outdir/ASL/resource_usage.csv and totalled per stage and per
+        tool in $outdir/ASL/resource_usage_summary.json.
+    resume : bool, optional
+        If True, stages which record their progress in the run journal,
+        $outdir/ASL/run_journal.jsonl, resume from the last step
+        completed by a previous run. Default is False.
+    scratch : pathlib.Path, optional
+        Directory on local storage. If provided, stages 0-10 write
+        their intermediate files to $scratch/hcp_asl/$subid and only
+        copy the outputs used by later stages back to $outdir. The
+        copy is removed once every stage has succeeded. Default is
+        to write everything to $outdir.
+    intermediate_format : {"nii.gz", "nii"}, optional
+        Format of the intermediate images written by the chains of
+        corrections in stages 2, 3 and 6. Uncompressed "nii" images
+        are memory-mapped rather than decompressed when they are read.
+        Final outputs are always gzipped. Default is "nii.gz".
+    satrecov_fitter : {"fabber", "numpy"}, optional
+        How the saturation recovery model is fitted in stage 3: by two
+        Fabber runs, or in process by `hcpasl.satrecov`. Default is
+        "fabber".
+    satrecov_warm_start : bool, optional
+        If True, Fabber's second satrecov fit in stage 3 starts from
+        the posterior of the first fit and stops once it has converged.
+        Default is False.
+    moco_warm_start : bool, optional
+        If True, the second motion estimation in stage 3 refines the
+        first pass's estimates with flirt rather than running mcflirt
+        from scratch. Experimental, see `scripts/benchmark_moco.py`.
+        Default is False.
     """
 
     if not isinstance(stages, (list, set)):
         raise RuntimeError("stages must either be a set or list of ints")
+    from hcpasl.utils import (
+        copy_oxford_asl_inputs,
+        set_intermediate_format,
+        sp_run,
+        split_asl,
+        IBF,
+        TIS,
+        BOLUS,
+        TE,
+        SLICEDT,
+        SLICEBAND,
+        RPTS,
+    )
+
+    from hcpasl import pgzip
+
+    set_intermediate_format(intermediate_format)
+    # compress and decompress images using every core available
+    pgzip.set_threads(cores)
 
     # create results directories
     logging.info("Creating main results directories.")
-    asl_dir, aslt1w_dir = [subject_dir / outdir / name for name in ("ASL", "T1w/ASL")]
+    base_dir = subject_dir / outdir
+    shared_asl_dir = base_dir / "ASL"
+    shared_asl_dir.mkdir(exist_ok=True, parents=True)
+    workspace, work_dir = None, base_dir
+    if scratch is not None:
+        workspace = Workspace(base_dir, Path(scratch) / "hcp_asl" / subid)
+        work_dir = workspace.local_dir
+        logging.info(f"Writing intermediate files to {work_dir}.")
+    asl_dir, aslt1w_dir = [work_dir / name for name in ("ASL", "T1w/ASL")]
     label_control_dir, calib0_dir, calib1_dir = [
         asl_dir / name
         for name in ("label_control", "calibration/calib0", "calibration/calib1")
     ]
     for d in [asl_dir, aslt1w_dir, label_control_dir, calib0_dir, calib1_dir]:
         d.mkdir(exist_ok=True, parents=True)
+    journal = RunJournal(shared_asl_dir / "run_journal.jsonl", resume=resume)
 
     # split ASL sequence into label-control label_control and calibration images
     tis_name, calib0_name, calib1_name = [
@@ -135,10 +202,8 @@ def process_subject(
             ("label_control.nii.gz", "calib0.nii.gz", "calib1.nii.gz"),
         )
     ]
-    if 0 in stages:
-        logging.info(
-            "Stage 0: Splitting ASL sequence into label-control pairs and calibration images."
-        )
+
+    def stage_0(cores):
         split_asl(mbpcasl, tis_name, calib0_name, calib1_name)
 
     # Run gradient_unwarp and topup on the calibration images
@@ -146,10 +211,15 @@ def process_subject(
     gradunwarp_dir = asl_dir / "gradient_unwarp"
     topup_dir = asl_dir / "topup"
     gd_corr = gradients is not None
-    if 1 in stages:
-        logging.info(
-            "Stage 1: Derive gradient and susceptibility distortion correction."
-        )
+    gdc_warp = gradunwarp_dir / "fullWarp_abs.nii.gz" if gd_corr else None
+    sdc_warp, fmap, fmapmag = [
+        topup_dir / name
+        for name in ("WarpField_01.nii.gz", "fmap.nii.gz", "fmapmag.nii.gz")
+    ]
+
+    def stage_1(cores):
+        from hcpasl.distortion_correction import derive_gdc_sdc
+
         if not gd_corr:
             logging.info(
                 "Gradient coefficient file not provided, derivation will be skipped."
@@ -169,8 +239,14 @@ def process_subject(
     # Apply corrections derived thus far to M0 image
     # Estimate biasfield
     t1w_dir = structural["struct"].parent
-    if 2 in stages:
-        logging.info("Stage 2: Derive and apply initial corrections to M0 image.")
+    aparc_aseg, fs_brainmask = [
+        t1w_dir / name for name in ("aparc+aseg.nii.gz", "brainmask_fs.nii.gz")
+    ]
+    fmap2struct = topup_dir / "fmap_struct_reg/asl2struct.mat"
+
+    def stage_2(cores):
+        from hcpasl.calibration_correction import initial_corrections_calibration
+
         initial_corrections_calibration(
             subject_id=subid,
             calib_dir=calib0_dir.parent,
@@ -191,8 +267,9 @@ def process_subject(
     calib2struct = calib0_dir / "registration/asl2struct.mat"
 
     # Apply corrections derived thus far to ASL timeseries
-    if 3 in stages:
-        logging.info("Stage 3: Derive and apply initial corrections to ASL timeseries.")
+    def stage_3(cores):
+        from hcpasl.asl_correction import initial_corrections_asl
+
         initial_corrections_asl(
             subject_dir=subject_dir,
             label_control_dir=label_control_dir,
@@ -207,6 +284,10 @@ def process_subject(
             cores=cores,
             interpolation=interpolation,
             nobandingcorr=nobandingcorr,
+            satrecov_fitter=satrecov_fitter,
+            satrecov_warm_start=satrecov_warm_start,
+            moco_warm_start=moco_warm_start,
+            journal=journal,
         )
 
     # perform tag-control subtraction in ASL0 space
@@ -214,8 +295,10 @@ def process_subject(
     scaling_factors = label_control_dir / "combined_scaling_factors_mc.nii.gz"
     asl_subtract = label_control_dir / "motion_subtraction"
     asl0_brainmask = label_control_dir / "brain_fov_mask.nii.gz"
-    if 4 in stages:
-        logging.info("Stage 4: Label-control subtraction in native ASL space.")
+
+    def stage_4(cores):
+        from hcpasl.asl_differencing import tag_control_differencing
+
         tag_control_differencing(
             asl_lc, scaling_factors, asl_subtract, mask=asl0_brainmask
         )
@@ -223,8 +306,11 @@ def process_subject(
     # estimate perfusion in ASL0 space using oxford_asl
     oxford_asl_dir = label_control_dir.parent / "perfusion_estimation"
     oxford_asl_dir.mkdir(exist_ok=True, parents=True)
-    if 5 in stages:
-        logging.info("Stage 5: Perfusion estimation in ASL native space.")
+    t1_est = (
+        label_control_dir / "saturation_recovery/second/spatial/mean_T1t_filt.nii.gz"
+    )
+
+    def stage_5(cores):
         logging.info(
             f"Copying oxford_asl inputs to one location ({str(oxford_asl_dir / 'oxford_asl_inputs')})."
         )
@@ -251,11 +337,7 @@ def process_subject(
             "--debug",
         ]
         if use_t1:
-            est_t1 = (
-                label_control_dir
-                / "saturation_recovery/second/spatial/mean_T1t_filt.nii.gz"
-            )
-            oxford_asl_call.append(f"--t1im={str(est_t1)}")
+            oxford_asl_call.append(f"--t1im={str(t1_est)}")
         logging.info(oxford_asl_call)
         sp_run(oxford_asl_call)
 
@@ -268,13 +350,13 @@ def process_subject(
         mt_name = eb_factors
     else:
         asl_scaling_factors, mt_name = None, None
-    t1_est = (
-        label_control_dir / "saturation_recovery/second/spatial/mean_T1t_filt.nii.gz"
-    )
-    if 6 in stages:
-        logging.info(
-            "Stage 6: Fully-correct ASL and calibration into ASL-gridded T1w space."
-        )
+    moco_dir = label_control_dir / "motion_correction/asln2calibration_final.mat"
+    fov_mask = label_control_dir / "motion_correction/fov_mask.nii.gz"
+    perfusion_name = oxford_asl_dir / "native_space/perfusion.nii.gz"
+
+    def stage_6(cores):
+        from hcpasl.fully_corrected import fully_correct_asl_calibration_aslt1w
+
         fully_correct_asl_calibration_aslt1w(
             asl_name=tis_name,
             calib_name=calib0_name,
@@ -282,9 +364,8 @@ def process_subject(
             subject_dir=subject_dir,
             t1w_dir=t1w_dir,
             aslt1w_dir=aslt1w_dir,
-            moco_dir=label_control_dir / "motion_correction/asln2calibration_final.mat",
-            perfusion_name=label_control_dir.parent
-            / "perfusion_estimation/native_space/perfusion.nii.gz",
+            moco_dir=moco_dir,
+            perfusion_name=perfusion_name,
             gradunwarp_dir=gradunwarp_dir,
             gd_corr=gd_corr,
             topup_dir=topup_dir,
@@ -307,20 +388,26 @@ def process_subject(
         )
 
     # perform partial volume estimation
-    if 7 in stages:
-        logging.info("Stage 7: Partial volume estimation in ASLT1w space.")
-        run_pv_estimation(subject_dir, cores, outdir, interpolation)
+    asl2struct = aslt1w_dir / "registration/asl2struct.mat"
+
+    def stage_7(cores):
+        from hcpasl.pv_estimation import run_pv_estimation
+
+        run_pv_estimation(subject_dir, cores, outdir, interpolation, work_dir)
 
     # perform tag-control subtraction in ASLT1w space
-    aslt1w_dir = aslt1w_dir
     series = aslt1w_dir / "label_control/label_control_corrected.nii.gz"
-    scaling_factors = aslt1w_dir / "label_control/label_control_scaling_factors.nii.gz"
+    aslt1w_scaling_factors = (
+        aslt1w_dir / "label_control/label_control_scaling_factors.nii.gz"
+    )
     subtracted_dir = aslt1w_dir / "label_control/motion_subtraction"
     brainmask = aslt1w_dir / "registration/brain_fov_mask.nii.gz"
-    if 8 in stages:
-        logging.info("Stage 8: Label-control subtraction in ASLT1w space")
+
+    def stage_8(cores):
+        from hcpasl.asl_differencing import tag_control_differencing
+
         tag_control_differencing(
-            series, scaling_factors, subtracted_dir, mask=brainmask
+            series, aslt1w_scaling_factors, subtracted_dir, mask=brainmask
         )
         copy(
             subtracted_dir / "beta_perf.nii.gz",
@@ -330,10 +417,14 @@ def process_subject(
     # final perfusion estimation in ASLT1w space
     pve_dir = aslt1w_dir / "pvs"
     gm_pve, wm_pve = [pve_dir / f"pv_{tiss}.nii.gz" for tiss in ("GM", "WM")]
+    csf_mask = pve_dir / "vent_csf_mask.nii.gz"
+    calib_aslt1w = aslt1w_dir / "calibration/calib0/calib0_corrected.nii.gz"
+    timing_img = aslt1w_dir / "label_control/timing_img.nii.gz"
+    t1_est_aslt1w = aslt1w_dir / "registration/mean_T1t_filt.nii.gz"
     oxford_aslt1w_dir = aslt1w_dir / "perfusion_estimation"
     oxford_aslt1w_dir.mkdir(parents=True, exist_ok=True)
-    if 9 in stages:
-        logging.info("Stage 9: Perfusion estimation in ASLT1w space")
+
+    def stage_9(cores):
         logging.info(
             f"Copying oxford_asl inputs to one location ({str(oxford_aslt1w_dir / 'oxford_asl_inputs')})."
         )
@@ -341,10 +432,10 @@ def process_subject(
             "-i": subtracted_dir / "beta_perf.nii.gz",
             "--pvgm": gm_pve,
             "--pvwm": wm_pve,
-            "--csf": pve_dir / "vent_csf_mask.nii.gz",
-            "-c": aslt1w_dir / "calibration/calib0/calib0_corrected.nii.gz",
-            "-m": aslt1w_dir / "registration/brain_fov_mask.nii.gz",
-            "--tiimg": aslt1w_dir / "label_control/timing_img.nii.gz",
+            "--csf": csf_mask,
+            "-c": calib_aslt1w,
+            "-m": brainmask,
+            "--tiimg": timing_img,
         }
         if use_t1:
             oxasl_inputs["--t1im"] = (
@@ -369,39 +460,308 @@ def process_subject(
             "--debug",
         ]
         if use_t1:
-            est_t1 = aslt1w_dir / "registration/mean_T1t_filt.nii.gz"
-            oxford_aslt1w_call.append(f"--t1im={str(est_t1)}")
+            oxford_aslt1w_call.append(f"--t1im={str(t1_est_aslt1w)}")
         sp_run(oxford_aslt1w_call)
 
     mninonlinear_name = subject_dir / "MNINonLinear"
-    if 10 in stages:
-        logging.info("Stage 10: Summary statistics within ROIs.")
+    std2struct = mninonlinear_name / "xfms/standard2acpc_dc.nii.gz"
+    native_space = oxford_aslt1w_dir / "native_space"
+    roi_stats_dir = aslt1w_dir / "roi_stats"
+
+    def stage_10(cores):
+        from hcpasl.qc import roi_stats
+
+        logging.info("Producing summary statistics within ROIs.")
         roi_stats(
             struct_name=structural["struct"],
             oxford_asl_dir=oxford_aslt1w_dir,
             gm_pve=gm_pve,
             wm_pve=wm_pve,
-            std2struct_name=mninonlinear_name / "xfms/standard2acpc_dc.nii.gz",
-            roi_stats_dir=aslt1w_dir / "roi_stats",
+            std2struct_name=std2struct,
+            roi_stats_dir=roi_stats_dir,
             territories_atlas=territories_atlas,
             territories_labels=territories_labels,
         )
 
-    if 11 in stages:
-        logging.info("Stage 11: Volume to surface projection.")
+    cifti_dirs = [base_dir / f"{d}/ASL/CIFTIPrepare" for d in ("T1w", "MNINonLinear")]
+
+    def stage_11(cores):
         surface_projection_stage(
-            subject_dir=subject_dir, subject_id=subid, outdir=outdir
+            subject_dir=subject_dir, subject_id=subid, outdir=outdir, cores=cores
         )
 
-    if 12 in stages:
-        logging.info(
-            "Stage 12: Copy key results into $outdir/T1w/ASL and $outdir/MNINonLinear/ASL"
+    mni_asl_dir = base_dir / "MNINonLinear/ASL"
+    key_outputs = [
+        aslt1w_dir / "perfusion_calib.nii.gz",
+        mni_asl_dir / "perfusion_calib.nii.gz",
+        mni_asl_dir / "perfusion_estimation/std_space",
+    ]
+
+    def stage_12(cores):
+        copy_outputs(subject_dir, outdir, cores)
+
+    def stage_13(cores):
+        from hcpasl.qc import create_qc_report
+
+        create_qc_report(
+            subject_id=subid, subject_dir=subject_dir, outdir=outdir, cores=cores
         )
-        copy_outputs(subject_dir, outdir)
 
-    if 13 in stages:
-        logging.info("Stage 13: Create QC workbench scene.")
-        create_qc_report(subject_id=subid, subject_dir=subject_dir, outdir=outdir)
+    # declare the artifacts each stage reads and writes so that
+    # independent stages can be run concurrently
+    pipeline = [
+        Stage(
+            0,
+            "Splitting ASL sequence into label-control pairs and calibration images.",
+            stage_0,
+            inputs=[mbpcasl],
+            outputs=[tis_name, calib0_name, calib1_name],
+        ),
+        Stage(
+            1,
+            "Derive gradient and susceptibility distortion correction.",
+            stage_1,
+            inputs=[calib0_name, fmaps["PA"], fmaps["AP"], gradients],
+            outputs=[gdc_warp, sdc_warp, fmap, fmapmag],
+            params={"interpolation": interpolation, "gd_corr": gd_corr},
+        ),
+        Stage(
+            2,
+            "Derive and apply initial corrections to M0 image.",
+            stage_2,
+            inputs=[
+                calib0_name,
+                calib1_name,
+                gdc_warp,
+                sdc_warp,
+                fmap,
+                fmapmag,
+                structural["struct"],
+                aparc_aseg,
+                fs_brainmask,
+                wmparc,
+                ribbon,
+                eb_factors,
+            ],
+            outputs=[calib_corr, bias_field, calib2struct, fmap2struct],
+            params={
+                "subid": subid,
+                "interpolation": interpolation,
+                "nobandingcorr": nobandingcorr,
+                "gd_corr": gd_corr,
+            },
+        ),
+        Stage(
+            3,
+            "Derive and apply initial corrections to ASL timeseries.",
+            stage_3,
+            inputs=[
+                tis_name,
+                calib_corr,
+                bias_field,
+                calib2struct,
+                gdc_warp,
+                sdc_warp,
+                fmapmag,
+                fmap2struct,
+                structural["struct"],
+                fs_brainmask,
+                eb_factors,
+            ],
+            outputs=[
+                asl_lc,
+                scaling_factors,
+                asl0_brainmask,
+                moco_dir,
+                fov_mask,
+                t1_est,
+                asl_scaling_factors,
+            ],
+            cores=cores,
+            params={
+                "interpolation": interpolation,
+                "nobandingcorr": nobandingcorr,
+                "gd_corr": gd_corr,
+                "satrecov_fitter": satrecov_fitter,
+                "satrecov_warm_start": satrecov_warm_start,
+                "moco_warm_start": moco_warm_start,
+            },
+        ),
+        Stage(
+            4,
+            "Label-control subtraction in native ASL space.",
+            stage_4,
+            inputs=[asl_lc, scaling_factors, asl0_brainmask],
+            outputs=[asl_subtract / "beta_perf.nii.gz"],
+        ),
+        Stage(
+            5,
+            "Perfusion estimation in ASL native space.",
+            stage_5,
+            inputs=[
+                asl_subtract / "beta_perf.nii.gz",
+                asl0_brainmask,
+                t1_est if use_t1 else None,
+            ],
+            outputs=[perfusion_name],
+            params={"use_t1": use_t1},
+        ),
+        Stage(
+            6,
+            "Fully-correct ASL and calibration into ASL-gridded T1w space.",
+            stage_6,
+            inputs=[
+                tis_name,
+                calib0_name,
+                perfusion_name,
+                moco_dir,
+                fov_mask,
+                gdc_warp,
+                sdc_warp,
+                fmapmag,
+                fmap2struct,
+                structural["struct"],
+                fs_brainmask,
+                wmparc,
+                ribbon,
+                asl_scaling_factors,
+                mt_name,
+                t1_est,
+            ],
+            outputs=[
+                asl2struct,
+                brainmask,
+                series,
+                aslt1w_scaling_factors,
+                calib_aslt1w,
+                timing_img,
+                t1_est_aslt1w,
+                aslt1w_dir / "registration/fov_mask.nii.gz",
+                aslt1w_dir / "registration/ASL_grid_T1w_brain_mask.nii.gz",
+                aslt1w_dir / "calibration/calib0/calib0_uncorrected.nii.gz",
+                aslt1w_dir / "calib_corrected.nii.gz",
+                aslt1w_dir / "label_control_corrected.nii.gz",
+            ],
+            cores=cores,
+            params={
+                "subid": subid,
+                "interpolation": interpolation,
+                "nobandingcorr": nobandingcorr,
+                "gd_corr": gd_corr,
+            },
+        ),
+        Stage(
+            7,
+            "Partial volume estimation in ASLT1w space.",
+            stage_7,
+            inputs=[tis_name, asl2struct, structural["struct"], aparc_aseg],
+            outputs=[
+                gm_pve,
+                wm_pve,
+                csf_mask,
+                aslt1w_dir / "registration/ASL_grid_T1w_acpc_dc_restore.nii.gz",
+            ],
+            cores=cores,
+            params={"interpolation": interpolation},
+        ),
+        Stage(
+            8,
+            "Label-control subtraction in ASLT1w space",
+            stage_8,
+            inputs=[series, aslt1w_scaling_factors, brainmask],
+            outputs=[
+                subtracted_dir / "beta_perf.nii.gz",
+                aslt1w_dir / "label_control_corrected_subtracted.nii.gz",
+            ],
+        ),
+        Stage(
+            9,
+            "Perfusion estimation in ASLT1w space",
+            stage_9,
+            inputs=[
+                subtracted_dir / "beta_perf.nii.gz",
+                gm_pve,
+                wm_pve,
+                csf_mask,
+                calib_aslt1w,
+                brainmask,
+                timing_img,
+                t1_est_aslt1w if use_t1 else None,
+            ],
+            outputs=[native_space],
+            params={"use_t1": use_t1},
+        ),
+        Stage(
+            10,
+            "Summary statistics within ROIs.",
+            stage_10,
+            inputs=[
+                structural["struct"],
+                native_space,
+                gm_pve,
+                wm_pve,
+                std2struct,
+                territories_atlas,
+                territories_labels,
+            ],
+            outputs=[roi_stats_dir],
+        ),
+        Stage(
+            11,
+            "Volume to surface projection.",
+            stage_11,
+            inputs=[native_space],
+            outputs=cifti_dirs,
+            cores=cores,
+            params={"subid": subid},
+            cacheable=False,
+        ),
+        Stage(
+            12,
+            "Copy key results into $outdir/T1w/ASL and $outdir/MNINonLinear/ASL",
+            stage_12,
+            inputs=[native_space, *cifti_dirs],
+            outputs=key_outputs,
+            cores=cores,
+            cacheable=False,
+        ),
+        Stage(
+            13,
+            "Create QC workbench scene.",
+            stage_13,
+            inputs=[
+                *key_outputs,
+                calib_aslt1w,
+                aslt1w_dir / "calib_corrected.nii.gz",
+                aslt1w_dir / "label_control_corrected.nii.gz",
+                pve_dir,
+                brainmask,
+                mni_asl_dir,
+            ],
+            outputs=[aslt1w_dir / "ASLQC"],
+            cores=cores,
+            params={"subid": subid},
+            cacheable=False,
+        ),
+    ]
+    if workspace is not None:
+        # stages 11 onwards run scripts which find their inputs within
+        # $outdir, so they work there rather than in the scratch copy
+        pipeline = [workspace.stage(s, local=s.number <= 10) for s in pipeline]
+    cache = StageCache(shared_asl_dir / "stage_cache.json") if use_cache else None
+    start_accounting(shared_asl_dir / "resource_usage.csv")
+    try:
+        run_stages(
+            [s for s in pipeline if s.number in stages], cores=cores, cache=cache
+        )
+    except BaseException:
+        if workspace is not None:
+            logging.error(f"Intermediate files have been kept in {work_dir}.")
+        raise
+    finally:
+        save_summary(shared_asl_dir / "resource_usage_summary.json")
+    if workspace is not None:
+        workspace.remove()
 
 
 def surface_projection_stage(
@@ -413,6 +773,7 @@ def surface_projection_stage(
     SmoothingFWHM="2",
     GreyOrdsRes="2",
     RegName="", #If using MSMAll, put MSMAll here
+    cores=1,
 ):
     """
     Project perfusion results to the cortical surface and generate
@@ -424,6 +785,8 @@ def surface_projection_stage(
     ----------
     subject_dir : pathlib.Path
         Subject's data directory
+    cores : int, optional
+        Number of projections to run at once. Default is 1.
     """
 
     # Projection scripts path:
@@ -443,6 +806,7 @@ def surface_projection_stage(
         "arrival_var",
     ]
 
+    cmds = []
     for idx in range(4):
         non_pvcorr_cmd = [
             script,
@@ -476,11 +840,17 @@ def surface_projection_stage(
             str(outdir),
         ]
 
-        sp_run(non_pvcorr_cmd)
-        sp_run(pvcorr_cmd)
+        cmds.extend([non_pvcorr_cmd, pvcorr_cmd])
+
+    # the first projection of each kind creates the ASL-grid and ROI images
+    # shared by the rest of that kind
+    deps = {n: [n % 2] for n in range(2, len(cmds))}
+    from hcpasl.utils import sp_run_many
 
+    sp_run_many(cmds, deps=deps, cores=cores)
 
-def copy_outputs(subject_dir, outdir):
+
+def copy_outputs(subject_dir, outdir, cores=1):
     """
     Copy key pipeline outputs to the T1w and MNI aligned high level ASL directory
 
@@ -488,19 +858,23 @@ def copy_outputs(subject_dir, outdir):
     ----------
     subject_dir : pathlib.Path
         Path to the subject data directory
+    cores : int, optional
+        Number of commands to run at once. Default is 1.
     """
 
     path_to_outs = str(subject_dir / outdir)
     mni_raw = str(subject_dir / "MNINonLinear")
     t1w_preproc = str(subject_dir / "T1w")
-    copy_key_outputs(path_to_outs, t1w_preproc, mni_raw)
+    from hcpasl.key_outputs import copy_key_outputs
 
+    copy_key_outputs(path_to_outs, t1w_preproc, mni_raw, cores=cores)
 
-def main():
+
+def check_environment():
     """
-    Main entry point for the hcp-asl pipeline.
+    Check the environment variables and FSL scripts required by the
+    pipeline are available, raising a RuntimeError if not.
     """
-
     env_var = ["HCPPIPEDIR", "FREESURFER_HOME", "FSLDIR", "CARET7DIR"]
     for ev in env_var:
         if not bool(os.environ.get(ev)):
@@ -509,8 +883,54 @@ def main():
             )
 
     # Try and load the ROI stats script now - func will raise exception if not found.
+    from hcpasl.utils import get_roi_stats_script
+
     get_roi_stats_script()
 
+
+def find_structural_inputs(
+    subject_dir, struct=None, sbrain=None, wmparc=None, ribbon=None
+):
+    """
+    Locate the structural inputs to the pipeline, using the default
+    locations within the subject's directory for any not provided.
+
+    Parameters
+    ----------
+    subject_dir : pathlib.Path
+        Subject's structural pre-processed data directory.
+    struct, sbrain, wmparc, ribbon : str or pathlib.Path, optional
+        Locations of the acpc-aligned, dc and restored structural
+        image, its brain-extracted counterpart and FreeSurfer's
+        wmparc.nii.gz and ribbon.nii.gz.
+
+    Returns
+    -------
+    dict
+        Resolved pathlib.Path locations of each input, keyed by
+        "struct", "sbrain", "wmparc" and "ribbon".
+    """
+    inputs = {"struct": struct, "sbrain": sbrain, "wmparc": wmparc, "ribbon": ribbon}
+    defaults = {
+        "struct": "T1w/T1w_acpc_dc_restore.nii.gz",
+        "sbrain": "T1w/T1w_acpc_dc_restore_brain.nii.gz",
+        "wmparc": "T1w/wmparc.nii.gz",
+        "ribbon": "T1w/ribbon.nii.gz",
+    }
+    for name, default in defaults.items():
+        if inputs[name] is None:
+            inputs[name] = subject_dir / default
+            logging.info(f"Using default for {name}: {inputs[name]}")
+        if not os.path.exists(inputs[name]):
+            raise ValueError(f"Path to {name} does not exist: {inputs[name]}")
+    return {name: Path(path).resolve(strict=True) for name, path in inputs.items()}
+
+
+def main():
+    """
+    Main entry point for the hcp-asl pipeline.
+    """
+
     # argument handling
     parser = argparse.ArgumentParser(
         description="Minimal processing pipeline for HCP Lifespan ASL data."
@@ -592,7 +1012,8 @@ def main():
     )
     optional.add_argument(
         "--cores",
-        help="Number of cores to use for multi-core operations. Default is 1.",
+        help="Number of cores to use for multi-core operations. Independent "
+        + "pipeline stages are run concurrently within this budget. Default is 1.",
         default=1,
         type=int,
     )
@@ -612,19 +1033,76 @@ def main():
     )
     optional.add_argument(
         "--territories_atlas",
-        help="Location of vascular territory atlas.",
-        default=get_package_data_name("vascular_territories_atlas.nii.gz"),
+        help="Location of vascular territory atlas. Default is the atlas "
+        + "included with the distribution.",
     )
     optional.add_argument(
         "--territories_labels",
-        help="Location of txt file with labels for vascular territory atlas.",
-        default=get_package_data_name("vascular_territories_atlas_labels.txt"),
+        help="Location of txt file with labels for vascular territory atlas. "
+        + "Default is the labels included with the distribution.",
     )
     optional.add_argument(
         "--outdir",
         help="Name of output directory to be created within subjects's directory.",
         default="",
     )
+    optional.add_argument(
+        "--nocache",
+        help="Run every requested stage, even those whose inputs, options "
+        + "and software versions are unchanged since they last completed.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--resume",
+        help="Resume long stages from the last step completed by a previous, "
+        + "interrupted run, rather than from the start of the stage.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--scratch",
+        help="Directory on node-local storage (for example /tmp or $TMPDIR) "
+        + "in which to write intermediate files. Only the outputs needed by "
+        + "later stages are copied back to --outdir.",
+    )
+    optional.add_argument(
+        "--intermediate_format",
+        help="Format of intermediate images. Uncompressed nii images take "
+        + "more disk space but are memory-mapped rather than decompressed "
+        + "when read. Final outputs are always gzipped. Default is nii.gz.",
+        choices=("nii.gz", "nii"),
+        default="nii.gz",
+    )
+    optional.add_argument(
+        "--satrecov_fitter",
+        help="How to fit the saturation recovery model used for slice-time "
+        + "correction: with two Fabber runs, or with a vectorised fit in "
+        + "numpy, which is much faster. Default is fabber.",
+        choices=("fabber", "numpy"),
+        default="fabber",
+    )
+    optional.add_argument(
+        "--satrecov_warm_start",
+        help="Start Fabber's second fit of the saturation recovery model "
+        + "from the posterior of the first fit, and stop it once it has "
+        + "converged rather than after a fixed number of iterations.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--moco_warm_start",
+        help="Experimental: refine the first motion estimates with flirt, "
+        + "starting from each volume's first-pass transform, rather than "
+        + "re-running mcflirt from scratch on the distortion-corrected series. "
+        + "Not yet checked against mcflirt on real data, see "
+        + "scripts/benchmark_moco.py.",
+        action="store_true",
+    )
+    optional.add_argument(
+        "--trace",
+        help="Write a timeline of the run's stages, commands, resampling, "
+        + "Fabber runs and image reads and writes to this json file. It can "
+        + "be viewed in chrome://tracing or https://ui.perfetto.dev.",
+        metavar="FILE",
+    )
     optional.add_argument(
         "--clean",
         help="Remove all previous outputs found within --outdir",
@@ -633,6 +1111,9 @@ def main():
 
     # assign arguments to variables
     args = parser.parse_args()
+    check_environment()
+    from hcpasl.utils import get_package_data_name, setup_logger
+
     subid = args.subid
     subject_dir = Path(args.subdir).resolve(strict=True)
     base_dir = subject_dir / Path(args.outdir)
@@ -651,31 +1132,13 @@ def main():
         f"HCP-ASL pipeline v{__version__} (commit {__sha1__} on {__timestamp__})."
     )
     logging.info(f"Logging to {log_path}")
+    startup = time.perf_counter() - _IMPORT_START
+    logging.info(f"Pipeline started in {startup:.2f}s.")
 
     # Look for required files in default paths if not provided.
-    if args.struct is None:
-        args.struct = subject_dir / "T1w/T1w_acpc_dc_restore.nii.gz"
-        logging.info(f"Using default for struct: {args.struct}")
-    if not os.path.exists(args.struct):
-        raise ValueError(f"Path to struct does not exist: {args.struct}")
-
-    if args.sbrain is None:
-        args.sbrain = subject_dir / "T1w/T1w_acpc_dc_restore_brain.nii.gz"
-        logging.info(f"Using default for sbrain: {args.sbrain}")
-    if not os.path.exists(args.sbrain):
-        raise ValueError(f"Path to sbrain does not exist: {args.sbrain}")
-
-    if args.wmparc is None:
-        args.wmparc = subject_dir / "T1w/wmparc.nii.gz"
-        logging.info(f"Using default for wmparc: {args.wmparc}")
-    if not os.path.exists(args.wmparc):
-        raise ValueError(f"Path to wmparc does not exist: {args.wmparc}")
-
-    if args.ribbon is None:
-        args.ribbon = subject_dir / "T1w/ribbon.nii.gz"
-        logging.info(f"Using default for ribbon: {args.ribbon}")
-    if not os.path.exists(args.ribbon):
-        raise ValueError(f"Path to ribbon does not exist: {args.ribbon}")
+    inputs = find_structural_inputs(
+        subject_dir, args.struct, args.sbrain, args.wmparc, args.ribbon
+    )
 
     # parse remaining arguments
     if args.mtname:
@@ -684,10 +1147,15 @@ def main():
         mtname = get_package_data_name("empirical_banding_factors.txt")
     else:
         mtname = None
-    structural = {
-        "struct": Path(args.struct).resolve(strict=True),
-        "sbrain": Path(args.sbrain).resolve(strict=True),
-    }
+    if args.territories_atlas is None:
+        args.territories_atlas = get_package_data_name(
+            "vascular_territories_atlas.nii.gz"
+        )
+    if args.territories_labels is None:
+        args.territories_labels = get_package_data_name(
+            "vascular_territories_atlas_labels.txt"
+        )
+    structural = {"struct": inputs["struct"], "sbrain": inputs["sbrain"]}
     mbpcasl = Path(args.mbpcasl).resolve(strict=True)
     fmaps = {
         "AP": Path(args.fmap_ap).resolve(strict=True),
@@ -707,6 +1175,9 @@ def main():
 
     # process subject
     logging.info(f"Processing subject {subject_dir}.")
+    if args.trace:
+        trace_path = Path(args.trace).resolve()
+        start_trace()
     try:
         process_subject(
             subid=subid,
@@ -721,15 +1192,25 @@ def main():
             structural=structural,
             fmaps=fmaps,
             use_t1=args.use_t1,
-            wmparc=args.wmparc,
-            ribbon=args.ribbon,
+            wmparc=inputs["wmparc"],
+            ribbon=inputs["ribbon"],
             nobandingcorr=args.nobandingcorr,
             outdir=args.outdir,
             stages=args.stages,
+            use_cache=not args.nocache,
+            resume=args.resume,
+            scratch=Path(args.scratch).resolve() if args.scratch else None,
+            intermediate_format=args.intermediate_format,
+            satrecov_fitter=args.satrecov_fitter,
+            satrecov_warm_start=args.satrecov_warm_start,
+            moco_warm_start=args.moco_warm_start,
         )
     except Exception as e:
         logging.error(f"Error processing subject {subject_dir}:\n {e}")
         raise e
+    finally:
+        if args.trace:
+            save_trace(trace_path)
 
 
 if __name__ == "__main__":
@@ -118,9 +118,11 @@ setup(
     entry_points={
         "console_scripts": [
             "process_hcp_asl = scripts.run_pipeline:main",
+            "process_hcp_asl_batch = scripts.run_batch:main",
             "get_sebased_bias_asl = scripts.se_based:se_based_bias_estimation",
             "mt_estimation_asl = scripts.mt_estimation_pipeline:main",
             "results_to_mni_asl = scripts.results_to_mni:main",
+            "compare_hcp_asl_outputs = scripts.compare_outputs:main",
         ]
     },
     scripts=[
@@ -136,6 +138,7 @@ setup(
             "resources/vascular_territories_atlas.nii.gz",
             "resources/vascular_territories_atlas_labels.txt",
             "resources/ASLQC_template.scene",
+            "resources/moco_refine.sch",
         ]
     },
 )
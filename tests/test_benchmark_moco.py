@@ -0,0 +1,41 @@
+"""
+RMS deviation used by `scripts/benchmark_moco.py` to check
+--moco_warm_start against mcflirt.
+"""
+
+import numpy as np
+import pytest
+
+from scripts.benchmark_moco import RMS_RADIUS, rms_deviation
+
+CENTRE = np.array([107.5, 107.5, 73.75])
+
+
+def rotation_z(angle, centre=CENTRE):
+    """FSL transform rotating by `angle` radians about z through `centre`"""
+    mat = np.eye(4)
+    c, s = np.cos(angle), np.sin(angle)
+    mat[:2, :2] = [[c, -s], [s, c]]
+    mat[:3, 3] = centre - mat[:3, :3] @ centre
+    return mat
+
+
+def test_identical_transforms():
+    mat = rotation_z(0.1) @ rotation_z(0.05, np.zeros(3))
+    assert rms_deviation(mat, mat, CENTRE) == pytest.approx(0, abs=1e-9)
+
+
+def test_translation():
+    shifted = np.eye(4)
+    shifted[:3, 3] = [0.3, -0.4, 0]
+    assert rms_deviation(shifted, np.eye(4), CENTRE) == pytest.approx(0.5)
+
+
+def test_rotation_about_centre():
+    # mean squared displacement over a ball of radius R rotated by a
+    # small angle about a diameter is 2 R^2 (1 - cos(angle)) * 2 / 5
+    angle = 0.01
+    expected = np.sqrt(RMS_RADIUS**2 * 2 / 5 * 2 * (1 - np.cos(angle)))
+    assert rms_deviation(rotation_z(angle), np.eye(4), CENTRE) == pytest.approx(
+        expected, rel=1e-3
+    )
@@ -0,0 +1,144 @@
+"""
+Layout of Fabber's MVN images and logs, see `hcpasl.fabber_outputs`.
+
+The tests marked `real_output` check the outputs of a real pair of
+Fabber satrecov runs, as saved by stage 3 in
+ASL/label_control/saturation_recovery/{first,second}. They are skipped
+unless the environment variable HCPASL_TEST_SATRECOV_DIR gives one of
+those directories.
+"""
+
+import os
+from pathlib import Path
+
+import nibabel as nb
+import numpy as np
+import pytest
+
+from hcpasl.fabber_outputs import (
+    SATRECOV_PARAMS,
+    fabber_iterations,
+    join_mvn,
+    mvn_layout,
+    split_mvn,
+    warm_start_mvn,
+)
+
+SATRECOV_DIR = os.environ.get("HCPASL_TEST_SATRECOV_DIR")
+real_output = pytest.mark.skipif(
+    SATRECOV_DIR is None, reason="HCPASL_TEST_SATRECOV_DIR is not set"
+)
+RUNS = ("nospatial", "spatial")
+
+
+def random_posterior(rng, shape, n_params):
+    means = rng.normal(size=(*shape, n_params))
+    factor = rng.normal(size=(*shape, n_params, n_params))
+    covariance = factor @ np.swapaxes(factor, -1, -2) + np.eye(n_params)
+    return means, covariance
+
+
+def load_image(directory, name):
+    (path,) = Path(directory).glob(f"{name}.nii*")
+    return nb.load(path).get_fdata()
+
+
+def test_mvn_layout():
+    # two parameters: c00, c10, c11, m0, m1, 1
+    mvn = np.array([1.0, 0.5, 2.0, 10.0, 20.0, 1.0])
+    means, covariance = split_mvn(mvn)
+    np.testing.assert_array_equal(means, [10.0, 20.0])
+    np.testing.assert_array_equal(covariance, [[1.0, 0.5], [0.5, 2.0]])
+
+
+@pytest.mark.parametrize("n_params", [1, 2, 3, 4])
+def test_mvn_round_trip(n_params):
+    rng = np.random.default_rng(n_params)
+    means, covariance = random_posterior(rng, (4, 5), n_params)
+    mvn = join_mvn(means, covariance)
+    assert mvn.shape[-1] == n_params * (n_params + 1) // 2 + n_params + 1
+    assert mvn_layout(mvn.shape[-1])[0] == n_params
+    np.testing.assert_array_equal(mvn[..., -1], 1)
+    split_means, split_covariance = split_mvn(mvn)
+    np.testing.assert_array_equal(split_means, means)
+    np.testing.assert_allclose(split_covariance, covariance)
+
+
+@pytest.mark.parametrize("n_volumes", [0, 2, 5, 8])
+def test_mvn_layout_rejects_other_sizes(n_volumes):
+    with pytest.raises(ValueError):
+        mvn_layout(n_volumes)
+
+
+def test_fabber_iterations():
+    log = (
+        "*** Spatial iteration *** 1\n"
+        "*** Spatial iteration *** 12\n"
+        "Max iterations reached\n"
+        "Iteration 3: F = 2.5\n"
+    )
+    assert fabber_iterations(log) == 12
+    assert fabber_iterations("Max iterations reached") is None
+
+
+@pytest.mark.parametrize("run", RUNS)
+def test_warm_start_mvn(tmp_path, run):
+    rng = np.random.default_rng(RUNS.index(run))
+    n_params = len(SATRECOV_PARAMS)
+    means, covariance = random_posterior(rng, (6, 6, 4), n_params)
+    fitted = np.zeros((6, 6, 4), dtype=bool)
+    fitted[1:5, 1:5, 1:3] = True
+    mvn = np.where(fitted[..., None], join_mvn(means, covariance), 0)
+    mask = np.zeros(fitted.shape)
+    mask[:, :5] = 1
+    nb.save(nb.Nifti1Image(mvn, np.eye(4)), tmp_path / "finalMVN.nii.gz")
+    nb.save(nb.Nifti1Image(mask, np.eye(4)), tmp_path / "mask.nii.gz")
+
+    warm_start_mvn(
+        tmp_path / "finalMVN.nii.gz", tmp_path / "mask.nii.gz", tmp_path / "init.nii.gz"
+    )
+    warm = nb.load(tmp_path / "init.nii.gz").get_fdata()
+    assert warm.shape == mvn.shape
+    warm_means, warm_covariance = split_mvn(warm)
+
+    inside, missing = mask > 0, (mask > 0) & ~fitted
+    np.testing.assert_allclose(warm_means[fitted], means[fitted])
+    median = np.median(means[fitted], axis=0)
+    np.testing.assert_allclose(
+        warm_means[missing], np.broadcast_to(median, warm_means[missing].shape)
+    )
+    variance = np.maximum(
+        means[fitted].var(axis=0),
+        np.median(np.diagonal(covariance[fitted], axis1=-2, axis2=-1), axis=0),
+    )
+    np.testing.assert_allclose(
+        warm_covariance[inside],
+        np.broadcast_to(np.diag(variance), warm_covariance[inside].shape),
+    )
+    np.testing.assert_array_equal(warm[inside, -1], 1)
+    np.testing.assert_array_equal(warm[~inside], 0)
+
+
+@real_output
+@pytest.mark.parametrize("run", RUNS)
+def test_real_fabber_log(run):
+    log = (Path(SATRECOV_DIR) / run / "logfile").read_text()
+    n_iter = fabber_iterations(log)
+    assert n_iter is not None and n_iter > 0
+
+
+@real_output
+@pytest.mark.parametrize("run", RUNS)
+def test_real_fabber_mvn(run):
+    mvn = load_image(Path(SATRECOV_DIR) / run, "finalMVN")
+    n_params, _, _ = mvn_layout(mvn.shape[-1])
+    assert n_params == len(SATRECOV_PARAMS)
+    fitted = np.any(mvn != 0, axis=-1)
+    means, covariance = split_mvn(mvn[fitted])
+    np.testing.assert_allclose(mvn[fitted, -1], 1)
+    assert np.all(np.diagonal(covariance, axis1=-2, axis2=-1) >= 0)
+    if run == "spatial":
+        t1 = load_image(Path(SATRECOV_DIR) / run, "mean_T1t")[fitted]
+        np.testing.assert_allclose(
+            means[:, SATRECOV_PARAMS.index("T1t")], t1, rtol=1e-5, atol=1e-6
+        )
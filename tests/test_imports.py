@@ -0,0 +1,37 @@
+"""
+Start-up of the command-line entry points.
+
+The processing modules, and the heavy third-party packages they
+import, must only be imported by the stages which use them, so that
+--help, argument errors and environment checks are fast.
+"""
+
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+# packages which are slow to import and must not be imported at start-up
+HEAVY_MODULES = {"fabber", "fsl", "regtricks", "scipy", "toblerone"}
+
+
+def imported_packages(module):
+    """Top-level packages imported by importing `module` in a fresh interpreter"""
+    code = f"import sys, {module}; print(' '.join(sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=REPO_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return {name.split(".")[0] for name in result.stdout.split()}
+
+
+@pytest.mark.parametrize(
+    "module", ["hcpasl", "scripts.run_pipeline", "scripts.run_batch"]
+)
+def test_no_heavy_imports(module):
+    assert not imported_packages(module) & HEAVY_MODULES
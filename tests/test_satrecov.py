@@ -0,0 +1,83 @@
+"""
+Accuracy of `hcpasl.satrecov` against synthetic ground truth.
+
+Control images are simulated from known M0t and T1t maps at the slice
+times of the HCP mbPCASL acquisition. Without noise the voxelwise fit
+must recover the maps; the spatial fit estimates the noise from the
+residuals, so it is only run on noisy images. With Gaussian noise of
+3% of M0t in each image, the tolerances below are about twice the
+errors seen over several noise seeds. The slice-time corrected series
+is checked through the correction factors given by the fitted T1t,
+which are what scale the series in
+`hcpasl.asl_correction.apply_slicetime_correction`.
+
+These tests do not compare the fit with Fabber's; that needs real data
+and `scripts/benchmark_satrecov.py`.
+"""
+
+import numpy as np
+import pytest
+
+from hcpasl.satrecov import fit_satrecov
+from hcpasl.timing import MBPCASL
+from hcpasl.utils import satrecov_scaling
+
+SHAPE = (12, 12, MBPCASL.n_slices)
+NOISE = 30.0
+
+# tolerances of the noisy fits, in s for T1t and relative for M0t
+T1_BIAS = 0.01
+T1_RMSE = {"nospatial": 0.15, "spatial": 0.06}
+M0_MEAN_ABS = {"nospatial": 0.025, "spatial": 0.012}
+# relative error of the slice-time correction factors
+FACTOR_RMS = {"nospatial": 0.005, "spatial": 0.0025}
+FACTOR_MAX = {"nospatial": 0.05, "spatial": 0.02}
+
+
+@pytest.fixture(scope="module")
+def truth():
+    x = np.arange(SHAPE[0])
+    t1 = 1.3 + 0.3 * np.sin(x / 3)[:, None, None] + 0.2 * np.cos(x / 4)[None, :, None]
+    m0 = 1000 + 200 * np.cos(x / 5)[:, None, None]
+    t1, m0 = (np.broadcast_to(a, SHAPE).copy() for a in (t1, m0))
+    times = MBPCASL.volume_times()[..., 0::2]
+    control = m0[..., None] * -np.expm1(-times / t1[..., None])
+    return m0, t1, control
+
+
+def factors(t1):
+    """Slice-time correction factors at each TI"""
+    return satrecov_scaling(t1[..., None], MBPCASL.tis, MBPCASL.volume_times(False))
+
+
+def test_noise_free_fit(truth):
+    m0, t1, control = truth
+    fit_m0, fit_t1 = fit_satrecov(control, spatial=False)["nospatial"]
+    np.testing.assert_allclose(fit_t1, t1, rtol=0, atol=1e-4)
+    np.testing.assert_allclose(fit_m0, m0, rtol=1e-4)
+
+
+@pytest.mark.parametrize("seed", [0, 1])
+def test_noisy_fit(truth, seed):
+    m0, t1, control = truth
+    noisy = control + np.random.default_rng(seed).normal(0, NOISE, control.shape)
+    fits = fit_satrecov(noisy)
+    for name, (fit_m0, fit_t1) in fits.items():
+        error = fit_t1 - t1
+        assert abs(error.mean()) < T1_BIAS, name
+        assert np.sqrt(np.mean(error**2)) < T1_RMSE[name], name
+        assert np.mean(np.abs(fit_m0 / m0 - 1)) < M0_MEAN_ABS[name], name
+
+        relative = factors(fit_t1) / factors(t1) - 1
+        assert np.sqrt(np.mean(relative**2)) < FACTOR_RMS[name], name
+        assert np.abs(relative).max() < FACTOR_MAX[name], name
+    spatial_error = np.mean((fits["spatial"][1] - t1) ** 2)
+    assert spatial_error < np.mean((fits["nospatial"][1] - t1) ** 2)
+
+
+def test_slicetime_correction(truth):
+    # the factors of the true T1t move every slice's signal to its TI
+    m0, t1, control = truth
+    corrected = control * np.take(factors(t1), MBPCASL.volume_ti_index[0::2], axis=-1)
+    expected = m0[..., None] * -np.expm1(-MBPCASL.volume_tis[0::2] / t1[..., None])
+    np.testing.assert_allclose(corrected, expected, rtol=1e-10)